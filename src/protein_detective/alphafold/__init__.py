@@ -1,18 +1,10 @@
-import asyncio
-import concurrent
 import logging
-from asyncio import Semaphore
-from collections.abc import AsyncGenerator, Iterable
+from collections.abc import Iterable
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Literal
-
-from aiohttp_retry import RetryClient
-from cattrs import structure
-from tqdm.asyncio import tqdm
+from typing import Any, Literal
 
 from protein_detective.alphafold.entry_summary import EntrySummary
-from protein_detective.utils import friendly_session, retrieve_files
 
 logger = logging.getLogger(__name__)
 
@@ -36,26 +28,6 @@ class AlphaFoldEntry:
     am_annotations_hg38_file: Path | None = None
 
 
-async def fetch_summmary(qualifier: str, session: RetryClient, semaphore: Semaphore) -> list[EntrySummary]:
-    url = f"https://alphafold.ebi.ac.uk/api/prediction/{qualifier}"
-    async with semaphore, session.get(url) as response:
-        response.raise_for_status()
-        data = await response.json()
-        return structure(data, list[EntrySummary])
-
-
-async def fetch_summaries(qualifiers: Iterable[str], max_parallel_downloads: int = 5) -> AsyncGenerator[EntrySummary]:
-    semaphore = Semaphore(max_parallel_downloads)
-    async with friendly_session() as session:
-        tasks = [fetch_summmary(qualifier, session, semaphore) for qualifier in qualifiers]
-        summaries_per_qualifier: list[list[EntrySummary]] = await tqdm.gather(
-            *tasks, desc="Fetching Alphafold summaries"
-        )
-        for summaries in summaries_per_qualifier:
-            for summary in summaries:
-                yield summary
-
-
 def url2name(url: str) -> str:
     """Given a URL, return the final path component as the name of the file."""
     return url.split("/")[-1]
@@ -85,57 +57,17 @@ downloadable_formats: set[DownloadableFormat] = {
 }
 """Set of formats that can be downloaded from the AlphaFold web service."""
 
-
-async def fetch_many_async(
-    ids: Iterable[str], save_dir: Path, what: set[DownloadableFormat] | None = None
-) -> AsyncGenerator[AlphaFoldEntry]:
-    """Asynchronously fetches summaries and pdb and pae (predicted alignment error) files from
-    [AlphaFold Protein Structure Database](https://alphafold.ebi.ac.uk/).
-
-    Args:
-        ids: A set of Uniprot IDs to fetch.
-        save_dir: The directory to save the fetched files to.
-        what: A set of formats to download. Defaults to {"pdb"}.
-
-    Yields:
-        A dataclass containing the summary, pdb file, and pae file.
-    """
-    summaries = [s async for s in fetch_summaries(ids)]
-
-    if what is None:
-        what = {"pdb"}
-    files = files_to_download(what, summaries)
-
-    await retrieve_files(
-        files,
-        save_dir,
-        desc="Downloading AlphaFold files",
-    )
-    for summary in summaries:
-        yield AlphaFoldEntry(
-            uniprot_acc=summary.uniprotAccession,
-            summary=summary,
-            bcif_file=save_dir / url2name(summary.bcifUrl) if "bcif" in what else None,
-            cif_file=save_dir / url2name(summary.cifUrl) if "cif" in what else None,
-            pdb_file=save_dir / url2name(summary.pdbUrl) if "pdb" in what else None,
-            pae_image_file=save_dir / url2name(summary.paeImageUrl) if "paeImage" in what else None,
-            pae_doc_file=save_dir / url2name(summary.paeDocUrl) if "paeDoc" in what else None,
-            am_annotations_file=(
-                save_dir / url2name(summary.amAnnotationsUrl)
-                if "amAnnotations" in what and summary.amAnnotationsUrl
-                else None
-            ),
-            am_annotations_hg19_file=(
-                save_dir / url2name(summary.amAnnotationsHg19Url)
-                if "amAnnotationsHg19" in what and summary.amAnnotationsHg19Url
-                else None
-            ),
-            am_annotations_hg38_file=(
-                save_dir / url2name(summary.amAnnotationsHg38Url)
-                if "amAnnotationsHg38" in what and summary.amAnnotationsHg38Url
-                else None
-            ),
-        )
+entry_fields: dict[DownloadableFormat, str] = {
+    "bcif": "bcif_file",
+    "cif": "cif_file",
+    "pdb": "pdb_file",
+    "paeImage": "pae_image_file",
+    "paeDoc": "pae_doc_file",
+    "amAnnotations": "am_annotations_file",
+    "amAnnotationsHg19": "am_annotations_hg19_file",
+    "amAnnotationsHg38": "am_annotations_hg38_file",
+}
+"""Field of AlphaFoldEntry with the file of each format."""
 
 
 def files_to_download(what: set[DownloadableFormat], summaries: Iterable[EntrySummary]) -> set[tuple[str, str]]:
@@ -158,28 +90,41 @@ def files_to_download(what: set[DownloadableFormat], summaries: Iterable[EntrySu
     return files
 
 
-def fetch_many(ids: Iterable[str], save_dir: Path, what: set[DownloadableFormat] | None = None) -> list[AlphaFoldEntry]:
-    """Synchronously fetches summaries and pdb and pae files from AlphaFold Protein Structure Database.
+def entry_from_summary(summary: EntrySummary, save_dir: Path, what: set[DownloadableFormat]) -> AlphaFoldEntry:
+    """Create an AlphaFoldEntry with the files of a summary that are downloaded to a directory.
 
     Args:
-        ids: A set of Uniprot IDs to fetch.
-        save_dir: The directory to save the fetched files to.
-        what: A set of formats to download (e.g., "pdb", "cif"). Defaults to {"pdb"}.
+        summary: The summary of the entry.
+        save_dir: The directory where the files are downloaded to.
+        what: The formats that are downloaded.
 
     Returns:
-        A list of AlphaFoldEntry dataclasses containing the summary, pdb file, and pae file.
+        An AlphaFoldEntry with paths to the downloaded files.
     """
-
-    async def gather_entries():
-        return [entry async for entry in fetch_many_async(ids, save_dir, what)]
-
-    def run_async_task():
-        return asyncio.run(gather_entries())
-
-    # pyrefly: ignore  # noqa: ERA001
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(run_async_task)
-        return future.result()
+    return AlphaFoldEntry(
+        uniprot_acc=summary.uniprotAccession,
+        summary=summary,
+        bcif_file=save_dir / url2name(summary.bcifUrl) if "bcif" in what else None,
+        cif_file=save_dir / url2name(summary.cifUrl) if "cif" in what else None,
+        pdb_file=save_dir / url2name(summary.pdbUrl) if "pdb" in what else None,
+        pae_image_file=save_dir / url2name(summary.paeImageUrl) if "paeImage" in what else None,
+        pae_doc_file=save_dir / url2name(summary.paeDocUrl) if "paeDoc" in what else None,
+        am_annotations_file=(
+            save_dir / url2name(summary.amAnnotationsUrl)
+            if "amAnnotations" in what and summary.amAnnotationsUrl
+            else None
+        ),
+        am_annotations_hg19_file=(
+            save_dir / url2name(summary.amAnnotationsHg19Url)
+            if "amAnnotationsHg19" in what and summary.amAnnotationsHg19Url
+            else None
+        ),
+        am_annotations_hg38_file=(
+            save_dir / url2name(summary.amAnnotationsHg38Url)
+            if "amAnnotationsHg38" in what and summary.amAnnotationsHg38Url
+            else None
+        ),
+    )
 
 
 def relative_to(entry: AlphaFoldEntry, session_dir: Path) -> AlphaFoldEntry:
@@ -208,3 +153,24 @@ def relative_to(entry: AlphaFoldEntry, session_dir: Path) -> AlphaFoldEntry:
             entry.am_annotations_hg38_file.relative_to(session_dir) if entry.am_annotations_hg38_file else None
         ),
     )
+
+
+_fetch_names = {
+    "fetch_summmary",
+    "fetch_summaries",
+    "fetch_many_async",
+    "fetch_many_list_async",
+    "fetch_many",
+    "iter_fetch_async",
+}
+
+
+def __getattr__(name: str) -> Any:
+    # The fetch functions live in protein_detective.alphafold.fetch and are loaded on first use,
+    # so using AlphaFoldEntry does not import the HTTP client stack.
+    if name in _fetch_names:
+        from protein_detective.alphafold import fetch  # noqa: PLC0415 lazy load
+
+        return getattr(fetch, name)
+    msg = f"module {__name__!r} has no attribute {name!r}"
+    raise AttributeError(msg)
@@ -1,8 +1,12 @@
 import logging
-from collections.abc import Generator
+from collections.abc import Generator, Iterable, Mapping
 from dataclasses import dataclass
+from itertools import groupby
 from pathlib import Path
 
+from protein_detective.instrumentation import timed
+from protein_detective.packed import PackedStore
+
 """
 Methods to filter AlphaFoldDB structures on confidence scores.
 
@@ -15,9 +19,14 @@ See https://www.ebi.ac.uk/training/online/courses/alphafold/inputs-and-outputs/e
 logger = logging.getLogger(__name__)
 
 
-def find_high_confidence_residues(pdb_file: Path, confidence: float) -> Generator[int]:
+def find_high_confidence_residues(
+    pdb_file: Path, confidence: float, store: PackedStore | None = None
+) -> Generator[int]:
+    if store is None:
+        store = PackedStore(pdb_file.parent)
     prev_res_index = None
-    with pdb_file.open("r") as f:
+    # Files linked from a mirror can be gzipped, which the store takes care of
+    with store.open_text(pdb_file) as f:
         for line in f:
             if line.startswith("ATOM"):
                 # Extract the b-factor value from the PDB line
@@ -31,23 +40,100 @@ def find_high_confidence_residues(pdb_file: Path, confidence: float) -> Generato
                         prev_res_index = res_index
 
 
-def filter_out_low_confidence_residues(input_pdb_file: Path, allowed_residues: set[int], output_pdb_file: Path):
+def filter_out_low_confidence_residues(
+    input_pdb_file: Path,
+    allowed_residues: set[int],
+    output_pdb_file: Path,
+    store: PackedStore | None = None,
+    overwrite: bool = False,
+) -> bool:
     # TODO if residue is removed from ATOM lines also remove it
     # elsewhere in the file (SEQRES, TER).
     # TODO do we need to take model/chain into account?
     # now assumes single model and single chain
-    if output_pdb_file.exists():
+    if store is None:
+        store = PackedStore(output_pdb_file.parent)
+    if not overwrite and store.exists(output_pdb_file):
         logger.info(f"Output file {output_pdb_file} already exists. Skipping filtering for {input_pdb_file}.")
-        return
-    with input_pdb_file.open("r") as input_file, output_pdb_file.open("w") as output_file:
+        return False
+    output = []
+    with store.open_text(input_pdb_file) as input_file:
         for line in input_file:
             if line.startswith("ATOM"):
                 # Extract the residue index from the PDB line
                 res_index = int(line[22:26].strip())
                 if res_index in allowed_residues:
-                    output_file.write(line)
+                    output.append(line)
             else:
-                output_file.write(line)
+                output.append(line)
+    store.write_text(output_pdb_file, "".join(output))
+    return True
+
+
+def density_filtered_file(pdb_file: Path, density_filtered_dir: Path) -> Path:
+    """Path of the density filtered PDB file of an AlphaFoldDB PDB file.
+
+    Args:
+        pdb_file: The AlphaFoldDB PDB file, which may be gzipped.
+        density_filtered_dir: Directory where the filtered PDB files are saved.
+
+    Returns:
+        The path, the filtered PDB file is never gzipped.
+    """
+    return density_filtered_dir / pdb_file.name.removesuffix(".gz")
+
+
+def density_filtered_fingerprint(input_fingerprint: str, confidence: float) -> str:
+    """Fingerprint of a density filtered PDB file.
+
+    The file only depends on the AlphaFoldDB PDB file and the confidence threshold,
+    so filters that only differ in their min and max threshold share the file.
+
+    Args:
+        input_fingerprint: Fingerprint of the AlphaFoldDB PDB file,
+            see [PackedStore.fingerprint][protein_detective.packed.PackedStore.fingerprint].
+        confidence: The confidence threshold.
+
+    Returns:
+        The fingerprint.
+    """
+    # The database stores the threshold as a 32 bit float, so round it
+    return f"{input_fingerprint};confidence={confidence:g}"
+
+
+def format_residue_ranges(residues: Iterable[int]) -> str:
+    """Format residue indices as compact ranges.
+
+    Args:
+        residues: The residue indices.
+
+    Returns:
+        Comma separated ranges, like `1-10,15,20-25`.
+    """
+    ranges = []
+    # Consecutive residues have the same difference between residue index and position in sorted list
+    for _, group in groupby(enumerate(sorted(set(residues))), key=lambda pair: pair[1] - pair[0]):
+        run = [residue for _, residue in group]
+        ranges.append(str(run[0]) if len(run) == 1 else f"{run[0]}-{run[-1]}")
+    return ",".join(ranges)
+
+
+def parse_residue_ranges(ranges: str) -> set[int]:
+    """Parse ranges made by [format_residue_ranges][protein_detective.alphafold.density.format_residue_ranges].
+
+    Args:
+        ranges: Comma separated ranges, like `1-10,15,20-25`.
+
+    Returns:
+        The residue indices.
+    """
+    residues: set[int] = set()
+    for part in ranges.split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        residues.update(range(int(start), int(end or start) + 1))
+    return residues
 
 
 @dataclass
@@ -74,15 +160,48 @@ class DensityFilterResult:
         pdb_file: The name of the PDB file that was processed.
         count: The number of residues with a pLDDT above the confidence threshold.
         density_filtered_file: The path to the density filtered PDB file, if passed filter.
+            The file is only written when filtering eagerly.
+        kept_residues: Ranges of the residues with a pLDDT above the confidence threshold, if passed filter.
+            Use [parse_residue_ranges][protein_detective.alphafold.density.parse_residue_ranges] to get the indices.
+        input_fingerprint: Fingerprint of the PDB file that was processed.
+        output_fingerprint: Fingerprint of the density filtered PDB file, if it was written or already up to date.
     """
 
     pdb_file: str
     count: int
     density_filtered_file: Path | None = None
+    kept_residues: str | None = None
+    input_fingerprint: str | None = None
+    output_fingerprint: str | None = None
 
 
+@dataclass(frozen=True)
+class DensityFilteredRow:
+    """A structure that passed a density filter, as stored in the session database.
+
+    Parameters:
+        uniprot_acc: The UniProt accession of the structure.
+        pdb_file: The AlphaFoldDB PDB file the structure was filtered from.
+        density_filtered_file: The path of the density filtered PDB file.
+        kept_residues: Ranges of the residues with a pLDDT above the confidence threshold.
+        confidence: The confidence threshold of the density filter.
+    """
+
+    uniprot_acc: str
+    pdb_file: Path
+    density_filtered_file: Path
+    kept_residues: str
+    confidence: float
+
+
+@timed
 def filter_on_density(
-    alphafold_pdb_files: list[Path], query: DensityFilterQuery, density_filtered_dir: Path
+    alphafold_pdb_files: list[Path],
+    query: DensityFilterQuery,
+    density_filtered_dir: Path,
+    store: PackedStore | None = None,
+    eager: bool = True,
+    fingerprints: Mapping[Path, str] | None = None,
 ) -> Generator[DensityFilterResult]:
     """Filter AlphaFoldDB structures based on density confidence.
 
@@ -90,29 +209,49 @@ def filter_on_density(
         alphafold_pdb_files: List of PDB files from AlphaFoldDB to filter.
         query: The density filter query containing the confidence thresholds.
         density_filtered_dir: Directory where the filtered PDB files will be saved.
+        store: Store to read and write packed files with. If None, files are read from and written to disk.
+        eager: Whether to write the filtered PDB files.
+            If False, only the kept residues are returned and the files can be written later with
+            [filter_out_low_confidence_residues][protein_detective.alphafold.density.filter_out_low_confidence_residues].
+        fingerprints: Fingerprints of existing density filtered PDB files, by path.
+            If given, a file is written unless it exists with the fingerprint it would be written with.
+            If None, existing files are never written again.
 
     Yields:
         For each PDB files yields whether it was filtered or not,
             and number of residues with pLDDT above the confidence threshold.
     """
+    if store is None:
+        store = PackedStore(density_filtered_dir)
     for pdb_file in alphafold_pdb_files:
-        residues = set(find_high_confidence_residues(pdb_file, query.confidence))
+        input_fingerprint = store.fingerprint(pdb_file)
+        residues = set(find_high_confidence_residues(pdb_file, query.confidence, store))
         count = len(residues)
         if count < query.min_threshold or count > query.max_threshold:
             yield DensityFilterResult(
                 pdb_file=pdb_file.name,
                 count=count,
+                input_fingerprint=input_fingerprint,
             )
             # Skip structure that is outside the min and max threshold
             continue
-        density_filtered_file = density_filtered_dir / pdb_file.name
-        filter_out_low_confidence_residues(
-            pdb_file,
-            residues,
-            density_filtered_file,
-        )
+        output_file = density_filtered_file(pdb_file, density_filtered_dir)
+        output_fingerprint = None
+        if eager:
+            output_fingerprint = density_filtered_fingerprint(input_fingerprint, query.confidence)
+            if fingerprints is None:
+                if not filter_out_low_confidence_residues(pdb_file, residues, output_file, store):
+                    # An existing file of unknown origin was kept
+                    output_fingerprint = None
+            else:
+                recorded = fingerprints.get(output_file)
+                if recorded != output_fingerprint or not store.exists(output_file):
+                    filter_out_low_confidence_residues(pdb_file, residues, output_file, store, overwrite=True)
         yield DensityFilterResult(
             pdb_file=pdb_file.name,
             count=count,
-            density_filtered_file=density_filtered_file,
+            density_filtered_file=output_file,
+            kept_residues=format_residue_ranges(residues),
+            input_fingerprint=input_fingerprint,
+            output_fingerprint=output_fingerprint,
         )
@@ -0,0 +1,256 @@
+"""Fetch summaries and files from the [AlphaFold Protein Structure Database](https://alphafold.ebi.ac.uk/)."""
+
+from asyncio import Semaphore, to_thread
+from collections.abc import AsyncGenerator, Iterable
+from pathlib import Path
+
+from aiohttp_retry import RetryClient
+from cattrs import structure
+from tqdm.asyncio import tqdm
+
+from protein_detective.alphafold import AlphaFoldEntry, DownloadableFormat, entry_from_summary, files_to_download
+from protein_detective.alphafold.entry_summary import EntrySummary
+from protein_detective.instrumentation import timed
+from protein_detective.mirror import link_from_alphafold_mirror
+from protein_detective.utils import (
+    FriendlyClient,
+    _worker_pool,
+    iter_retrieve_files,
+    retrieve_files,
+    reuse_session,
+    run_async,
+)
+
+
+@timed
+async def fetch_summmary(qualifier: str, session: RetryClient, semaphore: Semaphore) -> list[EntrySummary]:
+    url = f"https://alphafold.ebi.ac.uk/api/prediction/{qualifier}"
+    async with semaphore, session.get(url) as response:
+        response.raise_for_status()
+        data = await response.json()
+        return structure(data, list[EntrySummary])
+
+
+async def fetch_summaries(
+    qualifiers: Iterable[str], max_parallel_downloads: int = 5, session: FriendlyClient | None = None
+) -> AsyncGenerator[EntrySummary]:
+    semaphore = Semaphore(max_parallel_downloads)
+    async with reuse_session(session, max_parallel_per_host=max_parallel_downloads) as client:
+        tasks = [fetch_summmary(qualifier, client, semaphore) for qualifier in qualifiers]
+        summaries_per_qualifier: list[list[EntrySummary]] = await tqdm.gather(
+            *tasks, desc="Fetching Alphafold summaries"
+        )
+        for summaries in summaries_per_qualifier:
+            for summary in summaries:
+                yield summary
+
+
+async def fetch_many_async(
+    ids: Iterable[str],
+    save_dir: Path,
+    what: set[DownloadableFormat] | None = None,
+    max_parallel_downloads: int = 5,
+    session: FriendlyClient | None = None,
+    mirror_dir: Path | None = None,
+) -> AsyncGenerator[AlphaFoldEntry]:
+    """Asynchronously fetches summaries and pdb and pae (predicted alignment error) files from
+    [AlphaFold Protein Structure Database](https://alphafold.ebi.ac.uk/).
+
+    Args:
+        ids: A set of Uniprot IDs to fetch.
+        save_dir: The directory to save the fetched files to.
+        what: A set of formats to download. Defaults to {"pdb"}.
+        max_parallel_downloads: The maximum number of parallel downloads.
+        session: Session to fetch summaries and files with.
+            If None, a new session is created and used for both.
+        mirror_dir: Directory with AlphaFold files. Entries with all formats in the directory are
+            linked into `save_dir` without a summary, only the other entries are fetched.
+
+    Yields:
+        A dataclass containing the summary, pdb file, and pae file.
+    """
+    if what is None:
+        what = {"pdb"}
+    if mirror_dir is not None:
+        # Scanning the mirror and linking files blocks, so it runs in a thread instead of on the event loop
+        linked, ids = await to_thread(link_from_alphafold_mirror, ids, mirror_dir, save_dir, what)
+        for entry in linked:
+            yield entry
+
+    async with reuse_session(session, max_parallel_per_host=max_parallel_downloads) as client:
+        summaries = [s async for s in fetch_summaries(ids, max_parallel_downloads, session=client)]
+
+        files = files_to_download(what, summaries)
+
+        await retrieve_files(
+            files,
+            save_dir,
+            max_parallel_downloads=max_parallel_downloads,
+            desc="Downloading AlphaFold files",
+            session=client,
+        )
+    for summary in summaries:
+        yield entry_from_summary(summary, save_dir, what)
+
+
+async def iter_fetch_async(
+    ids: Iterable[str],
+    save_dir: Path,
+    what: set[DownloadableFormat] | None = None,
+    max_parallel_downloads: int = 5,
+    session: FriendlyClient | None = None,
+    mirror_dir: Path | None = None,
+) -> AsyncGenerator[AlphaFoldEntry]:
+    """Asynchronously fetches summaries and files, yielding each entry as soon as its files are downloaded.
+
+    Unlike `fetch_many_async`, downloading files starts while summaries are still being fetched,
+    so the first entries are available long before the last.
+
+    Args:
+        ids: A set of Uniprot IDs to fetch.
+        save_dir: The directory to save the fetched files to.
+        what: A set of formats to download. Defaults to {"pdb"}.
+        max_parallel_downloads: The maximum number of parallel downloads.
+        session: Session to fetch summaries and files with.
+            If None, a new session is created and used for both.
+        mirror_dir: Directory with AlphaFold files. Entries with all formats in the directory are
+            linked into `save_dir` without a summary, only the other entries are fetched.
+
+    Yields:
+        Entries with files, first the linked entries
+        and then the downloaded entries in the order their files finished downloading.
+    """
+    if what is None:
+        what = {"pdb"}
+    if mirror_dir is not None:
+        linked, ids = await to_thread(link_from_alphafold_mirror, ids, mirror_dir, save_dir, what)
+        for entry in linked:
+            yield entry
+    async for entry in _iter_download(ids, save_dir, what, max_parallel_downloads, session):
+        yield entry
+
+
+async def _iter_download(
+    ids: Iterable[str],
+    save_dir: Path,
+    what: set[DownloadableFormat],
+    max_parallel_downloads: int,
+    session: FriendlyClient | None,
+) -> AsyncGenerator[AlphaFoldEntry]:
+    downloads = _EntryDownloads(save_dir, what)
+
+    async with reuse_session(session, max_parallel_per_host=max_parallel_downloads) as client:
+        semaphore = Semaphore(max_parallel_downloads)
+
+        async def fetch(qualifier: str) -> list[EntrySummary]:
+            return await fetch_summmary(qualifier, client, semaphore)
+
+        async def urls() -> AsyncGenerator[tuple[str, str]]:
+            qualifiers = ((qualifier,) for qualifier in ids)
+            async for summaries in _worker_pool(qualifiers, fetch, max_parallel_downloads):
+                for summary in summaries:
+                    for file in downloads.add(summary):
+                        yield file
+
+        async for path in iter_retrieve_files(
+            urls(),
+            save_dir,
+            max_parallel_downloads=max_parallel_downloads,
+            desc="Downloading AlphaFold files",
+            session=client,
+        ):
+            downloads.downloaded(path.name)
+            for entry in downloads.pop_ready():
+                yield entry
+    for entry in downloads.pop_ready():
+        yield entry
+
+
+class _EntryDownloads:
+    """Keeps track of which files of each entry are still being downloaded."""
+
+    def __init__(self, save_dir: Path, what: set[DownloadableFormat]):
+        self.save_dir = save_dir
+        self.what = what
+        self._entries: dict[str, AlphaFoldEntry] = {}
+        self._pending: dict[str, int] = {}
+        self._file2entry: dict[str, str] = {}
+        self._ready: list[AlphaFoldEntry] = []
+
+    def add(self, summary: EntrySummary) -> set[tuple[str, str]]:
+        """Add the entry of a summary and return its files to download."""
+        files = files_to_download(self.what, [summary])
+        entry = entry_from_summary(summary, self.save_dir, self.what)
+        if not files:
+            self._ready.append(entry)
+            return files
+        self._entries[summary.entryId] = entry
+        self._pending[summary.entryId] = len(files)
+        for _, filename in files:
+            self._file2entry[filename] = summary.entryId
+        return files
+
+    def downloaded(self, filename: str):
+        """Mark a file as downloaded, the entry is ready when all its files are downloaded."""
+        entry_id = self._file2entry.pop(filename)
+        self._pending[entry_id] -= 1
+        if self._pending[entry_id] == 0:
+            del self._pending[entry_id]
+            self._ready.append(self._entries.pop(entry_id))
+
+    def pop_ready(self) -> list[AlphaFoldEntry]:
+        """Return the entries with all files downloaded since the last call."""
+        ready, self._ready = self._ready, []
+        return ready
+
+
+async def fetch_many_list_async(
+    ids: Iterable[str],
+    save_dir: Path,
+    what: set[DownloadableFormat] | None = None,
+    max_parallel_downloads: int = 5,
+    session: FriendlyClient | None = None,
+    mirror_dir: Path | None = None,
+) -> list[AlphaFoldEntry]:
+    """Asynchronously fetches summaries and files from AlphaFold Protein Structure Database into a list.
+
+    Args:
+        ids: A set of Uniprot IDs to fetch.
+        save_dir: The directory to save the fetched files to.
+        what: A set of formats to download (e.g., "pdb", "cif"). Defaults to {"pdb"}.
+        max_parallel_downloads: The maximum number of parallel downloads.
+        session: Session to fetch summaries and files with. If None, a new session is created.
+        mirror_dir: Directory with AlphaFold files. Entries with all formats in the directory are
+            linked into `save_dir` without a summary, only the other entries are fetched.
+
+    Returns:
+        A list of AlphaFoldEntry dataclasses containing the summary, pdb file, and pae file.
+    """
+    return [
+        entry
+        async for entry in fetch_many_async(ids, save_dir, what, max_parallel_downloads, session, mirror_dir=mirror_dir)
+    ]
+
+
+def fetch_many(
+    ids: Iterable[str],
+    save_dir: Path,
+    what: set[DownloadableFormat] | None = None,
+    max_parallel_downloads: int = 5,
+    mirror_dir: Path | None = None,
+) -> list[AlphaFoldEntry]:
+    """Synchronously fetches summaries and pdb and pae files from AlphaFold Protein Structure Database.
+
+    Args:
+        ids: A set of Uniprot IDs to fetch.
+        save_dir: The directory to save the fetched files to.
+        what: A set of formats to download (e.g., "pdb", "cif"). Defaults to {"pdb"}.
+        max_parallel_downloads: The maximum number of parallel downloads.
+        mirror_dir: Directory with AlphaFold files. Entries with all formats in the directory are
+            linked into `save_dir` without a summary, only the other entries are fetched.
+
+    Returns:
+        A list of AlphaFoldEntry dataclasses containing the summary, pdb file, and pae file.
+    """
+
+    return run_async(fetch_many_list_async(ids, save_dir, what, max_parallel_downloads, mirror_dir=mirror_dir))
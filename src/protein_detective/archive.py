@@ -0,0 +1,119 @@
+"""Random access to members of uncompressed tar archives.
+
+The AlphaFold database publishes the structures of each proteome as a tar archive,
+like `UP000005640_9606_HUMAN_v4.tar`, with a gzipped file per structure.
+Listing the members of an archive means reading all its headers,
+so the offsets of the members are stored in an index file next to the archive.
+With the index, a member is read with a single seek instead of a scan through the archive.
+"""
+
+import json
+import logging
+import tarfile
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ArchiveMember:
+    """A file in a tar archive.
+
+    Parameters:
+        archive: Path to the tar archive.
+        name: Name of the member in the archive.
+        offset: Offset of the data of the member in the archive, in bytes.
+        size: Size of the data of the member, in bytes.
+    """
+
+    archive: Path
+    name: str
+    offset: int
+    size: int
+
+
+def index_path(archive: Path) -> Path:
+    """Return the path of the index file of an archive.
+
+    Args:
+        archive: Path to the tar archive.
+
+    Returns:
+        Path to the index file.
+    """
+    return archive.with_name(archive.name + ".index.json")
+
+
+def build_index(archive: Path) -> list[ArchiveMember]:
+    """List the files in a tar archive with their offsets.
+
+    Args:
+        archive: Path to the uncompressed tar archive.
+
+    Returns:
+        The files in the archive.
+    """
+    with tarfile.open(archive, mode="r:") as tar:
+        return [ArchiveMember(archive, info.name, info.offset_data, info.size) for info in tar if info.isfile()]
+
+
+def load_index(archive: Path) -> list[ArchiveMember]:
+    """Load the index of a tar archive, building it when missing or outdated.
+
+    The index is outdated when the size or modification time of the archive changed.
+    When the index can not be written next to the archive, it is only kept in memory.
+
+    Args:
+        archive: Path to the uncompressed tar archive.
+
+    Returns:
+        The files in the archive.
+    """
+    stat = archive.stat()
+    path = index_path(archive)
+    if path.exists():
+        index = json.loads(path.read_text())
+        if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+            return [ArchiveMember(archive, name, offset, size) for name, offset, size in index["members"]]
+
+    logger.info("Indexing members of %s", archive)
+    members = build_index(archive)
+    index = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "members": [(member.name, member.offset, member.size) for member in members],
+    }
+    try:
+        path.write_text(json.dumps(index))
+    except OSError as e:
+        logger.warning("Could not write index of %s to %s: %s", archive, path, e)
+    return members
+
+
+def extract_member(member: ArchiveMember, save_dir: Path, chunk_size: int = 1024 * 1024) -> Path:
+    """Extract a single file from a tar archive, by reading just its bytes.
+
+    Args:
+        member: The file to extract.
+        save_dir: The directory to extract the file to, without the directories of the member name.
+        chunk_size: Number of bytes to copy at a time.
+
+    Returns:
+        Path to the extracted file.
+    """
+    save_dir.mkdir(parents=True, exist_ok=True)
+    output_file = save_dir / PurePosixPath(member.name).name
+    part = output_file.with_name(output_file.name + ".part")
+    with member.archive.open("rb") as source, part.open("wb") as target:
+        source.seek(member.offset)
+        remaining = member.size
+        while remaining > 0:
+            chunk = source.read(min(chunk_size, remaining))
+            if not chunk:
+                msg = f"Archive {member.archive} ended before end of member {member.name}"
+                raise ValueError(msg)
+            target.write(chunk)
+            remaining -= len(chunk)
+    part.replace(output_file)
+    return output_file
@@ -1,79 +1,229 @@
 import argparse
+from datetime import timedelta
 from pathlib import Path
 
 from rich import print  # noqa: A004
 
 from protein_detective.alphafold import downloadable_formats
-from protein_detective.alphafold.density import DensityFilterQuery
-from protein_detective.uniprot import Query
-from protein_detective.workflow import (
-    density_filter,
-    prune_pdbs,
-    retrieve_structures,
-    search_structures_in_uniprot,
-    what_retrieve_choices,
-)
+from protein_detective.instrumentation import instrumentation, write_profile
 
+# The workflow and its dependencies are imported inside the handlers,
+# so a subcommand only pays for importing what it uses.
 
-def add_search_parser(subparsers):
-    search_parser = subparsers.add_parser("search", help="Search UniProt for structures")
-    search_parser.add_argument("session_dir", help="Session directory to store results")
-    search_parser.add_argument("--taxon-id", type=str, help="NCBI Taxon ID")
-    search_parser.add_argument(
+what_retrieve_choices = {"pdbe", "alphafold"}
+"""Same as protein_detective.workflow.what_retrieve_choices, without importing the workflow."""
+search_backend_choices = {"sparql", "rest"}
+"""Same as protein_detective.workflow.search_backend_choices, without importing the workflow."""
+
+
+def add_profile_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Measure time spent per stage, print it and store it in the stage_timings table of the session.",
+    )
+    parser.add_argument(
+        "--profile-output",
+        type=Path,
+        metavar="DIR",
+        help="Profile the command and write a flamegraph compatible profile to this directory. "
+        "Uses pyinstrument when installed, otherwise cProfile.",
+    )
+
+
+def add_shard_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--shard",
+        type=str,
+        metavar="INDEX/COUNT",
+        help="Only do the work of this shard, like 3/8 for shard index 3 of 8. "
+        "Reads the session read-only and writes results to the shards directory of the session, "
+        "so shards can run on different nodes at the same time. Merge them with the merge-shards command.",
+    )
+
+
+def add_packed_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--packed",
+        action="store_true",
+        help="Append output files to pack files in the packed directory of the session, "
+        "instead of writing a file per structure. Use the materialize command to get files.",
+    )
+
+
+def add_eager_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--eager",
+        action="store_true",
+        help="Write the density filtered structures while filtering. "
+        "By default only the kept residues are stored and structures are written with the materialize command.",
+    )
+
+
+def add_search_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--taxon-id", type=str, help="NCBI Taxon ID")
+    parser.add_argument(
         "--reviewed",
-        type=bool,
         action=argparse.BooleanOptionalAction,
         help="Reviewed=swissprot, no-reviewed=trembl. Default is uniprot=swissprot+trembl.",
         default=None,
     )
-    search_parser.add_argument("--subcellular-location-uniprot", type=str, help="Subcellular location (UniProt)")
+    parser.add_argument("--subcellular-location-uniprot", type=str, help="Subcellular location (UniProt)")
+    parser.add_argument("--subcellular-location-go", type=str, help="Subcellular location (GO term, e.g. GO:0005737)")
+    parser.add_argument("--molecular-function-go", type=str, help="Molecular function (GO term, e.g. GO:0003677)")
+    parser.add_argument("--limit", type=int, default=10_000, help="Limit number of results")
+    parser.add_argument(
+        "--go-ontology",
+        type=Path,
+        metavar="FILE",
+        help="Local copy of the Gene Ontology, like go-basic.obo or go-basic.json. "
+        "GO terms are searched as a list of the term and its descendants, which is faster than searching subclasses.",
+    )
+
+
+def add_backend_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--backend",
+        choices=sorted(search_backend_choices),
+        default="sparql",
+        help="How to search UniProt. sparql runs a query for UniProt entries, PDB entries and AlphaFold entries each. "
+        "rest streams all of them from the UniProt REST API in one request, "
+        "for queries that find many entries it is often faster. Default is sparql.",
+    )
+
+
+def backend_arguments_error(args) -> str | None:
+    """Return an error message when options are given that the search backend does not support."""
+    if getattr(args, "backend", None) != "rest":
+        return None
+    unsupported = [
+        option
+        for option, value in (
+            ("--incremental", getattr(args, "incremental", False)),
+            ("--go-ontology", getattr(args, "go_ontology", None)),
+        )
+        if value
+    ]
+    if not unsupported:
+        return None
+    return f"the rest backend does not support {' and '.join(unsupported)}"
+
+
+def add_search_parser(subparsers):
+    search_parser = subparsers.add_parser("search", help="Search UniProt for structures")
+    search_parser.add_argument("session_dir", help="Session directory to store results")
+    add_search_arguments(search_parser)
+    add_backend_argument(search_parser)
     search_parser.add_argument(
-        "--subcellular-location-go", type=str, help="Subcellular location (GO term, e.g. GO:0005737)"
+        "--incremental",
+        action="store_true",
+        help="Only search PDB and AlphaFold cross-references of UniProt entries that are new to the session "
+        "or were refreshed longer than --refresh-after days ago.",
     )
     search_parser.add_argument(
-        "--molecular-function-go", type=str, help="Molecular function (GO term, e.g. GO:0003677)"
+        "--refresh-after",
+        type=float,
+        metavar="DAYS",
+        help="With --incremental, search cross-references again when they were searched this many days ago. "
+        "Default is never.",
     )
-    search_parser.add_argument("--limit", type=int, default=10_000, help="Limit number of results")
+    add_profile_argument(search_parser)
     return search_parser
 
 
-def add_retrieve_parser(subparsers):
-    retrieve_parser = subparsers.add_parser("retrieve", help="Retrieve structures")
-    retrieve_parser.add_argument("session_dir", help="Session directory to store results")
-    retrieve_parser.add_argument(
+def add_plan_parser(subparsers):
+    plan_parser = subparsers.add_parser(
+        "plan",
+        help="Estimate the size of a search and retrieval",
+        description="Count the results of a search and estimate the bytes to retrieve, "
+        "from the sizes of the files of a sample of the search.",
+    )
+    add_search_arguments(plan_parser)
+    plan_parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=10,
+        help="Number of UniProt entries to sample, the sizes of at most this many files per database are requested.",
+    )
+    plan_parser.add_argument(
+        "--max-parallel-downloads", type=int, default=5, help="Maximum number of parallel requests per host."
+    )
+    # A plan has no session to store stage timings in
+    plan_parser.set_defaults(profile=False, profile_output=None)
+    return plan_parser
+
+
+def add_retrieve_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
         "--what",
         type=str,
         action="append",
         choices=sorted(what_retrieve_choices),
         help="What to retrieve. Can be specified multiple times. Default is pdbe and alphafold.",
     )
-    retrieve_parser.add_argument(
+    parser.add_argument(
         "--what-af-formats",
         type=str,
         action="append",
         choices=sorted(downloadable_formats),
         help="AlphaFold formats to retrieve. Can be specified multiple times. Default is 'pdb'.",
     )
+    parser.add_argument(
+        "--max-parallel-downloads",
+        type=int,
+        default=5,
+        help="Maximum number of parallel downloads per host. Starts lower and adapts to how the server responds.",
+    )
+    parser.add_argument(
+        "--pdb-mirror",
+        type=Path,
+        metavar="DIR",
+        help="Directory of a local wwPDB mirror with divided mmCIF files, like DIR/wa/8was.cif.gz. "
+        "Files in the mirror are linked into the session, only missing files are downloaded from PDBe.",
+    )
+    parser.add_argument(
+        "--alphafold-mirror",
+        type=Path,
+        metavar="DIR",
+        help="Directory with AlphaFold files, like DIR/AF-P12345-F1-model_v4.pdb, "
+        "or proteome archives, like DIR/UP000005640_9606_HUMAN_v4.tar. "
+        "Files in the directory are linked and files in archives are extracted into the session, "
+        "only missing entries are downloaded from AlphaFold. Linked entries have no summary.",
+    )
+
+
+def add_retrieve_parser(subparsers):
+    retrieve_parser = subparsers.add_parser("retrieve", help="Retrieve structures")
+    retrieve_parser.add_argument("session_dir", help="Session directory to store results")
+    add_retrieve_arguments(retrieve_parser)
+    add_shard_argument(retrieve_parser)
+    add_profile_argument(retrieve_parser)
     return retrieve_parser
 
 
-def add_density_filter_parser(subparsers):
-    density_filter_parser = subparsers.add_parser(
-        "density-filter", help="Filter AlphaFoldDB structures based on density confidence"
-    )
-    density_filter_parser.add_argument("session_dir", help="Session directory for input and output")
-    density_filter_parser.add_argument(
-        "--confidence-threshold", type=float, default=70.0, help="pLDDT confidence threshold (0-100)"
-    )
-    density_filter_parser.add_argument(
+def add_density_filter_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--confidence-threshold", type=float, default=70.0, help="pLDDT confidence threshold (0-100)")
+    parser.add_argument(
         "--min-residues", type=int, default=0, help="Minimum number of residues above confidence threshold"
     )
-    density_filter_parser.add_argument(
+    parser.add_argument(
         "--max-residues",
         type=int,
         default=1_000_000,
         help="Maximum number of residues above confidence threshold.",
     )
+
+
+def add_density_filter_parser(subparsers):
+    density_filter_parser = subparsers.add_parser(
+        "density-filter", help="Filter AlphaFoldDB structures based on density confidence"
+    )
+    density_filter_parser.add_argument("session_dir", help="Session directory for input and output")
+    add_density_filter_arguments(density_filter_parser)
+    add_eager_argument(density_filter_parser)
+    add_packed_argument(density_filter_parser)
+    add_shard_argument(density_filter_parser)
+    add_profile_argument(density_filter_parser)
     return density_filter_parser
 
 
@@ -82,31 +232,260 @@ def add_prune_pdbs_parser(subparsers):
         "prune-pdbs", help="Prune PDBe files to keep only the first chain and rename it to A"
     )
     prune_pdbs_parser.add_argument("session_dir", help="Session directory containing PDB files")
+    add_packed_argument(prune_pdbs_parser)
+    add_shard_argument(prune_pdbs_parser)
+    add_profile_argument(prune_pdbs_parser)
     return prune_pdbs_parser
 
 
-def handle_search(args):
-    query = Query(
+def add_run_parser(subparsers):
+    run_parser = subparsers.add_parser(
+        "run",
+        help="Search, retrieve, density filter and prune in one go, "
+        "filtering or pruning each structure as soon as it is downloaded",
+    )
+    run_parser.add_argument("session_dir", help="Session directory to store results")
+    run_parser.add_argument(
+        "--skip-search",
+        action="store_true",
+        help="Use the structures already found in the session instead of searching UniProt.",
+    )
+    add_search_arguments(run_parser)
+    add_backend_argument(run_parser)
+    add_retrieve_arguments(run_parser)
+    add_density_filter_arguments(run_parser)
+    add_eager_argument(run_parser)
+    run_parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes for density filtering and pruning. Default is number of CPUs.",
+    )
+    run_parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=100,
+        help="Maximum number of downloaded structures waiting to be density filtered or pruned. "
+        "Downloading pauses when the queue is full.",
+    )
+    add_profile_argument(run_parser)
+    return run_parser
+
+
+def add_pack_parser(subparsers):
+    pack_parser = subparsers.add_parser(
+        "pack", help="Move structure files of a session into a few large pack files, to save inodes"
+    )
+    pack_parser.add_argument("session_dir", help="Session directory with structure files")
+    add_profile_argument(pack_parser)
+    return pack_parser
+
+
+def add_materialize_parser(subparsers):
+    materialize_parser = subparsers.add_parser(
+        "materialize",
+        help="Write packed files and density filtered structures of a session as files, for tools that need files",
+    )
+    materialize_parser.add_argument("session_dir", help="Session directory with packed or density filtered files")
+    materialize_parser.add_argument(
+        "paths",
+        nargs="*",
+        type=Path,
+        help="Session relative paths of files or directories to write, like density_filtered. Default is all.",
+    )
+    materialize_parser.add_argument(
+        "--output-dir",
+        type=Path,
+        help="Directory to write files to, under their session relative path. Default is the session directory.",
+    )
+    add_profile_argument(materialize_parser)
+    return materialize_parser
+
+
+def add_merge_shards_parser(subparsers):
+    merge_shards_parser = subparsers.add_parser(
+        "merge-shards",
+        help="Merge results of shards into the session and remove the merged shard files. Safe to run more than once.",
+    )
+    merge_shards_parser.add_argument("session_dir", help="Session directory with shards directory")
+    add_profile_argument(merge_shards_parser)
+    return merge_shards_parser
+
+
+def add_export_parser(subparsers):
+    export_parser = subparsers.add_parser(
+        "export", help="Export session results to Parquet files with a manifest, for jobs on other nodes"
+    )
+    export_parser.add_argument("session_dir", help="Session directory to export")
+    export_parser.add_argument("export_dir", type=Path, help="Empty directory to write Parquet files and manifest to")
+    export_parser.add_argument(
+        "--compression",
+        type=str,
+        default="zstd",
+        choices=["gzip", "snappy", "uncompressed", "zstd"],
+        help="Parquet compression codec. Default is zstd.",
+    )
+    add_profile_argument(export_parser)
+    return export_parser
+
+
+def add_import_parser(subparsers):
+    import_parser = subparsers.add_parser("import", help="Import session results from an export directory")
+    import_parser.add_argument("export_dir", type=Path, help="Directory with Parquet files and manifest")
+    import_parser.add_argument("session_dir", help="Session directory to import into")
+    add_profile_argument(import_parser)
+    return import_parser
+
+
+def add_query_parser(subparsers):
+    query_parser = subparsers.add_parser(
+        "query",
+        help="Query many sessions at once with SQL",
+        description="Query many sessions at once with SQL. "
+        "Each session table is available as a view with an extra session_dir column.",
+    )
+    query_parser.add_argument("session_dirs", nargs="+", help="Session directories to query")
+    query_parser.add_argument(
+        "--sql",
+        type=str,
+        default="shared-pdbs",
+        help="SQL query or name of a preset query: shared-pdbs (PDB entries found in more than one session) "
+        "or density-filtered (density filter results of all sessions). Default is shared-pdbs.",
+    )
+    query_parser.add_argument(
+        "--output",
+        type=Path,
+        help="File to write result to, Parquet if it ends with .parquet otherwise CSV. Default is to print result.",
+    )
+    # Stage timings are stored per session, so can not be stored for many sessions
+    query_parser.set_defaults(profile=False, profile_output=None)
+    return query_parser
+
+
+def add_serve_parser(subparsers):
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run a server that accepts jobs over HTTP, keeping HTTP connections and worker processes warm",
+    )
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    serve_parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    serve_parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes for density-filter and prune-pdbs jobs. Default is number of CPUs.",
+    )
+    serve_parser.add_argument(
+        "--max-parallel-downloads",
+        type=int,
+        default=5,
+        help="Maximum number of parallel downloads per host, shared by all retrieve jobs.",
+    )
+    # A server has no single session to store stage timings in
+    serve_parser.set_defaults(profile=False, profile_output=None)
+    return serve_parser
+
+
+def parse_query(args):
+    from protein_detective.uniprot import Query  # noqa: PLC0415
+
+    return Query(
         taxon_id=args.taxon_id,
         reviewed=args.reviewed,
         subcellular_location_uniprot=args.subcellular_location_uniprot,
         subcellular_location_go=args.subcellular_location_go,
         molecular_function_go=args.molecular_function_go,
     )
+
+
+def parse_density_query(args):
+    from protein_detective.alphafold.density import DensityFilterQuery  # noqa: PLC0415
+
+    return DensityFilterQuery(
+        confidence=args.confidence_threshold,
+        min_threshold=args.min_residues,
+        max_threshold=args.max_residues,
+    )
+
+
+def handle_search(args):
+    from protein_detective.workflow import search_structures_in_uniprot  # noqa: PLC0415
+
+    query = parse_query(args)
     session_dir = Path(args.session_dir)
-    nr_uniprot, nr_pdbes, nr_afs = search_structures_in_uniprot(query, session_dir, limit=args.limit)
+    nr_uniprot, nr_pdbes, nr_afs = search_structures_in_uniprot(
+        query,
+        session_dir,
+        limit=args.limit,
+        incremental=args.incremental,
+        refresh_after=None if args.refresh_after is None else timedelta(days=args.refresh_after),
+        go_ontology=args.go_ontology,
+        backend=args.backend,
+    )
     print(
         f"Search completed: {nr_uniprot} UniProt entries found, "
         f"{nr_pdbes} PDBe structures, {nr_afs} AlphaFold structures."
     )
 
 
+def format_bytes(nbytes: int | None) -> str:
+    if nbytes is None:
+        return "unknown"
+    size = float(nbytes)
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1000 or unit == "TB":
+            break
+        size /= 1000
+    return f"{size:.1f} {unit}"
+
+
+def handle_plan(args):
+    from rich.table import Table  # noqa: PLC0415
+
+    from protein_detective.plan import plan_search  # noqa: PLC0415
+
+    plan = plan_search(
+        parse_query(args),
+        limit=args.limit,
+        sample_size=args.sample_size,
+        max_parallel_downloads=args.max_parallel_downloads,
+        go_ontology=args.go_ontology,
+    )
+    counts = plan.counts
+    table = Table(title="Expected size of search and retrieve")
+    for column in ("Database", "Rows", "Files", "Bytes"):
+        table.add_column(column, justify="left" if column == "Database" else "right")
+    table.add_row("UniProt", str(counts.nr_uniprot), "", "")
+    table.add_row("PDBe", str(counts.nr_pdb_rows), str(counts.nr_pdbs), format_bytes(plan.pdb_bytes))
+    table.add_row("AlphaFold", str(counts.nr_alphafolds), str(counts.nr_alphafolds), format_bytes(plan.alphafold_bytes))
+    print(table)
+    if plan.truncated:
+        print(
+            f"The {', '.join(plan.truncated)} queries find more results than the limit of {plan.limit}, "
+            "increase --limit to find all. Bytes are for the limited number of files."
+        )
+
+
+def parse_shard(args):
+    if args.shard is None:
+        return None
+    from protein_detective.shards import Shard  # noqa: PLC0415
+
+    return Shard.parse(args.shard)
+
+
 def handle_retrieve(args):
+    from protein_detective.workflow import retrieve_structures  # noqa: PLC0415
+
     session_dir = Path(args.session_dir)
     download_dir, nr_pdbes, nr_afs = retrieve_structures(
         session_dir,
         what=set(args.what) if args.what else None,
         what_af_formats=set(args.what_af_formats) if args.what_af_formats else None,
+        max_parallel_downloads=args.max_parallel_downloads,
+        shard=parse_shard(args),
+        pdb_mirror=args.pdb_mirror,
+        alphafold_mirror=args.alphafold_mirror,
     )
     print(
         "Structures retrieved successfully: "
@@ -115,30 +494,173 @@ def handle_retrieve(args):
 
 
 def handle_density_filter(args):
-    query = DensityFilterQuery(
-        confidence=args.confidence_threshold,
-        min_threshold=args.min_residues,
-        max_threshold=args.max_residues,
-    )
+    from protein_detective.workflow import density_filter  # noqa: PLC0415
+
+    query = parse_density_query(args)
     session_dir = Path(args.session_dir)
-    result = density_filter(session_dir, query)
-    print(f"Filtered {result.nr_kept} structures, written to {result.density_filtered_dir} directory.")
+    result = density_filter(session_dir, query, shard=parse_shard(args), packed=args.packed, eager=args.eager)
+    if args.eager:
+        print(f"Filtered {result.nr_kept} structures, written to {result.density_filtered_dir} directory.")
+    else:
+        print(
+            f"Filtered {result.nr_kept} structures, "
+            f"use the materialize command to write them to {result.density_filtered_dir} directory."
+        )
     print(f"Discarded {result.nr_discarded} structures based on density confidence.")
+    if result.nr_unchanged:
+        print(f"Reused results of {result.nr_unchanged} structures that did not change since the previous run.")
 
 
 def handle_prune_pdbs(args):
+    from protein_detective.workflow import prune_pdbs  # noqa: PLC0415
+
     session_dir = Path(args.session_dir)
-    single_chain_dir, nr_files = prune_pdbs(session_dir)
+    single_chain_dir, nr_files = prune_pdbs(session_dir, shard=parse_shard(args), packed=args.packed)
     print(f"Written {nr_files} PDB files to {single_chain_dir} directory.")
 
 
+def handle_run(args):
+    from protein_detective.pipeline import run_pipeline  # noqa: PLC0415
+    from protein_detective.workflow import density_filtered_dir_of  # noqa: PLC0415
+
+    session_dir = Path(args.session_dir)
+    density_query = parse_density_query(args)
+    result = run_pipeline(
+        session_dir,
+        density_query,
+        query=None if args.skip_search else parse_query(args),
+        limit=args.limit,
+        what=set(args.what) if args.what else None,
+        what_af_formats=set(args.what_af_formats) if args.what_af_formats else None,
+        max_parallel_downloads=args.max_parallel_downloads,
+        max_workers=args.workers,
+        queue_size=args.queue_size,
+        pdb_mirror=args.pdb_mirror,
+        alphafold_mirror=args.alphafold_mirror,
+        eager=args.eager,
+        go_ontology=args.go_ontology,
+        search_backend=args.backend,
+    )
+    print(
+        f"Retrieved {result.nr_mmcif_files} PDBe structures and {result.nr_afs} AlphaFold structures "
+        f"to {session_dir / 'downloads'} directory."
+    )
+    print(f"Written {result.nr_single_chain_files} PDB files to {session_dir / 'single_chain'} directory.")
+    written = "written to" if args.eager else "use the materialize command to write them to"
+    density_filtered_dir = density_filtered_dir_of(session_dir, density_query)
+    print(
+        f"Filtered {result.nr_kept} structures, {written} {density_filtered_dir} directory. "
+        f"Discarded {result.nr_discarded} structures based on density confidence."
+    )
+    if result.nr_unchanged:
+        print(f"Reused results of {result.nr_unchanged} structures that did not change since the previous run.")
+
+
+def handle_pack(args):
+    from protein_detective.workflow import pack_session  # noqa: PLC0415
+
+    nr_files = pack_session(Path(args.session_dir))
+    print(f"Packed {nr_files} files into {Path(args.session_dir) / 'packed'} directory.")
+
+
+def handle_materialize(args):
+    from protein_detective.workflow import materialize  # noqa: PLC0415
+
+    written = materialize(Path(args.session_dir), args.paths, args.output_dir)
+    print(f"Written {len(written)} files to {args.output_dir or args.session_dir} directory.")
+
+
+def handle_merge_shards(args):
+    from protein_detective.shards import merge_shards  # noqa: PLC0415
+
+    merged = merge_shards(Path(args.session_dir))
+    for kind, nr_files in merged.items():
+        print(f"Merged {nr_files} {kind} shard files.")
+
+
+def handle_export(args):
+    from protein_detective.export import export_session  # noqa: PLC0415
+
+    manifest = export_session(Path(args.session_dir), args.export_dir, compression=args.compression)
+    nr_rows = sum(table.rows for table in manifest.tables.values())
+    print(
+        f"Exported {nr_rows} rows of {len(manifest.tables)} tables to {args.export_dir}, "
+        f"referring to {len(manifest.structure_files)} structure files."
+    )
+
+
+def handle_import(args):
+    from protein_detective.export import import_session  # noqa: PLC0415
+
+    rows = import_session(args.export_dir, Path(args.session_dir))
+    print(f"Imported {sum(rows.values())} rows of {len(rows)} tables into {args.session_dir}.")
+
+
+def handle_query(args):
+    from protein_detective.sessions import query_sessions  # noqa: PLC0415
+
+    query_sessions([Path(session_dir) for session_dir in args.session_dirs], args.sql, args.output)
+    if args.output:
+        print(f"Query result written to {args.output}")
+
+
+def handle_serve(args):
+    from protein_detective.server import serve  # noqa: PLC0415
+
+    serve(
+        host=args.host,
+        port=args.port,
+        max_workers=args.workers,
+        max_parallel_downloads=args.max_parallel_downloads,
+    )
+
+
+def report_profile(command: str, session_dir: Path | None):
+    from rich.table import Table  # noqa: PLC0415
+
+    from protein_detective.db import connect, save_stage_timings  # noqa: PLC0415
+
+    stages = instrumentation.stages
+    table = Table(title=f"Time spent per stage of {command}")
+    for column in ("Stage", "Calls", "Items", "Bytes", "Retries", "Total (s)", "Wall (s)", "Items/s"):
+        if column == "Stage":
+            table.add_column(column, no_wrap=True)
+        else:
+            table.add_column(column, justify="right")
+    for name, stats in sorted(stages.items(), key=lambda item: item[1].wall_seconds, reverse=True):
+        table.add_row(
+            name,
+            str(stats.calls),
+            str(stats.items),
+            str(stats.bytes),
+            str(stats.retries),
+            f"{stats.total_seconds:.3f}",
+            f"{stats.wall_seconds:.3f}",
+            f"{stats.items_per_second:.1f}" if stats.items_per_second is not None else "",
+        )
+    print(table)
+    if session_dir is None:
+        return
+    with connect(session_dir) as con:
+        save_stage_timings(command, stages, con)
+
+
 def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Protein Detective CLI", prog="protein-detective")
     subparsers = parser.add_subparsers(dest="command", required=True)
     add_search_parser(subparsers)
+    add_plan_parser(subparsers)
     add_retrieve_parser(subparsers)
     add_density_filter_parser(subparsers)
     add_prune_pdbs_parser(subparsers)
+    add_run_parser(subparsers)
+    add_pack_parser(subparsers)
+    add_materialize_parser(subparsers)
+    add_merge_shards_parser(subparsers)
+    add_export_parser(subparsers)
+    add_import_parser(subparsers)
+    add_query_parser(subparsers)
+    add_serve_parser(subparsers)
     return parser
 
 
@@ -146,15 +668,40 @@ def main():
     parser = make_parser()
 
     args = parser.parse_args()
+    if error := backend_arguments_error(args):
+        parser.error(error)
+
+    if args.profile:
+        instrumentation.enable()
+
+    handlers = {
+        "search": handle_search,
+        "plan": handle_plan,
+        "retrieve": handle_retrieve,
+        "density-filter": handle_density_filter,
+        "prune-pdbs": handle_prune_pdbs,
+        "run": handle_run,
+        "pack": handle_pack,
+        "materialize": handle_materialize,
+        "merge-shards": handle_merge_shards,
+        "export": handle_export,
+        "import": handle_import,
+        "query": handle_query,
+        "serve": handle_serve,
+    }
+    handler = handlers[args.command]
+    with instrumentation.measure(f"cli.{args.command}"):
+        if args.profile_output:
+            with write_profile(args.profile_output, args.command) as profile_file:
+                handler(args)
+            print(f"Profile written to {profile_file}")
+        else:
+            handler(args)
 
-    if args.command == "search":
-        handle_search(args)
-    elif args.command == "retrieve":
-        handle_retrieve(args)
-    elif args.command == "density-filter":
-        handle_density_filter(args)
-    elif args.command == "prune-pdbs":
-        handle_prune_pdbs(args)
+    if args.profile:
+        # Shards read the session database while other shards run, so can not store timings in it
+        sharded = getattr(args, "shard", None) is not None
+        report_profile(args.command, None if sharded else Path(args.session_dir))
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 from collections.abc import Iterable, Mapping
 from contextlib import contextmanager
+from datetime import timedelta
 from pathlib import Path
 
 from cattrs import unstructure
@@ -8,8 +9,10 @@ from duckdb import DuckDBPyConnection
 from duckdb import connect as duckdb_connect
 
 from protein_detective.alphafold import AlphaFoldEntry
-from protein_detective.alphafold.density import DensityFilterQuery, DensityFilterResult
+from protein_detective.alphafold.density import DensityFilteredRow, DensityFilterQuery, DensityFilterResult
 from protein_detective.alphafold.entry_summary import EntrySummary
+from protein_detective.instrumentation import StageStats, timed
+from protein_detective.packed import PackedFile
 from protein_detective.pdbe.io import ProteinPdbRow, SingleChainResult
 from protein_detective.uniprot import PdbResult, Query
 
@@ -77,6 +80,78 @@ CREATE TABLE IF NOT EXISTS density_filtered_alphafolds (
 );
 """
 
+stage_timings_ddl = """\
+CREATE TABLE IF NOT EXISTS stage_timings (
+    command TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    calls INTEGER NOT NULL,
+    items INTEGER NOT NULL,
+    bytes BIGINT NOT NULL,
+    retries INTEGER NOT NULL,
+    total_seconds DOUBLE NOT NULL,
+    wall_seconds DOUBLE NOT NULL,
+    items_per_second DOUBLE,
+    recorded_at TIMESTAMPTZ NOT NULL DEFAULT current_timestamp,
+);
+"""
+
+packed_files_ddl = """\
+CREATE TABLE packed_files (
+    path TEXT PRIMARY KEY,
+    pack TEXT NOT NULL,
+    pack_offset BIGINT NOT NULL,
+    size BIGINT NOT NULL,
+);
+"""
+
+kept_residues_ddl = """\
+ALTER TABLE density_filtered_alphafolds ADD COLUMN kept_residues TEXT;
+"""
+
+fingerprints_ddl = """\
+ALTER TABLE density_filtered_alphafolds ADD COLUMN input_fingerprint TEXT;
+
+CREATE TABLE output_fingerprints (
+    path TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+);
+"""
+
+refreshed_at_ddl = """\
+ALTER TABLE proteins ADD COLUMN refreshed_at TIMESTAMPTZ;
+"""
+
+migrations = [ddl, stage_timings_ddl, packed_files_ddl, kept_residues_ddl, fingerprints_ddl, refreshed_at_ddl]
+"""Migrations of the session database schema, index + 1 is the schema version it migrates to.
+
+Only append to this list, a released migration must never change.
+To add a column use `ALTER TABLE ... ADD COLUMN`, so sessions made by older versions can be migrated.
+Sessions made before schema versioning have no schema_migrations table,
+so the first migrations use `IF NOT EXISTS` and are safe to run on them.
+"""
+
+schema_version = len(migrations)
+"""Schema version of the session database that this version of protein-detective uses."""
+
+schema_migrations_ddl = """\
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    migrated_at TIMESTAMPTZ NOT NULL DEFAULT current_timestamp,
+);
+"""
+
+
+def quote_literal(value: str) -> str:
+    """Quote a string as a SQL string literal, for statements that do not support parameters like ATTACH and COPY.
+
+    Args:
+        value: The string to quote.
+
+    Returns:
+        The quoted string.
+    """
+    return "'" + value.replace("'", "''") + "'"
+
 
 def db_path(session_dir: Path) -> Path:
     """Return the path to the DuckDB database file in the given session directory.
@@ -90,20 +165,103 @@ def db_path(session_dir: Path) -> Path:
     return session_dir / "session.db"
 
 
+def current_schema_version(con: DuckDBPyConnection) -> int:
+    """Return the schema version of the database.
+
+    Args:
+        con: The DuckDB connection to check.
+
+    Returns:
+        The schema version, or 0 if the database has not been migrated yet.
+    """
+    has_table = con.execute(
+        "SELECT count(*) FROM duckdb_tables() WHERE table_name = 'schema_migrations'",
+    ).fetchone()
+    if has_table is None or has_table[0] == 0:
+        return 0
+    result = con.execute("SELECT max(version) FROM schema_migrations").fetchone()
+    if result is None or result[0] is None:
+        return 0
+    return result[0]
+
+
+def migrate(con: DuckDBPyConnection) -> int:
+    """Migrate the database schema to the latest version.
+
+    When the database is already at the latest version, this is a single cheap query.
+
+    Args:
+        con: The DuckDB connection to migrate.
+
+    Returns:
+        The number of migrations that were applied.
+
+    Raises:
+        ValueError: If the database was made by a newer version of protein-detective.
+    """
+    version = current_schema_version(con)
+    if version == schema_version:
+        return 0
+    if version > schema_version:
+        msg = (
+            f"Session database has schema version {version}, "
+            f"but this version of protein-detective only supports up to {schema_version}. "
+            "Please upgrade protein-detective."
+        )
+        raise ValueError(msg)
+    con.begin()
+    try:
+        con.execute(schema_migrations_ddl)
+        for index, migration in enumerate(migrations[version:], start=version + 1):
+            con.execute(migration)
+            con.execute("INSERT INTO schema_migrations (version) VALUES (?)", (index,))
+    except Exception:
+        con.rollback()
+        raise
+    con.commit()
+    return schema_version - version
+
+
 @contextmanager
-def connect(session_dir: Path):
-    # wrapper around duckdb.connect to create tables on connect
+def connect(session_dir: Path, read_only: bool = False):
+    """Connect to the session database, creating or migrating its tables when needed.
+
+    Open one connection per workflow step and pass it around,
+    instead of connecting for every load or save.
+
+    Args:
+        session_dir: The directory where the session data is stored.
+        read_only: Open the database read-only, so many processes can read it at the same time.
+            A read-only database can not be migrated, so it must already be at the latest schema version.
+
+    Yields:
+        The DuckDB connection.
+
+    Raises:
+        ValueError: If a read-only database is not at the latest schema version.
+    """
     database = db_path(session_dir)
-    con = duckdb_connect(database)
-    con.sql(ddl)
-    yield con
-    con.close()
+    con = duckdb_connect(database, read_only=read_only)
+    try:
+        if not read_only:
+            migrate(con)
+        elif (version := current_schema_version(con)) != schema_version:
+            msg = (
+                f"Session database has schema version {version}, but {schema_version} is needed. "
+                "Open the session once without read-only to migrate it."
+            )
+            raise ValueError(msg)
+        yield con
+    finally:
+        con.close()
 
 
+@timed
 def save_query(query: Query, con: DuckDBPyConnection):
     con.execute("INSERT INTO uniprot_searches (query) VALUES (?)", (unstructure(query),))
 
 
+@timed
 def save_uniprot_accessions(uniprot_accessions: Iterable[str], con: DuckDBPyConnection):
     rows = [(uniprot_acc,) for uniprot_acc in uniprot_accessions]
     if len(rows) == 0:
@@ -114,6 +272,43 @@ def save_uniprot_accessions(uniprot_accessions: Iterable[str], con: DuckDBPyConn
     )
 
 
+def save_refreshed(uniprot_accessions: Iterable[str], con: DuckDBPyConnection):
+    """Record that the cross-references of UniProt accessions were searched just now.
+
+    Args:
+        uniprot_accessions: The UniProt accessions, which must already be saved.
+        con: The DuckDB connection to use for saving the data.
+    """
+    accessions = list(uniprot_accessions)
+    if len(accessions) == 0:
+        return
+    con.execute(
+        "UPDATE proteins SET refreshed_at = current_timestamp WHERE uniprot_acc IN (SELECT unnest(?))",
+        (accessions,),
+    )
+
+
+def load_fresh_uniprot_accessions(con: DuckDBPyConnection, max_age: timedelta | None = None) -> set[str]:
+    """Load the UniProt accessions whose cross-references were searched recently.
+
+    Args:
+        con: The DuckDB connection to use for fetching the data.
+        max_age: How long ago the cross-references may have been searched. If None, any time ago is recent.
+
+    Returns:
+        The UniProt accessions. Accessions saved before refresh times were recorded are never fresh.
+    """
+    max_age_seconds = None if max_age is None else max_age.total_seconds()
+    rows = con.execute(
+        """SELECT uniprot_acc FROM proteins
+        WHERE refreshed_at IS NOT NULL
+            AND ($max_age IS NULL OR refreshed_at >= current_timestamp - to_seconds($max_age::DOUBLE))""",
+        {"max_age": max_age_seconds},
+    ).fetchall()
+    return {row[0] for row in rows}
+
+
+@timed
 def save_pdbs(
     uniprot2pdbs: Mapping[str, Iterable[PdbResult]],
     con: DuckDBPyConnection,
@@ -138,6 +333,7 @@ def save_pdbs(
     )
 
 
+@timed
 def save_pdb_files(mmcif_files: Mapping[str, Path], con: DuckDBPyConnection):
     """Save PDB files to the database.
 
@@ -186,6 +382,7 @@ def load_pdbs(con: DuckDBPyConnection) -> list[ProteinPdbRow]:
     ]
 
 
+@timed
 def save_alphafolds(afs: dict[str, set[str]], con: DuckDBPyConnection):
     rows = []
     for af_ids_of_uniprot in afs.values():
@@ -200,10 +397,33 @@ def save_alphafolds(afs: dict[str, set[str]], con: DuckDBPyConnection):
     save_uniprot_accessions(afs.keys(), con)
 
 
-def save_alphafolds_files(afs: list[AlphaFoldEntry], con: DuckDBPyConnection):
-    rows = [
+alphafolds_files_columns = (
+    "summary",
+    "bcif_file",
+    "cif_file",
+    "pdb_file",
+    "pae_image_file",
+    "pae_doc_file",
+    "am_annotations_file",
+    "am_annotations_hg19_file",
+    "am_annotations_hg38_file",
+    "uniprot_acc",
+)
+"""Columns of the alphafolds table in the order of the rows of `alphafolds_files_rows`."""
+
+
+def alphafolds_files_rows(afs: list[AlphaFoldEntry]) -> list[tuple]:
+    """Convert AlphaFold entries to rows with the columns of `alphafolds_files_columns`.
+
+    Args:
+        afs: The AlphaFold entries.
+
+    Returns:
+        A list of rows.
+    """
+    return [
         (
-            converter.dumps(af.summary, EntrySummary),
+            converter.dumps(af.summary, EntrySummary) if af.summary else None,
             str(af.bcif_file) if af.bcif_file else None,
             str(af.cif_file) if af.cif_file else None,
             str(af.pdb_file) if af.pdb_file else None,
@@ -216,6 +436,11 @@ def save_alphafolds_files(afs: list[AlphaFoldEntry], con: DuckDBPyConnection):
         )
         for af in afs
     ]
+
+
+@timed
+def save_alphafolds_files(afs: list[AlphaFoldEntry], con: DuckDBPyConnection):
+    rows = alphafolds_files_rows(afs)
     if len(rows) == 0:
         # executemany can not be called with an empty list, it raises error, so we return early
         return
@@ -264,7 +489,7 @@ def load_alphafolds(con: DuckDBPyConnection) -> list[AlphaFoldEntry]:
     return [
         AlphaFoldEntry(
             uniprot_acc=row[0],
-            summary=converter.loads(row[1], EntrySummary) if row[0] else None,
+            summary=converter.loads(row[1], EntrySummary) if row[1] else None,
             bcif_file=Path(row[2]) if row[2] else None,
             cif_file=Path(row[3]) if row[3] else None,
             pdb_file=Path(row[4]) if row[4] else None,
@@ -278,6 +503,7 @@ def load_alphafolds(con: DuckDBPyConnection) -> list[AlphaFoldEntry]:
     ]
 
 
+@timed
 def save_single_chain_pdb_files(files: list[SingleChainResult], con: DuckDBPyConnection):
     if len(files) == 0:
         return
@@ -285,8 +511,13 @@ def save_single_chain_pdb_files(files: list[SingleChainResult], con: DuckDBPyCon
         "UPDATE proteins_pdbs SET single_chain_pdb_file = ? WHERE uniprot_acc = ? AND pdb_id = ?",
         [(str(file.output_file), file.uniprot_acc, file.pdb_id) for file in files],
     )
+    save_output_fingerprints(
+        {file.output_file: file.fingerprint for file in files if file.fingerprint is not None},
+        con,
+    )
 
 
+@timed
 def save_density_filtered(
     query: DensityFilterQuery,
     files: list[DensityFilterResult],
@@ -321,11 +552,186 @@ def save_density_filtered(
                 file.count,
                 file.density_filtered_file is not None,
                 str(file.density_filtered_file) if file.density_filtered_file else None,
+                file.kept_residues,
+                file.input_fingerprint,
             )
         )
+    # Replace, as results are saved again when their input changed
     con.executemany(
-        """INSERT OR IGNORE INTO density_filtered_alphafolds
-        (density_filter_id, uniprot_acc, nr_residues_above_confidence, keep, pdb_file)
-        VALUES (?, ?, ?, ?, ?)""",
+        """INSERT OR REPLACE INTO density_filtered_alphafolds
+        (density_filter_id, uniprot_acc, nr_residues_above_confidence, keep, pdb_file, kept_residues, input_fingerprint)
+        VALUES (?, ?, ?, ?, ?, ?, ?)""",
         values,
     )
+    save_output_fingerprints(
+        {
+            file.density_filtered_file: file.output_fingerprint
+            for file in files
+            if file.density_filtered_file is not None and file.output_fingerprint is not None
+        },
+        con,
+    )
+
+
+def load_density_filter_results(query: DensityFilterQuery, con: DuckDBPyConnection) -> dict[str, DensityFilterResult]:
+    """Load the saved results of a density filter.
+
+    Args:
+        query: The density filter query.
+        con: The DuckDB connection to use for fetching the data.
+
+    Returns:
+        The results by UniProt accession. Empty if the density filter was never run.
+    """
+    rows = con.execute(
+        """SELECT d.uniprot_acc, a.pdb_file, d.nr_residues_above_confidence, d.pdb_file, d.kept_residues,
+            d.input_fingerprint
+        FROM density_filtered_alphafolds AS d
+        JOIN density_filters AS df USING (density_filter_id)
+        JOIN alphafolds AS a USING (uniprot_acc)
+        WHERE df.confidence = ? AND df.min_threshold = ? AND df.max_threshold = ?""",
+        (query.confidence, query.min_threshold, query.max_threshold),
+    ).fetchall()
+    return {
+        row[0]: DensityFilterResult(
+            pdb_file=Path(row[1]).name if row[1] else "",
+            count=row[2],
+            density_filtered_file=Path(row[3]) if row[3] else None,
+            kept_residues=row[4],
+            input_fingerprint=row[5],
+        )
+        for row in rows
+    }
+
+
+def load_density_filtered(con: DuckDBPyConnection) -> list[DensityFilteredRow]:
+    """Load the structures that passed a density filter and know which residues they keep.
+
+    Rows saved before the kept residues were stored are left out,
+    their density filtered files were written when filtering.
+
+    Args:
+        con: The DuckDB connection to use for fetching the data.
+
+    Returns:
+        The kept structures, ordered by density filter.
+    """
+    rows = con.execute(
+        """SELECT d.uniprot_acc, a.pdb_file, d.pdb_file, d.kept_residues, df.confidence
+        FROM density_filtered_alphafolds AS d
+        JOIN density_filters AS df USING (density_filter_id)
+        JOIN alphafolds AS a USING (uniprot_acc)
+        WHERE d.keep AND d.kept_residues IS NOT NULL AND a.pdb_file IS NOT NULL
+        ORDER BY d.density_filter_id, d.uniprot_acc"""
+    ).fetchall()
+    return [
+        DensityFilteredRow(
+            uniprot_acc=row[0],
+            pdb_file=Path(row[1]),
+            density_filtered_file=Path(row[2]),
+            kept_residues=row[3],
+            confidence=row[4],
+        )
+        for row in rows
+    ]
+
+
+def save_stage_timings(command: str, stages: Mapping[str, StageStats], con: DuckDBPyConnection):
+    """Save the per stage timings of a command to the database.
+
+    Args:
+        command: The command that was run, for example "retrieve".
+        stages: The stats per stage name.
+        con: The DuckDB connection to use for saving the data.
+    """
+    rows = [
+        (
+            command,
+            name,
+            stats.calls,
+            stats.items,
+            stats.bytes,
+            stats.retries,
+            stats.total_seconds,
+            stats.wall_seconds,
+            stats.items_per_second,
+        )
+        for name, stats in stages.items()
+    ]
+    if len(rows) == 0:
+        return
+    con.executemany(
+        """INSERT INTO stage_timings
+        (command, stage, calls, items, bytes, retries, total_seconds, wall_seconds, items_per_second)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        rows,
+    )
+
+
+def save_packed_files(files: list[PackedFile], con: DuckDBPyConnection):
+    """Save the location of packed files to the database.
+
+    Args:
+        files: The packed files.
+        con: The DuckDB connection to use for saving the data.
+    """
+    if len(files) == 0:
+        return
+    con.executemany(
+        "INSERT OR REPLACE INTO packed_files (path, pack, pack_offset, size) VALUES (?, ?, ?, ?)",
+        [(str(file.path), str(file.pack), file.offset, file.size) for file in files],
+    )
+
+
+def delete_packed_files(paths: Iterable[Path], con: DuckDBPyConnection):
+    """Forget the location of packed files, so they are read from disk again.
+
+    Args:
+        paths: Session relative paths of the files.
+        con: The DuckDB connection to use for deleting the data.
+    """
+    rows = [(str(path),) for path in paths]
+    if len(rows) == 0:
+        return
+    con.executemany("DELETE FROM packed_files WHERE path = ?", rows)
+
+
+def load_packed_files(con: DuckDBPyConnection) -> list[PackedFile]:
+    """Load the location of packed files from the database.
+
+    Args:
+        con: The DuckDB connection to use for fetching the data.
+
+    Returns:
+        The packed files.
+    """
+    rows = con.execute("SELECT path, pack, pack_offset, size FROM packed_files").fetchall()
+    return [PackedFile(path=Path(row[0]), pack=Path(row[1]), offset=row[2], size=row[3]) for row in rows]
+
+
+def save_output_fingerprints(fingerprints: Mapping[Path, str], con: DuckDBPyConnection):
+    """Save the fingerprints of written output files to the database.
+
+    Args:
+        fingerprints: The fingerprints by path of the file, relative to the session directory.
+        con: The DuckDB connection to use for saving the data.
+    """
+    if len(fingerprints) == 0:
+        return
+    con.executemany(
+        "INSERT OR REPLACE INTO output_fingerprints (path, fingerprint) VALUES (?, ?)",
+        [(str(path), fingerprint) for path, fingerprint in fingerprints.items()],
+    )
+
+
+def load_output_fingerprints(con: DuckDBPyConnection) -> dict[Path, str]:
+    """Load the fingerprints of written output files from the database.
+
+    Args:
+        con: The DuckDB connection to use for fetching the data.
+
+    Returns:
+        The fingerprints by path of the file, relative to the session directory.
+    """
+    rows = con.execute("SELECT path, fingerprint FROM output_fingerprints").fetchall()
+    return {Path(row[0]): row[1] for row in rows}
@@ -0,0 +1,264 @@
+"""Export session results to Parquet and import them back.
+
+An export directory contains a Parquet dataset per table and a `manifest.json`
+that lists the Parquet files and the structure files the tables refer to, with their sizes.
+Jobs on other nodes can read the export without sharing the lock on the session database.
+"""
+
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from pathlib import Path
+
+from cattrs.preconf.json import make_converter
+from duckdb import DuckDBPyConnection
+
+from protein_detective.db import (
+    connect,
+    fingerprints_ddl,
+    kept_residues_ddl,
+    migrations,
+    quote_literal,
+    schema_version,
+)
+
+converter = make_converter()
+
+exported_tables: dict[str, tuple[str, ...]] = {
+    "proteins": (),
+    "pdbs": (),
+    "proteins_pdbs": (),
+    "alphafolds": (),
+    "density_filters": (),
+    "density_filtered_alphafolds": ("density_filter_id",),
+    "output_fingerprints": (),
+}
+"""Tables to export with the columns to partition them on.
+
+In order of foreign keys, so importing them in this order satisfies the constraints.
+"""
+
+file_columns: dict[str, tuple[str, ...]] = {
+    "pdbs": ("mmcif_file",),
+    "proteins_pdbs": ("single_chain_pdb_file",),
+    "alphafolds": (
+        "bcif_file",
+        "cif_file",
+        "pdb_file",
+        "pae_image_file",
+        "pae_doc_file",
+        "am_annotations_file",
+        "am_annotations_hg19_file",
+        "am_annotations_hg38_file",
+    ),
+    "density_filtered_alphafolds": ("pdb_file",),
+}
+"""Columns with paths to structure files, relative to the session directory."""
+
+manifest_name = "manifest.json"
+
+compressions = {"zstd", "snappy", "gzip", "uncompressed"}
+
+
+@dataclass
+class ManifestFile:
+    """File in an export.
+
+    Parameters:
+        path: Path relative to the export directory for Parquet files
+            or relative to the session directory for structure files.
+        size: Size of the file in bytes.
+    """
+
+    path: str
+    size: int
+
+
+@dataclass
+class ManifestTable:
+    """Table in an export.
+
+    Parameters:
+        rows: Number of rows in the table.
+        partition_by: Columns the table is partitioned on.
+        files: Parquet files of the table.
+    """
+
+    rows: int
+    partition_by: list[str]
+    files: list[ManifestFile]
+
+
+@dataclass
+class Manifest:
+    """Manifest of an export.
+
+    Parameters:
+        schema_version: Schema version of the session database that was exported.
+        created_at: When the export was made, in ISO 8601 format.
+        tables: Exported tables by name.
+        structure_files: Structure files that the tables refer to.
+            Files that do not exist in the session directory are left out.
+    """
+
+    schema_version: int
+    created_at: str
+    tables: dict[str, ManifestTable] = field(default_factory=dict)
+    structure_files: list[ManifestFile] = field(default_factory=list)
+
+
+def _structure_files(session_dir: Path, con: DuckDBPyConnection) -> list[ManifestFile]:
+    paths: set[str] = set()
+    for table, columns in file_columns.items():
+        for column in columns:
+            # table and column names are constants of this module
+            rows = con.execute(f"SELECT DISTINCT {column} FROM {table} WHERE {column} IS NOT NULL").fetchall()  # noqa: S608
+            paths.update(row[0] for row in rows)
+    files = []
+    for path in sorted(paths):
+        full_path = session_dir / path
+        if full_path.exists():
+            files.append(ManifestFile(path=path, size=full_path.stat().st_size))
+    return files
+
+
+def export_session(session_dir: Path, export_dir: Path, compression: str = "zstd") -> Manifest:
+    """Export the results of a session to Parquet files.
+
+    Args:
+        session_dir: The directory where the session database is stored.
+        export_dir: The directory to write the Parquet files and manifest to. Must not exist or be empty.
+        compression: The Parquet compression codec, one of `compressions`.
+
+    Returns:
+        The manifest of the export, which is also written to `manifest.json` in the export directory.
+
+    Raises:
+        ValueError: If the export directory is not empty, the compression is not supported
+            or the session database is not at the latest schema version.
+    """
+    if compression not in compressions:
+        msg = f"Invalid compression: {compression}. Must be one of {sorted(compressions)}"
+        raise ValueError(msg)
+    if export_dir.exists() and any(export_dir.iterdir()):
+        msg = f"Export directory {export_dir} is not empty"
+        raise ValueError(msg)
+    export_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = Manifest(schema_version=schema_version, created_at=datetime.now(UTC).isoformat())
+    # Read-only, so exporting does not take the write lock of the session
+    with connect(session_dir, read_only=True) as con:
+        for table, partition_by in exported_tables.items():
+            table_dir = export_dir / table
+            options = f"FORMAT PARQUET, COMPRESSION {compression}"
+            if partition_by:
+                options += f", PARTITION_BY ({', '.join(partition_by)})"
+                target = table_dir
+            else:
+                table_dir.mkdir()
+                target = table_dir / "data_0.parquet"
+            con.execute(f"COPY {table} TO {quote_literal(str(target))} ({options})")
+            result = con.execute(f"SELECT count(*) FROM {table}").fetchone()  # noqa: S608 table is a constant
+            files = [
+                ManifestFile(path=file.relative_to(export_dir).as_posix(), size=file.stat().st_size)
+                for file in sorted(table_dir.rglob("*.parquet"))
+            ]
+            manifest.tables[table] = ManifestTable(
+                rows=result[0] if result else 0,
+                partition_by=list(partition_by),
+                files=files,
+            )
+        manifest.structure_files = _structure_files(session_dir, con)
+
+    (export_dir / manifest_name).write_text(converter.dumps(manifest, Manifest, indent=2))
+    return manifest
+
+
+def load_manifest(export_dir: Path) -> Manifest:
+    """Load the manifest of an export.
+
+    Args:
+        export_dir: The directory with the export.
+
+    Returns:
+        The manifest.
+    """
+    return converter.loads((export_dir / manifest_name).read_text(), Manifest)
+
+
+def _import_density_filtered_alphafolds(
+    files: list[str], dfs_files: list[str], exported_schema_version: int, con: DuckDBPyConnection
+):
+    # Exports made before the kept residues or fingerprints were stored do not have the column
+    has_kept_residues = exported_schema_version > migrations.index(kept_residues_ddl)
+    kept_residues = "e.kept_residues" if has_kept_residues else "NULL"
+    has_fingerprints = exported_schema_version > migrations.index(fingerprints_ddl)
+    input_fingerprint = "e.input_fingerprint" if has_fingerprints else "NULL"
+    # Density filter ids are generated by a sequence,
+    # so look them up by their thresholds instead of trusting the exported ids.
+    con.execute(
+        f"""INSERT OR IGNORE INTO density_filtered_alphafolds
+        (density_filter_id, uniprot_acc, nr_residues_above_confidence, keep, pdb_file, kept_residues,
+            input_fingerprint)
+        SELECT df.density_filter_id, e.uniprot_acc, e.nr_residues_above_confidence, e.keep, e.pdb_file,
+            {kept_residues}, {input_fingerprint}
+        FROM read_parquet(?, hive_partitioning = true) AS e
+        JOIN read_parquet(?) AS edf USING (density_filter_id)
+        JOIN density_filters AS df
+            ON df.confidence = edf.confidence
+            AND df.min_threshold = edf.min_threshold
+            AND df.max_threshold = edf.max_threshold
+        """,  # noqa: S608 kept_residues and input_fingerprint are a column name or NULL
+        (files, dfs_files),
+    )
+
+
+def import_session(export_dir: Path, session_dir: Path) -> dict[str, int]:
+    """Import an export into a session.
+
+    Rows that already exist in the session are left as is, so importing the same export twice is harmless.
+    Structure files are not copied, the paths in the tables are relative to the session directory.
+
+    Args:
+        export_dir: The directory with the export.
+        session_dir: The directory of the session to import into. Created if it does not exist.
+
+    Returns:
+        The number of rows in the export per table.
+
+    Raises:
+        ValueError: If the export was made by a newer version of protein-detective.
+    """
+    manifest = load_manifest(export_dir)
+    if manifest.schema_version > schema_version:
+        msg = (
+            f"Export has schema version {manifest.schema_version}, "
+            f"but this version of protein-detective only supports up to {schema_version}. "
+            "Please upgrade protein-detective."
+        )
+        raise ValueError(msg)
+    session_dir.mkdir(parents=True, exist_ok=True)
+
+    def files_of(table: str) -> list[str]:
+        if table not in manifest.tables:
+            return []
+        return [str(export_dir / file.path) for file in manifest.tables[table].files]
+
+    with connect(session_dir) as con:
+        con.begin()
+        for table in exported_tables:
+            files = files_of(table)
+            if not files:
+                continue
+            if table == "density_filters":
+                con.execute(
+                    """INSERT OR IGNORE INTO density_filters (confidence, min_threshold, max_threshold)
+                    SELECT confidence, min_threshold, max_threshold FROM read_parquet(?)""",
+                    (files,),
+                )
+            elif table == "density_filtered_alphafolds":
+                _import_density_filtered_alphafolds(files, files_of("density_filters"), manifest.schema_version, con)
+            else:
+                # table is a constant of this module
+                con.execute(f"INSERT OR IGNORE INTO {table} BY NAME SELECT * FROM read_parquet(?)", (files,))  # noqa: S608
+        con.commit()
+    return {table: exported.rows for table, exported in manifest.tables.items()}
@@ -0,0 +1,127 @@
+"""Local copy of the Gene Ontology, to expand GO terms of a search beforehand.
+
+Matching a GO term and its subclasses with a property path is expensive for the UniProt SPARQL endpoint.
+With a local copy of the ontology, the descendants of a GO term are computed once
+and the search matches a flat list of terms instead.
+
+Download `go-basic.obo` or `go-basic.json` from the
+[Gene Ontology download page](https://geneontology.org/docs/download-ontology/).
+"""
+
+import gzip
+import json
+import logging
+from collections import defaultdict
+from functools import cache
+from pathlib import Path
+from typing import TextIO
+
+logger = logging.getLogger(__name__)
+
+
+class GoOntology:
+    """Subclass relations between the terms of the Gene Ontology.
+
+    Args:
+        parents: For each GO term, the GO terms it is a direct subclass (is_a) of.
+    """
+
+    def __init__(self, parents: dict[str, set[str]]):
+        self.terms = set(parents)
+        self.children: dict[str, set[str]] = defaultdict(set)
+        for term, term_parents in parents.items():
+            for parent in term_parents:
+                self.children[parent].add(term)
+        self._descendants: dict[str, frozenset[str]] = {}
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.terms
+
+    def descendants(self, term: str) -> frozenset[str]:
+        """The GO term and all GO terms that are a subclass of it, directly or indirectly.
+
+        Args:
+            term: The GO term, like "GO:0005634".
+
+        Returns:
+            The GO term and its descendants.
+        """
+        if term not in self._descendants:
+            found = {term}
+            todo = [term]
+            while todo:
+                for child in self.children.get(todo.pop(), ()):
+                    if child not in found:
+                        found.add(child)
+                        todo.append(child)
+            self._descendants[term] = frozenset(found)
+        return self._descendants[term]
+
+
+def _parse_obo(f: TextIO) -> dict[str, set[str]]:
+    parents: dict[str, set[str]] = {}
+    term: str | None = None
+    is_term = False
+    for line in f:
+        line = line.strip()  # noqa: PLW2901
+        if line.startswith("["):
+            is_term = line == "[Term]"
+            term = None
+        elif not is_term:
+            continue
+        elif line.startswith("id: "):
+            term = line[4:]
+            parents[term] = set()
+        elif line == "is_obsolete: true" and term is not None:
+            del parents[term]
+            term = None
+        elif line.startswith("is_a: ") and term is not None:
+            parents[term].add(line[6:].split()[0])
+    return parents
+
+
+def _iri2term(iri: str) -> str | None:
+    prefix = "http://purl.obolibrary.org/obo/GO_"
+    if not iri.startswith(prefix):
+        return None
+    return "GO:" + iri.removeprefix(prefix)
+
+
+def _parse_obographs_json(f: TextIO) -> dict[str, set[str]]:
+    parents: dict[str, set[str]] = {}
+    graph = json.load(f)["graphs"][0]
+    for node in graph.get("nodes", []):
+        term = _iri2term(node["id"])
+        if term is not None and node.get("type", "CLASS") == "CLASS" and not node.get("meta", {}).get("deprecated"):
+            parents[term] = set()
+    for edge in graph.get("edges", []):
+        term = _iri2term(edge["sub"])
+        parent = _iri2term(edge["obj"])
+        if edge["pred"] == "is_a" and term in parents and parent is not None:
+            parents[term].add(parent)
+    return parents
+
+
+@cache
+def _load_go_ontology(path: Path, mtime_ns: int) -> GoOntology:  # noqa: ARG001 part of the cache key
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rt") as f:
+        parents = _parse_obo(f) if path.name.removesuffix(".gz").endswith(".obo") else _parse_obographs_json(f)
+    logger.info("Loaded %d GO terms from %s", len(parents), path)
+    return GoOntology(parents)
+
+
+def load_go_ontology(path: Path) -> GoOntology:
+    """Load the Gene Ontology from an OBO file or an OBO Graphs JSON file.
+
+    The format is chosen by the file name, `*.obo` or `*.json`, which may be gzipped.
+    Only is_a relations of terms that are not obsolete are loaded.
+    Loaded ontologies are kept in memory until the file changes.
+
+    Args:
+        path: The ontology file, like `go-basic.obo`.
+
+    Returns:
+        The ontology.
+    """
+    return _load_go_ontology(path.absolute(), path.stat().st_mtime_ns)
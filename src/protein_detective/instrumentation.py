@@ -0,0 +1,250 @@
+"""Timers and counters around the hot paths of the workflow steps.
+
+Disabled by default, in which case the instrumented functions only pay for a boolean check.
+
+Examples:
+    >>> instrumentation.enable()
+    >>> search_structures_in_uniprot(query, session_dir)
+    >>> for name, stats in instrumentation.stages.items():
+    >>>     print(name, stats.calls, stats.wall_seconds)
+"""
+
+import cProfile
+import functools
+import inspect
+import time
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Any
+
+
+@dataclass
+class StageStats:
+    """Timing and counters of a single stage.
+
+    Parameters:
+        calls: Number of times the stage was entered.
+        items: Number of items processed, for generators the number of yielded items.
+        bytes: Number of bytes processed.
+        retries: Number of retries.
+        total_seconds: Sum of time spent in each call. Can exceed wall_seconds when calls run concurrently.
+        first_start: Monotonic time the stage was first entered.
+        last_end: Monotonic time the stage was last left.
+    """
+
+    calls: int = 0
+    items: int = 0
+    bytes: int = 0
+    retries: int = 0
+    total_seconds: float = 0.0
+    first_start: float | None = None
+    last_end: float | None = None
+
+    @property
+    def wall_seconds(self) -> float:
+        """Time between first entering and last leaving the stage."""
+        if self.first_start is None or self.last_end is None:
+            return 0.0
+        return self.last_end - self.first_start
+
+    @property
+    def items_per_second(self) -> float | None:
+        """Number of items processed per second of wall time."""
+        if self.wall_seconds == 0:
+            return None
+        return self.items / self.wall_seconds
+
+
+class Instrumentation:
+    """Collects [StageStats][protein_detective.instrumentation.StageStats] per stage name."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stages: dict[str, StageStats] = {}
+
+    def enable(self):
+        """Start collecting stats, forgetting stats of a previous run."""
+        self.stages = {}
+        self.enabled = True
+
+    def disable(self):
+        """Stop collecting stats."""
+        self.enabled = False
+
+    def stage(self, name: str) -> StageStats:
+        """Stats of a stage, created when missing."""
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    def count(self, name: str, items: int = 0, nbytes: int = 0, retries: int = 0):
+        """Add to the counters of a stage.
+
+        Args:
+            name: Name of the stage.
+            items: Number of items to add.
+            nbytes: Number of bytes to add.
+            retries: Number of retries to add.
+        """
+        if not self.enabled:
+            return
+        stats = self.stage(name)
+        stats.items += items
+        stats.bytes += nbytes
+        stats.retries += retries
+
+    @contextmanager
+    def measure(self, name: str, items: int = 1):
+        """Time the body as a call of a stage.
+
+        Args:
+            name: Name of the stage.
+            items: Number of items processed by the body.
+        """
+        if not self.enabled:
+            yield
+            return
+        stats = self.stage(name)
+        start = time.monotonic()
+        if stats.first_start is None:
+            stats.first_start = start
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            stats.calls += 1
+            stats.items += items
+            stats.total_seconds += end - start
+            stats.last_end = end
+
+
+instrumentation = Instrumentation()
+"""Instrumentation shared by all instrumented functions."""
+
+
+def _stage_name(func: Callable) -> str:
+    return f"{func.__module__.removeprefix('protein_detective.')}.{func.__name__}"
+
+
+def _timed_generator(func: Callable, name: str) -> Callable:
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Generator:
+        if not instrumentation.enabled:
+            return (yield from func(*args, **kwargs))
+        stats = instrumentation.stage(name)
+        stats.calls += 1
+        if stats.first_start is None:
+            stats.first_start = time.monotonic()
+        gen = func(*args, **kwargs)
+        try:
+            while True:
+                # Only time spent inside the generator counts, not time spent by the consumer
+                start = time.monotonic()
+                try:
+                    item = next(gen)
+                except StopIteration as e:
+                    end = time.monotonic()
+                    stats.total_seconds += end - start
+                    stats.last_end = end
+                    return e.value
+                end = time.monotonic()
+                stats.total_seconds += end - start
+                stats.last_end = end
+                stats.items += 1
+                yield item
+        finally:
+            # Like yield from, close the generator when the consumer stops early or raises into the wrapper
+            gen.close()
+
+    return wrapper
+
+
+def _timed_coroutine(func: Callable, name: str) -> Callable:
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if not instrumentation.enabled:
+            return await func(*args, **kwargs)
+        with instrumentation.measure(name):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+def timed[F: Callable](func: F) -> F:
+    """Decorator that times each call of a function as a stage named after its module and name.
+
+    Works for plain functions, coroutine functions and generator functions.
+    For generators each yielded value counts as an item and
+    only time spent inside the generator is measured.
+
+    Args:
+        func: The function to time.
+
+    Returns:
+        The wrapped function.
+    """
+    name = _stage_name(func)
+    if inspect.isgeneratorfunction(func):
+        return _timed_generator(func, name)  # pyrefly: ignore
+    if inspect.iscoroutinefunction(func):
+        return _timed_coroutine(func, name)  # pyrefly: ignore
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if not instrumentation.enabled:
+            return func(*args, **kwargs)
+        with instrumentation.measure(name):
+            return func(*args, **kwargs)
+
+    return wrapper  # pyrefly: ignore
+
+
+@contextmanager
+def write_profile(output_dir: Path, name: str) -> Generator[Path]:
+    """Profile the body and write the profile to a file in output_dir.
+
+    When [pyinstrument](https://pyinstrument.readthedocs.io/) is installed,
+    the body is sampled and a [speedscope](https://www.speedscope.app/) JSON file is written.
+    Otherwise the body is profiled with [cProfile][] and a pstats file is written,
+    which can be turned into a flamegraph with tools like flameprof or snakeviz.
+
+    Examples:
+        >>> with write_profile(Path("profiles"), "density-filter") as profile_file:
+        >>>     density_filter(session_dir, query)
+        >>> print(profile_file)
+        profiles/density-filter-20250101T120000.speedscope.json
+
+    Args:
+        output_dir: Directory to write profile to.
+        name: Prefix of the file name of the profile.
+
+    Yields:
+        The path the profile is written to when the body is done.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now(UTC).strftime("%Y%m%dT%H%M%S")
+    try:
+        from pyinstrument import Profiler  # noqa: PLC0415 optional dependency
+        from pyinstrument.renderers import SpeedscopeRenderer  # noqa: PLC0415 optional dependency
+    except ImportError:
+        path = output_dir / f"{name}-{stamp}.prof"
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield path
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+        return
+
+    path = output_dir / f"{name}-{stamp}.speedscope.json"
+    sampler = Profiler(async_mode="enabled")
+    sampler.start()
+    try:
+        yield path
+    finally:
+        sampler.stop()
+        path.write_text(sampler.output(SpeedscopeRenderer()))
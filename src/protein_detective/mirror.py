@@ -0,0 +1,337 @@
+"""Resolve structures against local mirrors before downloading them.
+
+Files found in a mirror are symlinked into the session, so they are not copied.
+Only the structures missing from the mirror are downloaded.
+
+Supported layouts:
+
+- a wwPDB mirror of divided mmCIF files, like `<mirror>/wa/8was.cif.gz`,
+  which is the `mmCIF` directory of `rsync://rsync.wwpdb.org/ftp_data/structures/divided/mmCIF/`.
+- a directory with AlphaFold files as named by the AlphaFold database,
+  like `AF-P12345-F1-model_v4.pdb` or `AF-P12345-F1-model_v4.cif.gz`, in any subdirectory.
+  The files can also be in proteome archives, like `UP000005640_9606_HUMAN_v4.tar`,
+  from which only the requested files are extracted.
+  The AlphaFold files of a directory are indexed once, in a file next to the directory,
+  see [mirror_index_path][protein_detective.mirror.mirror_index_path].
+"""
+
+import json
+import logging
+import os
+import re
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+
+from protein_detective.alphafold import AlphaFoldEntry, DownloadableFormat, entry_fields
+from protein_detective.archive import ArchiveMember, extract_member, load_index
+
+logger = logging.getLogger(__name__)
+
+
+def link_file(source: Path, save_dir: Path) -> Path:
+    """Symlink a file into a directory with the same name.
+
+    Args:
+        source: The file to link to.
+        save_dir: The directory to create the link in.
+
+    Returns:
+        Path to the link.
+    """
+    save_dir.mkdir(parents=True, exist_ok=True)
+    link = save_dir / source.name
+    if link.is_symlink() or link.exists():
+        link.unlink()
+    link.symlink_to(source.absolute())
+    return link
+
+
+def pdb_mirror_file(mirror_dir: Path, pdb_id: str) -> Path | None:
+    """Find the mmCIF file of a PDB entry in a wwPDB mirror.
+
+    Args:
+        mirror_dir: Directory of the mirror with divided mmCIF files.
+        pdb_id: The PDB ID to find.
+
+    Returns:
+        Path to the file, or None if the entry is not in the mirror.
+    """
+    pdb_id = pdb_id.lower()
+    divided_dir = mirror_dir / pdb_id[1:3]
+    for name in (f"{pdb_id}.cif.gz", f"{pdb_id}.cif"):
+        file = divided_dir / name
+        if file.exists():
+            return file
+    return None
+
+
+def link_from_pdb_mirror(ids: Iterable[str], mirror_dir: Path, save_dir: Path) -> tuple[dict[str, Path], set[str]]:
+    """Link the mmCIF files of PDB entries from a wwPDB mirror.
+
+    Args:
+        ids: The PDB IDs to link.
+        mirror_dir: Directory of the mirror with divided mmCIF files.
+        save_dir: The directory to create the links in.
+
+    Returns:
+        A dict of PDB ID and linked file, and the PDB IDs that are not in the mirror.
+    """
+    linked: dict[str, Path] = {}
+    missing: set[str] = set()
+    for pdb_id in ids:
+        file = pdb_mirror_file(mirror_dir, pdb_id)
+        if file is None:
+            missing.add(pdb_id)
+        else:
+            linked[pdb_id] = link_file(file, save_dir)
+    logger.info("Linked %i PDB entries from %s, %i are missing", len(linked), mirror_dir, len(missing))
+    return linked, missing
+
+
+_alphafold_file_pattern = re.compile(
+    r"^AF-(?P<uniprot_acc>[A-Z0-9]+)-F1-(?P<kind>model|predicted_aligned_error)_v(?P<version>\d+)"
+    r"\.(?P<extension>pdb|cif|bcif|json|png)(\.gz)?$"
+)
+_alphafold_file_formats: dict[tuple[str, str], DownloadableFormat] = {
+    ("model", "pdb"): "pdb",
+    ("model", "cif"): "cif",
+    ("model", "bcif"): "bcif",
+    ("predicted_aligned_error", "json"): "paeDoc",
+    ("predicted_aligned_error", "png"): "paeImage",
+}
+
+
+type MirrorFile = Path | ArchiveMember
+"""A file in a mirror directory or a member of an archive in a mirror directory."""
+
+
+def materialize(file: MirrorFile, save_dir: Path) -> Path:
+    """Make a mirror file available in a directory.
+
+    Args:
+        file: The file in the mirror.
+        save_dir: The directory to make the file available in.
+
+    Returns:
+        Path to the link to the file, or to the file extracted from an archive.
+    """
+    if isinstance(file, ArchiveMember):
+        return extract_member(file, save_dir)
+    return link_file(file, save_dir)
+
+
+def mirror_index_path(directory: Path) -> Path:
+    """Return the path of the index file of a directory with AlphaFold files.
+
+    The index file is next to the directory instead of in it,
+    so writing the index does not change the directory.
+
+    Args:
+        directory: The directory with AlphaFold files.
+
+    Returns:
+        Path to the index file.
+    """
+    directory = directory.absolute()
+    return directory.with_name(directory.name + ".index.json")
+
+
+def _stamp(path: Path) -> tuple[int, int]:
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _file2json(directory: Path, file: MirrorFile) -> str | list:
+    if isinstance(file, ArchiveMember):
+        return [str(file.archive.relative_to(directory)), file.name, file.offset, file.size]
+    return str(file.relative_to(directory))
+
+
+def _json2file(directory: Path, file: str | list) -> MirrorFile:
+    if isinstance(file, str):
+        return directory / file
+    archive, name, offset, size = file
+    return ArchiveMember(directory / archive, name, offset, size)
+
+
+# Indexes of the mirrors used by this process, so a long running process does not read the index file every time
+_mirrors: dict[Path, "AlphaFoldMirror"] = {}
+
+
+@dataclass
+class AlphaFoldMirror:
+    """Index of a directory with AlphaFold files.
+
+    Parameters:
+        directory: The directory with AlphaFold files.
+        files: The newest version of each file per UniProt accession and format.
+        stamps: Size and modification time of each directory and archive in the directory, when it was indexed.
+    """
+
+    directory: Path
+    files: dict[str, dict[DownloadableFormat, MirrorFile]]
+    stamps: dict[Path, tuple[int, int]] = field(default_factory=dict)
+
+    @classmethod
+    def scan(cls, directory: Path, uniprot_accs: Iterable[str] | None = None) -> "AlphaFoldMirror":
+        """Index the AlphaFold files in a directory and its subdirectories.
+
+        Args:
+            directory: The directory with AlphaFold files.
+            uniprot_accs: Only index files of these UniProt accessions. If None, all files are indexed.
+
+        Returns:
+            The index.
+        """
+        wanted = None if uniprot_accs is None else set(uniprot_accs)
+        files: dict[str, dict[DownloadableFormat, MirrorFile]] = {}
+        versions: dict[tuple[str, DownloadableFormat], int] = {}
+        stamps: dict[Path, tuple[int, int]] = {}
+
+        def add(name: str, file: MirrorFile):
+            match = _alphafold_file_pattern.match(name)
+            if match is None:
+                return
+            uniprot_acc = match["uniprot_acc"]
+            what = _alphafold_file_formats[(match["kind"], match["extension"])]
+            version = int(match["version"])
+            if (wanted is not None and uniprot_acc not in wanted) or version < versions.get((uniprot_acc, what), 0):
+                return
+            versions[(uniprot_acc, what)] = version
+            files.setdefault(uniprot_acc, {})[what] = file
+
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if name.endswith(".tar"):
+                    archive = Path(root) / name
+                    stamps[archive] = _stamp(archive)
+                    for member in load_index(archive):
+                        add(PurePosixPath(member.name).name, member)
+                else:
+                    add(name, Path(root) / name)
+            # Writing the index of an archive next to it changes the directory,
+            # so the directory is stamped after the indexes of its archives are written
+            stamps[Path(root)] = _stamp(Path(root))
+        return cls(directory, files, stamps)
+
+    def is_current(self) -> bool:
+        """Whether the index is up to date with the directory.
+
+        Adding, removing or renaming a file changes the modification time of its directory,
+        so only the indexed directories and archives are checked, without listing their files.
+
+        Returns:
+            True if no directory or archive changed since the directory was indexed.
+        """
+        try:
+            return all(_stamp(path) == stamp for path, stamp in self.stamps.items())
+        except FileNotFoundError:
+            return False
+
+    def to_json(self) -> dict:
+        """Convert the index to a JSON serializable dict, with paths relative to the directory."""
+        return {
+            "stamps": [[str(path.relative_to(self.directory)), *stamp] for path, stamp in self.stamps.items()],
+            "files": {
+                uniprot_acc: {fmt: _file2json(self.directory, file) for fmt, file in files.items()}
+                for uniprot_acc, files in self.files.items()
+            },
+        }
+
+    @classmethod
+    def from_json(cls, directory: Path, data: dict) -> "AlphaFoldMirror":
+        """Create an index from the output of [to_json][protein_detective.mirror.AlphaFoldMirror.to_json].
+
+        Args:
+            directory: The directory with AlphaFold files.
+            data: The index as JSON.
+
+        Returns:
+            The index.
+        """
+        return cls(
+            directory,
+            files={
+                uniprot_acc: {fmt: _json2file(directory, file) for fmt, file in files.items()}
+                for uniprot_acc, files in data["files"].items()
+            },
+            stamps={directory / path: (size, mtime_ns) for path, size, mtime_ns in data["stamps"]},
+        )
+
+    @classmethod
+    def load(cls, directory: Path) -> "AlphaFoldMirror":
+        """Load the index of a directory with AlphaFold files, scanning the directory when missing or outdated.
+
+        The index is kept in memory and in the file at [mirror_index_path][protein_detective.mirror.mirror_index_path].
+        When the index file can not be written, the index is only kept in memory.
+
+        Args:
+            directory: The directory with AlphaFold files.
+
+        Returns:
+            The index of all AlphaFold files in the directory.
+        """
+        directory = directory.absolute()
+        path = mirror_index_path(directory)
+        mirror = _mirrors.get(directory)
+        if mirror is None and path.exists():
+            mirror = cls.from_json(directory, json.loads(path.read_text()))
+        if mirror is None or not mirror.is_current():
+            logger.info("Indexing AlphaFold files in %s", directory)
+            mirror = cls.scan(directory)
+            try:
+                path.write_text(json.dumps(mirror.to_json()))
+            except OSError as e:
+                logger.warning("Could not write index of %s to %s: %s", directory, path, e)
+        _mirrors[directory] = mirror
+        return mirror
+
+    def find(self, uniprot_acc: str, what: set[DownloadableFormat]) -> dict[DownloadableFormat, MirrorFile] | None:
+        """Find the files of an AlphaFold entry.
+
+        Args:
+            uniprot_acc: The UniProt accession of the entry.
+            what: The formats to find.
+
+        Returns:
+            The files per format, or None if any format is missing.
+        """
+        files = self.files.get(uniprot_acc, {})
+        if not what <= files.keys():
+            return None
+        return {fmt: files[fmt] for fmt in what}
+
+
+def link_from_alphafold_mirror(
+    ids: Iterable[str], mirror_dir: Path, save_dir: Path, what: set[DownloadableFormat]
+) -> tuple[list[AlphaFoldEntry], set[str]]:
+    """Link the files of AlphaFold entries from a directory.
+
+    Files in archives are extracted instead of linked.
+    Entries from a mirror have no summary, as the summary is only available from the AlphaFold API.
+    Scanning the mirror, indexing archives and extracting files block,
+    so async callers run this in a thread.
+
+    Args:
+        ids: The UniProt accessions to link.
+        mirror_dir: The directory with AlphaFold files.
+        save_dir: The directory to create the links in.
+        what: The formats to link. Entries that miss any format are not linked.
+
+    Returns:
+        The linked entries, and the UniProt accessions that are missing from the mirror.
+    """
+    ids = set(ids)
+    mirror = AlphaFoldMirror.load(mirror_dir)
+    entries: list[AlphaFoldEntry] = []
+    missing: set[str] = set()
+    for uniprot_acc in ids:
+        files = mirror.find(uniprot_acc, what)
+        if files is None:
+            missing.add(uniprot_acc)
+            continue
+        linked = {entry_fields[fmt]: materialize(file, save_dir) for fmt, file in files.items()}
+        entries.append(AlphaFoldEntry(uniprot_acc=uniprot_acc, summary=None, **linked))
+    logger.info("Linked %i AlphaFold entries from %s, %i are missing", len(entries), mirror_dir, len(missing))
+    return entries, missing
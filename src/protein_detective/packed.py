@@ -0,0 +1,234 @@
+"""Packed storage of the structure files of a session.
+
+A session of a proteome has tens of thousands of small structure files,
+which is slow and uses up inode quota on parallel file systems.
+With packed storage, files are appended to a few large pack files in the `packed` directory of the session.
+The offset of each file in its pack is stored in the `packed_files` table of the session database,
+under the session relative path the file would have had, so the other tables do not change.
+
+Each [PackedStore][protein_detective.packed.PackedStore] appends to its own pack file,
+so processes can write at the same time.
+Files are read from memory mapped packs, or from disk when they are not packed.
+"""
+
+import gzip
+import io
+import mmap
+import os
+import uuid
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, TextIO
+
+
+@dataclass(frozen=True)
+class PackedFile:
+    """A file in a pack.
+
+    Parameters:
+        path: Path the file would have had, relative to the session directory.
+        pack: Path to the pack file, relative to the session directory.
+        offset: Offset of the file in the pack, in bytes.
+        size: Size of the file, in bytes.
+    """
+
+    path: Path
+    pack: Path
+    offset: int
+    size: int
+
+
+def packed_dir(session_dir: Path) -> Path:
+    """Return the directory where pack files of a session are stored.
+
+    Args:
+        session_dir: The directory where the session data is stored.
+
+    Returns:
+        Path to the packed directory.
+    """
+    return session_dir / "packed"
+
+
+class PackedStore:
+    """Reads and writes the files of a session, packed or not.
+
+    Paths are the paths the files have on disk when not packed,
+    like `session_dir / "downloads" / "1abc.cif"`.
+    Files outside the session directory are always read from disk.
+
+    Args:
+        session_dir: The directory where the session data is stored.
+        packed_files: The files already in packs, see `protein_detective.db.load_packed_files`.
+        pack_writes: Whether written files are appended to a pack. If False, they are written to disk.
+        max_pack_size: When the pack of this store grows over this many bytes, a new pack is started.
+    """
+
+    def __init__(
+        self,
+        session_dir: Path,
+        packed_files: Iterable[PackedFile] = (),
+        pack_writes: bool = False,
+        max_pack_size: int = 2**30,
+    ):
+        self.session_dir = session_dir
+        self.pack_writes = pack_writes
+        self.max_pack_size = max_pack_size
+        self.index = {file.path: file for file in packed_files}
+        self.added: list[PackedFile] = []
+        """Files written to a pack by this store, which still need to be saved in the session database."""
+        self._maps: dict[Path, mmap.mmap] = {}
+        self._pack: BinaryIO | None = None
+        self._pack_path: Path | None = None
+
+    def _relative(self, path: Path) -> Path | None:
+        absolute_path = path.absolute()
+        session_dir = self.session_dir.absolute()
+        if absolute_path.is_relative_to(session_dir):
+            return absolute_path.relative_to(session_dir)
+        return None
+
+    def _packed(self, path: Path) -> PackedFile | None:
+        relative = self._relative(path)
+        return None if relative is None else self.index.get(relative)
+
+    def exists(self, path: Path) -> bool:
+        """Whether a file exists in a pack or on disk."""
+        return self._packed(path) is not None or path.exists()
+
+    def fingerprint(self, path: Path) -> str:
+        """Fingerprint of a file, which changes when the file changes.
+
+        For files on disk it is their size and modification time,
+        for packed files their location, as files in a pack are never changed.
+        So packing a file changes its fingerprint.
+
+        Args:
+            path: The file to fingerprint.
+
+        Returns:
+            The fingerprint.
+        """
+        packed = self._packed(path)
+        if packed is None:
+            stat = path.stat()
+            return f"{stat.st_size}:{stat.st_mtime_ns}"
+        return f"{packed.pack}:{packed.offset}:{packed.size}"
+
+    def read_bytes(self, path: Path) -> bytes:
+        """Read a file from a pack or from disk.
+
+        Args:
+            path: The file to read.
+
+        Returns:
+            The content of the file.
+        """
+        packed = self._packed(path)
+        if packed is None:
+            return path.read_bytes()
+        pack = self._map(packed.pack)
+        return pack[packed.offset : packed.offset + packed.size]
+
+    def open_text(self, path: Path) -> TextIO:
+        """Open a file for reading text, decompressing it when its name ends with .gz.
+
+        Args:
+            path: The file to open.
+
+        Returns:
+            The opened file.
+        """
+        if self._packed(path) is None:
+            if path.suffix == ".gz":
+                return gzip.open(path, "rt")
+            return path.open("r")
+        data = self.read_bytes(path)
+        if path.suffix == ".gz":
+            data = gzip.decompress(data)
+        return io.StringIO(data.decode())
+
+    def write_text(self, path: Path, text: str):
+        """Write a file to the pack of this store, or to disk when writes are not packed.
+
+        Args:
+            path: The file to write, must be in the session directory when writes are packed.
+            text: The content of the file.
+
+        Raises:
+            ValueError: If writes are packed and the path is outside the session directory.
+        """
+        if not self.pack_writes:
+            path.write_text(text)
+            return
+        relative = self._relative(path)
+        if relative is None:
+            msg = f"Can not pack {path}, it is outside the session directory {self.session_dir}"
+            raise ValueError(msg)
+        self.add(relative, text.encode())
+
+    def add(self, path: Path, data: bytes) -> PackedFile:
+        """Append a file to the pack of this store.
+
+        Args:
+            path: Path the file would have had, relative to the session directory.
+            data: The content of the file.
+
+        Returns:
+            The packed file.
+        """
+        pack, pack_path = self._writable_pack()
+        offset = pack.tell()
+        pack.write(data)
+        packed = PackedFile(path=path, pack=pack_path, offset=offset, size=len(data))
+        self.index[path] = packed
+        self.added.append(packed)
+        return packed
+
+    def _writable_pack(self) -> tuple[BinaryIO, Path]:
+        if self._pack is not None and self._pack_path is not None and self._pack.tell() < self.max_pack_size:
+            return self._pack, self._pack_path
+        self._close_pack()
+        directory = packed_dir(self.session_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+        # A unique name, so stores in other processes never append to the same pack
+        self._pack_path = (directory / f"{uuid.uuid4().hex}.pack").relative_to(self.session_dir)
+        self._pack = (self.session_dir / self._pack_path).open("ab")
+        return self._pack, self._pack_path
+
+    def _map(self, pack_path: Path) -> mmap.mmap:
+        if pack_path == self._pack_path and self._pack is not None:
+            # Map again to see the files appended since the last map
+            self._pack.flush()
+            if pack_path in self._maps:
+                self._maps.pop(pack_path).close()
+        if pack_path not in self._maps:
+            with (self.session_dir / pack_path).open("rb") as f:
+                self._maps[pack_path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[pack_path]
+
+    def flush(self):
+        """Flush the pack of this store to disk, do this before saving the added files in the session database."""
+        if self._pack is not None:
+            self._pack.flush()
+            os.fsync(self._pack.fileno())
+
+    def _close_pack(self):
+        if self._pack is not None:
+            self.flush()
+            self._pack.close()
+            self._pack = None
+
+    def close(self):
+        """Flush the pack of this store to disk and close the memory maps."""
+        self._close_pack()
+        for pack in self._maps.values():
+            pack.close()
+        self._maps.clear()
+
+    def __enter__(self) -> "PackedStore":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
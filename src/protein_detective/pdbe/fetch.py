@@ -1,9 +1,9 @@
 import asyncio
-import concurrent.futures
-from collections.abc import Iterable, Mapping
+from collections.abc import AsyncGenerator, Iterable, Mapping
 from pathlib import Path
 
-from protein_detective.utils import retrieve_files
+from protein_detective.mirror import link_from_pdb_mirror
+from protein_detective.utils import FriendlyClient, iter_retrieve_files, retrieve_files, run_async
 
 
 def _map_id_mmcif(pdb_id: str) -> tuple[str, str]:
@@ -28,32 +28,93 @@ def _map_id_mmcif(pdb_id: str) -> tuple[str, str]:
     return url, fn
 
 
-def fetch(ids: Iterable[str], save_dir: Path, max_parallel_downloads: int = 5) -> Mapping[str, Path]:
-    """Fetches mmCIF files from the PDBe database.
+async def fetch_async(
+    ids: Iterable[str],
+    save_dir: Path,
+    max_parallel_downloads: int = 5,
+    session: FriendlyClient | None = None,
+    mirror_dir: Path | None = None,
+) -> Mapping[str, Path]:
+    """Asynchronously fetches mmCIF files from the PDBe database.
 
     Args:
         ids: A set of PDB IDs to fetch.
         save_dir: The directory to save the fetched mmCIF files to.
         max_parallel_downloads: The maximum number of parallel downloads.
+        session: Session to download with. If None, a new session is created.
+        mirror_dir: Directory of a wwPDB mirror with divided mmCIF files.
+            Files in the mirror are linked into `save_dir`, only missing files are downloaded.
 
     Returns:
         A dict of id and paths to the downloaded mmCIF files.
     """
+    linked: dict[str, Path] = {}
+    if mirror_dir is not None:
+        # Looking up and linking files blocks, so it runs in a thread instead of on the event loop
+        linked, ids = await asyncio.to_thread(link_from_pdb_mirror, ids, mirror_dir, save_dir)
 
-    # The future result, is in a different order than the input ids,
+    # The result is in a different order than the input ids,
     # so we need to map the ids to the urls and filenames.
 
     id2urls = {pdb_id: _map_id_mmcif(pdb_id) for pdb_id in ids}
     urls = list(id2urls.values())
     id2paths = {pdb_id: save_dir / fn for pdb_id, (_, fn) in id2urls.items()}
 
-    def run_async_task():
-        return asyncio.run(retrieve_files(urls, save_dir, max_parallel_downloads, desc="Downloading PDBe mmCIF files"))
+    result = await retrieve_files(
+        urls, save_dir, max_parallel_downloads, desc="Downloading PDBe mmCIF files", session=session
+    )
+    if set(result) != set(id2paths.values()):
+        msg = "Not all files were downloaded successfully."
+        raise ValueError(msg)
+    return linked | id2paths
+
+
+async def iter_fetch_async(
+    ids: Iterable[str],
+    save_dir: Path,
+    max_parallel_downloads: int = 5,
+    session: FriendlyClient | None = None,
+    mirror_dir: Path | None = None,
+) -> AsyncGenerator[tuple[str, Path]]:
+    """Asynchronously fetches mmCIF files from the PDBe database, yielding each file as soon as it is downloaded.
+
+    Args:
+        ids: A set of PDB IDs to fetch.
+        save_dir: The directory to save the fetched mmCIF files to.
+        max_parallel_downloads: The maximum number of parallel downloads.
+        session: Session to download with. If None, a new session is created.
+        mirror_dir: Directory of a wwPDB mirror with divided mmCIF files.
+            Files in the mirror are linked into `save_dir`, only missing files are downloaded.
+
+    Yields:
+        Tuples of PDB ID and path to the mmCIF file, first the linked files
+        and then the downloaded files in the order they finished downloading.
+    """
+    if mirror_dir is not None:
+        linked, ids = await asyncio.to_thread(link_from_pdb_mirror, ids, mirror_dir, save_dir)
+        for item in linked.items():
+            yield item
+    id2urls = {pdb_id: _map_id_mmcif(pdb_id) for pdb_id in ids}
+    fn2id = {fn: pdb_id for pdb_id, (_, fn) in id2urls.items()}
+    async for path in iter_retrieve_files(
+        id2urls.values(), save_dir, max_parallel_downloads, desc="Downloading PDBe mmCIF files", session=session
+    ):
+        yield fn2id[path.name], path
+
+
+def fetch(
+    ids: Iterable[str], save_dir: Path, max_parallel_downloads: int = 5, mirror_dir: Path | None = None
+) -> Mapping[str, Path]:
+    """Fetches mmCIF files from the PDBe database.
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(run_async_task)
-        result = future.result()
-        if set(result) != set(id2paths.values()):
-            msg = "Not all files were downloaded successfully."
-            raise ValueError(msg)
-        return id2paths
+    Args:
+        ids: A set of PDB IDs to fetch.
+        save_dir: The directory to save the fetched mmCIF files to.
+        max_parallel_downloads: The maximum number of parallel downloads.
+        mirror_dir: Directory of a wwPDB mirror with divided mmCIF files.
+            Files in the mirror are linked into `save_dir`, only missing files are downloaded.
+
+    Returns:
+        A dict of id and paths to the downloaded mmCIF files.
+    """
+    return run_async(fetch_async(ids, save_dir, max_parallel_downloads, mirror_dir=mirror_dir))
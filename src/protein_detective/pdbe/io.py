@@ -1,10 +1,10 @@
 import logging
-from collections.abc import Generator
+from collections.abc import Generator, Mapping
 from dataclasses import dataclass
 from pathlib import Path
 
-import atomium
-from tqdm import tqdm
+from protein_detective.instrumentation import timed
+from protein_detective.packed import PackedStore
 
 logger = logging.getLogger(__name__)
 
@@ -32,8 +32,13 @@ def first_chain_from_uniprot_chains(uniprot_chains: str) -> str:
     return parts[0]
 
 
+@timed
 def write_single_chain_pdb_file(
-    mmcif_file: Path | str, chain2keep: str, output_file: Path | str, out_chain: str = "A"
+    mmcif_file: Path | str,
+    chain2keep: str,
+    output_file: Path | str,
+    out_chain: str = "A",
+    store: PackedStore | None = None,
 ) -> None:
     """Saves a specific protein chain from a mmCIF file to a new PDB file.
 
@@ -42,15 +47,23 @@ def write_single_chain_pdb_file(
         chain2keep: Chain to keep.
         output_file: Path to the output PDB file.
         out_chain: Chain identifier for the saved chain in the output file..
+        store: Store to read and write packed files with. If None, files are read from and written to disk.
     """
     logger.info(
         'From %s taking chain "%s" and saving as "%s" with chain %s.', mmcif_file, chain2keep, output_file, out_chain
     )
-    pdb = atomium.open(str(mmcif_file))
+    # slow to import, only needed here
+    from atomium.pdb import structure_to_pdb_string  # noqa: PLC0415
+    from atomium.utilities import parse_string  # noqa: PLC0415
+
+    if store is None:
+        store = PackedStore(Path())
+    mmcif_file = Path(mmcif_file)
+    with store.open_text(mmcif_file) as f:
+        pdb = parse_string(f.read(), str(mmcif_file).removesuffix(".gz"))
     # pyrefly: ignore  # noqa: ERA001
-    pdb.model.chain(chain2keep).copy(out_chain).save(
-        str(output_file),
-    )
+    chain = pdb.model.chain(chain2keep).copy(out_chain)
+    store.write_text(Path(output_file), structure_to_pdb_string(chain))
     # TODO use less diskspace, save gzipped and make powerfit work with it
 
 
@@ -80,17 +93,22 @@ class SingleChainResult:
         pdb_id: The PDB ID of the entry.
         output_file: The path to the output PDB file with
             just the first chain (renamed to A) belonging to given Uniprot accession.
+        fingerprint: Fingerprint of the mmCIF file and chain the output file was written from,
+            or None if an existing output file was kept.
     """
 
     uniprot_acc: str
     pdb_id: str
     output_file: Path
+    fingerprint: str | None = None
 
 
 def write_single_chain_pdb_files(
     proteinpdbs: list[ProteinPdbRow],
     session_dir: Path,
     single_chain_dir: Path,
+    store: PackedStore | None = None,
+    fingerprints: Mapping[Path, str] | None = None,
 ) -> Generator[SingleChainResult]:
     """Writes single chain PDB files from the provided protein PDB rows.
 
@@ -98,35 +116,87 @@ def write_single_chain_pdb_files(
         proteinpdbs: A list of ProteinPdbRow objects.
         session_dir: The directory where the session files are stored.
         single_chain_dir: The directory where the single chain PDB files will be saved.
+        store: Store to read and write packed files with. If None, files are read from and written to disk.
+        fingerprints: Fingerprints of existing single chain PDB files, by path.
+            If given, a file is written unless it exists with the fingerprint it would be written with.
+            If None, existing files are never written again.
 
     Yields:
         SingleChainResult objects containing the UniProt accession, PDB ID, and output file path.
     """
+    from tqdm import tqdm  # noqa: PLC0415 slow to import, only needed here
+
     for proteinpdb in tqdm(proteinpdbs, desc="Saving single chain PDB files from PDBe"):
-        if not proteinpdb.mmcif_file:
-            logger.warning(
-                "Skipping %s, because it does not have a file.",
-                proteinpdb.id,
-            )
-            continue
-        mmcif_file = session_dir / proteinpdb.mmcif_file
-        uniprot_chains = proteinpdb.uniprot_chains
-        chain2keep = first_chain_from_uniprot_chains(uniprot_chains)
-        uniprot_acc = proteinpdb.uniprot_acc
-        output_file = single_chain_dir / f"{uniprot_acc}_{mmcif_file.stem}_{chain2keep}2A.pdb"
-        if output_file.exists():
-            logger.info(
-                f"Output file {output_file} already exists. Skipping saving single chain PDB file for {mmcif_file}.",
-            )
-            yield SingleChainResult(
-                uniprot_acc=uniprot_acc,
-                pdb_id=proteinpdb.id,
-                output_file=output_file.relative_to(session_dir),
-            )
-            continue
-        write_single_chain_pdb_file(mmcif_file, chain2keep, output_file)
-        yield SingleChainResult(
-            uniprot_acc=uniprot_acc,
-            pdb_id=proteinpdb.id,
-            output_file=output_file.relative_to(session_dir),
+        result = write_single_chain_pdb_file_for_row(proteinpdb, session_dir, single_chain_dir, store, fingerprints)
+        if result is not None:
+            yield result
+
+
+def single_chain_pdb_file(mmcif_file: Path, chain2keep: str, uniprot_acc: str, single_chain_dir: Path) -> Path:
+    """Path of the single chain PDB file written from a mmCIF file.
+
+    Args:
+        mmcif_file: The mmCIF file, which may be gzipped.
+        chain2keep: The chain that is kept.
+        uniprot_acc: The UniProt accession the chain belongs to.
+        single_chain_dir: The directory where the single chain PDB files are saved.
+
+    Returns:
+        The path, like `single_chain_dir / "P12345_1abc_B2A.pdb"`.
+    """
+    # mmCIF files from a mirror are named like 8was.cif.gz
+    pdb_name = Path(mmcif_file.name.removesuffix(".gz")).stem
+    return single_chain_dir / f"{uniprot_acc}_{pdb_name}_{chain2keep}2A.pdb"
+
+
+def write_single_chain_pdb_file_for_row(
+    proteinpdb: ProteinPdbRow,
+    session_dir: Path,
+    single_chain_dir: Path,
+    store: PackedStore | None = None,
+    fingerprints: Mapping[Path, str] | None = None,
+) -> SingleChainResult | None:
+    """Writes a single chain PDB file for a protein PDB row.
+
+    Args:
+        proteinpdb: The protein PDB row.
+        session_dir: The directory where the session files are stored.
+        single_chain_dir: The directory where the single chain PDB file will be saved.
+        store: Store to read and write packed files with. If None, files are read from and written to disk.
+        fingerprints: Fingerprints of existing single chain PDB files, by path.
+            If given, the file is written unless it exists with the fingerprint it would be written with.
+            If None, an existing file is never written again.
+
+    Returns:
+        The written single chain PDB file, or None if the row does not have a mmCIF file.
+    """
+    if not proteinpdb.mmcif_file:
+        logger.warning(
+            "Skipping %s, because it does not have a file.",
+            proteinpdb.id,
         )
+        return None
+    mmcif_file = session_dir / proteinpdb.mmcif_file
+    uniprot_chains = proteinpdb.uniprot_chains
+    chain2keep = first_chain_from_uniprot_chains(uniprot_chains)
+    uniprot_acc = proteinpdb.uniprot_acc
+    output_file = single_chain_pdb_file(mmcif_file, chain2keep, uniprot_acc, single_chain_dir)
+    if store is None:
+        store = PackedStore(session_dir)
+    fingerprint: str | None = f"{store.fingerprint(mmcif_file)};chain={chain2keep}"
+    if fingerprints is None and store.exists(output_file):
+        logger.info(
+            f"Output file {output_file} already exists. Skipping saving single chain PDB file for {mmcif_file}.",
+        )
+        # An existing file of unknown origin was kept
+        fingerprint = None
+    elif fingerprints is not None and fingerprints.get(output_file) == fingerprint and store.exists(output_file):
+        logger.info(f"Output file {output_file} is up to date. Skipping saving single chain PDB file for {mmcif_file}.")
+    else:
+        write_single_chain_pdb_file(mmcif_file, chain2keep, output_file, store=store)
+    return SingleChainResult(
+        uniprot_acc=uniprot_acc,
+        pdb_id=proteinpdb.id,
+        output_file=output_file.relative_to(session_dir),
+        fingerprint=fingerprint,
+    )
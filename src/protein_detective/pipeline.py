@@ -0,0 +1,492 @@
+"""Run the whole workflow with the stages overlapping.
+
+Instead of waiting for all downloads to finish before density filtering or pruning,
+each structure goes to the next stage as soon as it is downloaded:
+
+- an AlphaFold PDB file is density filtered as soon as it lands,
+- a PDBe mmCIF file is pruned to a single chain as soon as it lands.
+
+Downloaded structures wait in a bounded queue for a worker,
+so downloading pauses when the CPU bound work can not keep up.
+The CPU bound work runs on a process pool and all results are saved by a single
+[SessionWriter][protein_detective.writer.SessionWriter].
+The UniProt search is a few bulk queries, so it finishes before the downloads start.
+Structures that are already retrieved and packed are not downloaded again, but go straight to the next stage.
+Structures whose file did not change since a previous run of the same density filter are not filtered again,
+and output files are only written again when they are out of date,
+like [density_filter][protein_detective.workflow.density_filter] and
+[prune_pdbs][protein_detective.workflow.prune_pdbs] do.
+"""
+
+import asyncio
+import os
+from collections import defaultdict, deque
+from collections.abc import AsyncIterable, Callable, Mapping
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, replace
+from functools import partial
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any
+
+from protein_detective.alphafold import AlphaFoldEntry, DownloadableFormat
+from protein_detective.alphafold import relative_to as af_relative_to
+from protein_detective.alphafold.density import (
+    DensityFilterQuery,
+    DensityFilterResult,
+    density_filtered_file,
+    filter_on_density,
+)
+from protein_detective.alphafold.fetch import iter_fetch_async as af_iter_fetch_async
+from protein_detective.db import (
+    load_alphafold_ids,
+    load_density_filter_results,
+    load_output_fingerprints,
+    load_packed_files,
+    load_pdbs,
+    save_alphafolds_files,
+    save_density_filtered,
+    save_pdb_files,
+    save_single_chain_pdb_files,
+)
+from protein_detective.packed import PackedFile, PackedStore
+from protein_detective.pdbe.fetch import iter_fetch_async as pdbe_iter_fetch_async
+from protein_detective.pdbe.io import (
+    ProteinPdbRow,
+    SingleChainResult,
+    first_chain_from_uniprot_chains,
+    single_chain_pdb_file,
+    write_single_chain_pdb_file_for_row,
+)
+from protein_detective.uniprot import Query
+from protein_detective.utils import FriendlyClient, reuse_session, run_async
+from protein_detective.workflow import (
+    SearchBackend,
+    WhatRetrieve,
+    _changed_alphafolds,
+    density_filtered_dir_of,
+    load_packed_retrieved,
+    search_structures_in_uniprot,
+    what_retrieve_choices,
+)
+from protein_detective.writer import SessionWriter, reuse_writer
+
+
+@dataclass
+class RunResult:
+    """Stats of a pipelined run.
+
+    Parameters:
+        nr_mmcif_files: The number of PDBe mmCIF files downloaded.
+        nr_single_chain_files: The number of single chain PDB files written.
+        nr_afs: The number of AlphaFold entries downloaded.
+        nr_kept: The number of AlphaFold structures that were kept after density filtering.
+        nr_discarded: The number of AlphaFold structures that were discarded after density filtering.
+        nr_unchanged: The number of kept or discarded AlphaFold structures that were not filtered again,
+            because their structure file did not change since the previous run of the same density filter.
+    """
+
+    nr_mmcif_files: int = 0
+    nr_single_chain_files: int = 0
+    nr_afs: int = 0
+    nr_kept: int = 0
+    nr_discarded: int = 0
+    nr_unchanged: int = 0
+
+
+def run_pipeline(
+    session_dir: Path,
+    density_query: DensityFilterQuery,
+    query: Query | None = None,
+    limit: int = 10_000,
+    what: set[WhatRetrieve] | None = None,
+    what_af_formats: set[DownloadableFormat] | None = None,
+    max_parallel_downloads: int = 5,
+    max_workers: int | None = None,
+    queue_size: int = 100,
+    pdb_mirror: Path | None = None,
+    alphafold_mirror: Path | None = None,
+    eager: bool = False,
+    go_ontology: Path | None = None,
+    search_backend: SearchBackend = "sparql",
+) -> RunResult:
+    """Search, retrieve, density filter and prune a session with the stages overlapping.
+
+    Synchronous wrapper around [run_pipeline_async][protein_detective.pipeline.run_pipeline_async].
+
+    Args:
+        session_dir: The directory to store downloaded files and the session database.
+        density_query: The density filter query containing the confidence thresholds.
+        query: The search query. If None, the structures already found in the session are used.
+        limit: The maximum number of results to return from each database query.
+        what: Which databases to retrieve files from. Default is pdbe and alphafold.
+        what_af_formats: Formats to download from AlphaFold. The pdb format is always downloaded,
+            as it is needed for density filtering.
+        max_parallel_downloads: The maximum number of parallel downloads per host.
+        max_workers: The number of worker processes for density filtering and pruning.
+            Default is number of CPUs.
+        queue_size: The maximum number of downloaded structures waiting for a worker per stage.
+        pdb_mirror: Directory of a wwPDB mirror with divided mmCIF files, to link PDBe files from.
+        alphafold_mirror: Directory with AlphaFold files, to link AlphaFold files from.
+        eager: Write the density filtered structures while filtering,
+            instead of when they are materialized with [materialize][protein_detective.workflow.materialize].
+        go_ontology: Local copy of the Gene Ontology, to search GO terms of the query as a list of terms.
+        search_backend: How to search UniProt, see
+            [search_structures_in_uniprot][protein_detective.workflow.search_structures_in_uniprot].
+
+    Returns:
+        Stats of the run.
+    """
+    return run_async(
+        run_pipeline_async(
+            session_dir,
+            density_query,
+            query=query,
+            limit=limit,
+            what=what,
+            what_af_formats=what_af_formats,
+            max_parallel_downloads=max_parallel_downloads,
+            max_workers=max_workers,
+            queue_size=queue_size,
+            pdb_mirror=pdb_mirror,
+            alphafold_mirror=alphafold_mirror,
+            eager=eager,
+            go_ontology=go_ontology,
+            search_backend=search_backend,
+        )
+    )
+
+
+async def run_pipeline_async(
+    session_dir: Path,
+    density_query: DensityFilterQuery,
+    query: Query | None = None,
+    limit: int = 10_000,
+    what: set[WhatRetrieve] | None = None,
+    what_af_formats: set[DownloadableFormat] | None = None,
+    max_parallel_downloads: int = 5,
+    max_workers: int | None = None,
+    queue_size: int = 100,
+    session: FriendlyClient | None = None,
+    writer: SessionWriter | None = None,
+    executor: Executor | None = None,
+    pdb_mirror: Path | None = None,
+    alphafold_mirror: Path | None = None,
+    eager: bool = False,
+    go_ontology: Path | None = None,
+    search_backend: SearchBackend = "sparql",
+) -> RunResult:
+    """Search, retrieve, density filter and prune a session with the stages overlapping.
+
+    Args:
+        session_dir: The directory to store downloaded files and the session database.
+        density_query: The density filter query containing the confidence thresholds.
+        query: The search query. If None, the structures already found in the session are used.
+        limit: The maximum number of results to return from each database query.
+        what: Which databases to retrieve files from. Default is pdbe and alphafold.
+        what_af_formats: Formats to download from AlphaFold. The pdb format is always downloaded,
+            as it is needed for density filtering.
+        max_parallel_downloads: The maximum number of parallel downloads per host.
+        max_workers: The number of worker processes for density filtering and pruning.
+            Default is number of CPUs. Ignored when `executor` is given.
+        queue_size: The maximum number of downloaded structures waiting for a worker per stage.
+        session: HTTP session to download with. If None, a new session is created.
+        writer: Writer of the session database. If None, a writer is opened for this run.
+        executor: Executor for the CPU bound work. If None, a process pool is created for this run.
+        pdb_mirror: Directory of a wwPDB mirror with divided mmCIF files, to link PDBe files from.
+        alphafold_mirror: Directory with AlphaFold files, to link AlphaFold files from.
+        eager: Write the density filtered structures while filtering,
+            instead of when they are materialized with [materialize][protein_detective.workflow.materialize].
+        go_ontology: Local copy of the Gene Ontology, to search GO terms of the query as a list of terms.
+        search_backend: How to search UniProt, see
+            [search_structures_in_uniprot][protein_detective.workflow.search_structures_in_uniprot].
+
+    Returns:
+        Stats of the run.
+
+    Raises:
+        ValueError: If `what` contains an unknown database.
+    """
+    if what is None:
+        what = {"pdbe", "alphafold"}
+    if not (what <= what_retrieve_choices):
+        msg = f"Invalid 'what' argument: {what}. Must be a subset of {what_retrieve_choices}."
+        raise ValueError(msg)
+    what_af_formats = (what_af_formats or set()) | {"pdb"}
+    session_dir.mkdir(parents=True, exist_ok=True)
+
+    with ExitStack() as stack:
+        session_writer = stack.enter_context(reuse_writer(session_dir, writer))
+        if executor is None:
+            # The writer and HTTP stack run threads, which are not safe to fork
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers, mp_context=get_context("forkserver")))
+        nr_workers = max_workers or os.process_cpu_count() or 1
+
+        if query is not None:
+            await asyncio.to_thread(
+                search_structures_in_uniprot,
+                query,
+                session_dir,
+                limit,
+                session_writer,
+                go_ontology=go_ontology,
+                backend=search_backend,
+            )
+        with session_writer.reader() as con:
+            pdb_rows = load_pdbs(con) if "pdbe" in what else []
+            af_ids = load_alphafold_ids(con) if "alphafold" in what else set()
+            packed_files = load_packed_files(con)
+            packed_mmcif_files, packed_afs = load_packed_retrieved(what_af_formats, con)
+            fingerprints = load_output_fingerprints(con)
+            previous = load_density_filter_results(density_query, con)
+        store = stack.enter_context(PackedStore(session_dir, packed_files))
+
+        run = _Run(session_dir, session_writer, executor, nr_workers, queue_size, store, fingerprints)
+        async with (
+            reuse_session(session, max_parallel_per_host=max_parallel_downloads) as client,
+            asyncio.TaskGroup() as tg,
+        ):
+            tg.create_task(run.pdbe(pdb_rows, packed_mmcif_files, max_parallel_downloads, client, pdb_mirror))
+            tg.create_task(
+                run.alphafold(
+                    af_ids,
+                    packed_afs,
+                    what_af_formats,
+                    density_query,
+                    previous,
+                    eager,
+                    max_parallel_downloads,
+                    client,
+                    alphafold_mirror,
+                )
+            )
+        await asyncio.gather(*(asyncio.wrap_future(saved) for saved in run.saved))
+        return run.result
+
+
+@dataclass(frozen=True)
+class _Files:
+    """Packed files and output fingerprints of the files a worker reads or writes for one structure.
+
+    Parameters:
+        packed_files: The packed files.
+        fingerprints: Fingerprints of the output files, by path.
+    """
+
+    packed_files: list[PackedFile]
+    fingerprints: dict[Path, str]
+
+
+class _Run:
+    """Streams downloaded structures of a session through the CPU bound stages."""
+
+    def __init__(
+        self,
+        session_dir: Path,
+        writer: SessionWriter,
+        executor: Executor,
+        nr_workers: int,
+        queue_size: int,
+        store: PackedStore,
+        fingerprints: Mapping[Path, str],
+    ):
+        self.session_dir = session_dir
+        self.writer = writer
+        self.executor = executor
+        self.nr_workers = nr_workers
+        self.queue_size = queue_size
+        self.store = store
+        self.fingerprints = fingerprints
+        self.download_dir = session_dir / "downloads"
+        self.saved: deque[Future] = deque()
+        self.result = RunResult()
+
+    def _files_for(self, *paths: Path) -> _Files:
+        """The packed files and output fingerprints of the session relative paths a worker reads or writes.
+
+        Workers get only these, as sending those of the whole session with every structure is slow.
+        """
+        return _Files(
+            packed_files=[self.store.index[path] for path in paths if path in self.store.index],
+            fingerprints={
+                self.session_dir / path: self.fingerprints[path] for path in paths if path in self.fingerprints
+            },
+        )
+
+    def _save(self, save: Callable[..., Any], *args: Any):
+        """Submit a save to the writer.
+
+        Only saves that are not done yet are kept, so memory does not grow with the number of structures.
+        The writer does saves in order, so done saves are dropped from the front.
+        Done saves are checked, so a failed save fails the run.
+        """
+        while self.saved and self.saved[0].done():
+            self.saved.popleft().result()
+        self.saved.append(self.writer.submit(save, *args))
+
+    def _to_prune(self, rows: list[ProteinPdbRow], mmcif_file: Path, single_chain_dir: Path):
+        """The rows of a retrieved PDB entry with the files to prune them with."""
+        for row in rows:
+            chain2keep = first_chain_from_uniprot_chains(row.uniprot_chains)
+            output_file = single_chain_pdb_file(mmcif_file, chain2keep, row.uniprot_acc, single_chain_dir)
+            files = self._files_for(mmcif_file, output_file.relative_to(self.session_dir))
+            yield replace(row, mmcif_file=mmcif_file), files
+
+    async def pdbe(
+        self,
+        pdb_rows: list[ProteinPdbRow],
+        packed_mmcif_files: Mapping[str, Path],
+        max_parallel_downloads: int,
+        client: FriendlyClient,
+        mirror_dir: Path | None,
+    ):
+        single_chain_dir = self.session_dir / "single_chain"
+        single_chain_dir.mkdir(parents=True, exist_ok=True)
+        rows_of_pdb: dict[str, list[ProteinPdbRow]] = defaultdict(list)
+        for row in pdb_rows:
+            rows_of_pdb[row.id].append(row)
+
+        async def downloaded_rows():
+            packed = {pdb_id: file for pdb_id, file in packed_mmcif_files.items() if pdb_id in rows_of_pdb}
+            for pdb_id, mmcif_file in packed.items():
+                for item in self._to_prune(rows_of_pdb[pdb_id], mmcif_file, single_chain_dir):
+                    yield item
+            downloads = pdbe_iter_fetch_async(
+                rows_of_pdb.keys() - packed.keys(),
+                self.download_dir,
+                max_parallel_downloads,
+                session=client,
+                mirror_dir=mirror_dir,
+            )
+            async for pdb_id, downloaded_file in downloads:
+                mmcif_file = downloaded_file.relative_to(self.session_dir)
+                self._save(save_pdb_files, {pdb_id: mmcif_file})
+                self.result.nr_mmcif_files += 1
+                for item in self._to_prune(rows_of_pdb[pdb_id], mmcif_file, single_chain_dir):
+                    yield item
+
+        def save(file: SingleChainResult | None):
+            if file is None:
+                return
+            self._save(save_single_chain_pdb_files, [file])
+            self.result.nr_single_chain_files += 1
+
+        prune = partial(_prune_one, session_dir=self.session_dir, single_chain_dir=single_chain_dir)
+        await self._stage(downloaded_rows(), prune, save)
+
+    async def alphafold(
+        self,
+        af_ids: set[str],
+        packed_afs: Mapping[str, AlphaFoldEntry],
+        what_af_formats: set[DownloadableFormat],
+        density_query: DensityFilterQuery,
+        previous: Mapping[str, DensityFilterResult],
+        eager: bool,
+        max_parallel_downloads: int,
+        client: FriendlyClient,
+        mirror_dir: Path | None,
+    ):
+        density_filtered_dir = density_filtered_dir_of(self.session_dir, density_query)
+        density_filtered_dir.mkdir(parents=True, exist_ok=True)
+
+        def to_filter(entry: AlphaFoldEntry):
+            if entry.pdb_file is None:
+                return None
+            _, unchanged = _changed_alphafolds(
+                [entry], density_query, self.session_dir, self.store, eager, previous, self.fingerprints
+            )
+            if unchanged:
+                self.result.nr_unchanged += 1
+                self._count_filtered(unchanged[0])
+                return None
+            output_file = density_filtered_file(entry.pdb_file, density_filtered_dir.relative_to(self.session_dir))
+            return entry, self._files_for(entry.pdb_file, output_file)
+
+        async def downloaded_entries():
+            packed = {uniprot_acc: entry for uniprot_acc, entry in packed_afs.items() if uniprot_acc in af_ids}
+            for entry in packed.values():
+                if (item := to_filter(entry)) is not None:
+                    yield item
+            downloads = af_iter_fetch_async(
+                af_ids - packed.keys(),
+                self.download_dir,
+                what=what_af_formats,
+                max_parallel_downloads=max_parallel_downloads,
+                session=client,
+                mirror_dir=mirror_dir,
+            )
+            async for downloaded_entry in downloads:
+                entry = af_relative_to(downloaded_entry, self.session_dir)
+                self._save(save_alphafolds_files, [entry])
+                self.result.nr_afs += 1
+                if (item := to_filter(entry)) is not None:
+                    yield item
+
+        def save(filtered: tuple[str, DensityFilterResult]):
+            uniprot_acc, result = filtered
+            self._save(save_density_filtered, density_query, [result], [uniprot_acc])
+            self._count_filtered(result)
+
+        filter_one = partial(
+            _density_filter_one,
+            query=density_query,
+            session_dir=self.session_dir,
+            density_filtered_dir=density_filtered_dir,
+            eager=eager,
+        )
+        await self._stage(downloaded_entries(), filter_one, save)
+
+    def _count_filtered(self, result: DensityFilterResult):
+        if result.density_filtered_file is None:
+            self.result.nr_discarded += 1
+        else:
+            self.result.nr_kept += 1
+
+    async def _stage[T, R](self, items: AsyncIterable[T], work: Callable[[T], R], save: Callable[[R], None]):
+        """Run `work` on the executor for each item as soon as it arrives and save its result."""
+        queue: asyncio.Queue[T] = asyncio.Queue(self.queue_size)
+        loop = asyncio.get_running_loop()
+
+        async def worker():
+            while True:
+                try:
+                    item = await queue.get()
+                except asyncio.QueueShutDown:
+                    return
+                save(await loop.run_in_executor(self.executor, work, item))
+
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(self.nr_workers):
+                tg.create_task(worker())
+            async for item in items:
+                await queue.put(item)
+            queue.shutdown()
+
+
+def _prune_one(
+    item: tuple[ProteinPdbRow, _Files], session_dir: Path, single_chain_dir: Path
+) -> SingleChainResult | None:
+    row, files = item
+    with PackedStore(session_dir, files.packed_files) as store:
+        return write_single_chain_pdb_file_for_row(row, session_dir, single_chain_dir, store, files.fingerprints)
+
+
+def _density_filter_one(
+    item: tuple[AlphaFoldEntry, _Files],
+    query: DensityFilterQuery,
+    session_dir: Path,
+    density_filtered_dir: Path,
+    eager: bool,
+) -> tuple[str, DensityFilterResult]:
+    entry, files = item
+    if entry.pdb_file is None:
+        msg = f"AlphaFold entry {entry.uniprot_acc} has no PDB file"
+        raise ValueError(msg)
+    with PackedStore(session_dir, files.packed_files) as store:
+        [result] = filter_on_density(
+            [session_dir / entry.pdb_file], query, density_filtered_dir, store, eager, files.fingerprints
+        )
+    if result.density_filtered_file is not None:
+        result.density_filtered_file = result.density_filtered_file.relative_to(session_dir)
+    return entry.uniprot_acc, result
@@ -0,0 +1,164 @@
+"""Estimate the size of a search and retrieval before running it.
+
+Counts come from COUNT variants of the search queries, see [count4search][protein_detective.uniprot.count4search].
+File sizes are estimated from a small sample of the search,
+with HEAD requests for the files that would be downloaded.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from statistics import mean
+
+from protein_detective.alphafold.fetch import fetch_summmary
+from protein_detective.gene_ontology import load_go_ontology
+from protein_detective.pdbe.fetch import _map_id_mmcif
+from protein_detective.uniprot import Query, SearchCounts, count4search, search4af, search4pdb, search4uniprot
+from protein_detective.utils import FriendlyClient, reuse_session, run_async
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SearchPlan:
+    """Expected size of a search and the retrieval of its structures.
+
+    Parameters:
+        counts: Number of results of the search when it is not limited.
+        limit: The limit of each query of the search.
+        pdb_file_size: Mean size in bytes of the sampled PDBe mmCIF files, None if none could be sampled.
+        alphafold_file_size: Mean size in bytes of the sampled AlphaFold pdb files, None if none could be sampled.
+    """
+
+    counts: SearchCounts
+    limit: int
+    pdb_file_size: float | None
+    alphafold_file_size: float | None
+
+    @property
+    def truncated(self) -> list[str]:
+        """Which queries of the search return more results than the limit."""
+        return [
+            what
+            for what, count in [
+                ("uniprot", self.counts.nr_uniprot),
+                ("pdb", self.counts.nr_pdb_rows),
+                ("alphafold", self.counts.nr_alphafolds),
+            ]
+            if count > self.limit
+        ]
+
+    @property
+    def pdb_bytes(self) -> int | None:
+        """Expected number of bytes to retrieve from PDBe."""
+        if self.pdb_file_size is None:
+            return None
+        return round(min(self.counts.nr_pdbs, self.limit) * self.pdb_file_size)
+
+    @property
+    def alphafold_bytes(self) -> int | None:
+        """Expected number of bytes to retrieve from AlphaFold."""
+        if self.alphafold_file_size is None:
+            return None
+        return round(min(self.counts.nr_alphafolds, self.limit) * self.alphafold_file_size)
+
+
+async def _content_length(url: str, session: FriendlyClient) -> int | None:
+    try:
+        async with session.limiter.limit(url), session.head(url, allow_redirects=True) as response:
+            response.raise_for_status()
+            return response.content_length
+    except Exception:  # a failed sample should not fail the plan
+        logger.warning("Could not get size of %s", url, exc_info=True)
+        return None
+
+
+async def _pdb_file_sizes(pdb_ids: set[str], session: FriendlyClient) -> list[int]:
+    sizes = await asyncio.gather(*(_content_length(_map_id_mmcif(pdb_id)[0], session) for pdb_id in sorted(pdb_ids)))
+    return [size for size in sizes if size is not None]
+
+
+async def _alphafold_file_size(uniprot_acc: str, session: FriendlyClient, semaphore: asyncio.Semaphore) -> int | None:
+    try:
+        summaries = await fetch_summmary(uniprot_acc, session, semaphore)
+    except Exception:  # a failed sample should not fail the plan
+        logger.warning("Could not get AlphaFold summary of %s", uniprot_acc, exc_info=True)
+        return None
+    if not summaries:
+        return None
+    return await _content_length(summaries[0].pdbUrl, session)
+
+
+async def _alphafold_file_sizes(
+    uniprot_accs: set[str], max_parallel_downloads: int, session: FriendlyClient
+) -> list[int]:
+    semaphore = asyncio.Semaphore(max_parallel_downloads)
+    sizes = await asyncio.gather(*(_alphafold_file_size(acc, session, semaphore) for acc in sorted(uniprot_accs)))
+    return [size for size in sizes if size is not None]
+
+
+async def plan_search_async(
+    query: Query,
+    limit: int = 10_000,
+    sample_size: int = 10,
+    max_parallel_downloads: int = 5,
+    go_ontology: Path | None = None,
+    session: FriendlyClient | None = None,
+) -> SearchPlan:
+    """Estimate how many results a search finds and how many bytes retrieving its structures downloads.
+
+    Args:
+        query: The search query.
+        limit: The maximum number of results to return from each database query of the search.
+        sample_size: Number of UniProt accessions to sample, to estimate file sizes with.
+            The sizes of at most this many files per database are requested.
+        max_parallel_downloads: The maximum number of parallel requests per host.
+        go_ontology: Local copy of the Gene Ontology, to search GO terms of the query as a list of terms.
+        session: HTTP session to make requests with. If None, a new session is created.
+
+    Returns:
+        The plan.
+    """
+    ontology = None if go_ontology is None else load_go_ontology(go_ontology)
+    counts = await asyncio.to_thread(count4search, query, go_ontology=ontology)
+
+    sample = await asyncio.to_thread(search4uniprot, query, sample_size, go_ontology=ontology)
+    pdbs = await asyncio.to_thread(search4pdb, sample) if sample else {}
+    afs = await asyncio.to_thread(search4af, sample) if sample else {}
+    pdb_ids = sorted({pdb.id for results in pdbs.values() for pdb in results})[:sample_size]
+
+    async with reuse_session(session, max_parallel_per_host=max_parallel_downloads) as client:
+        pdb_sizes = await _pdb_file_sizes(set(pdb_ids), client)
+        af_sizes = await _alphafold_file_sizes(set(afs), max_parallel_downloads, client)
+
+    return SearchPlan(
+        counts=counts,
+        limit=limit,
+        pdb_file_size=mean(pdb_sizes) if pdb_sizes else None,
+        alphafold_file_size=mean(af_sizes) if af_sizes else None,
+    )
+
+
+def plan_search(
+    query: Query,
+    limit: int = 10_000,
+    sample_size: int = 10,
+    max_parallel_downloads: int = 5,
+    go_ontology: Path | None = None,
+) -> SearchPlan:
+    """Estimate how many results a search finds and how many bytes retrieving its structures downloads.
+
+    Synchronous wrapper around [plan_search_async][protein_detective.plan.plan_search_async].
+
+    Args:
+        query: The search query.
+        limit: The maximum number of results to return from each database query of the search.
+        sample_size: Number of UniProt accessions to sample, to estimate file sizes with.
+        max_parallel_downloads: The maximum number of parallel requests per host.
+        go_ontology: Local copy of the Gene Ontology, to search GO terms of the query as a list of terms.
+
+    Returns:
+        The plan.
+    """
+    return run_async(plan_search_async(query, limit, sample_size, max_parallel_downloads, go_ontology))
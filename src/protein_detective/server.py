@@ -0,0 +1,430 @@
+"""Long running server that accepts workflow steps as jobs.
+
+Keeps warm state between jobs, so submitting many small sessions does not pay
+the cold start of a CLI invocation for each one:
+
+- heavy libraries are imported once,
+- a single HTTP session with its connection pool and per host limiter is shared by all retrieve jobs,
+- a process pool with warmed up workers runs the CPU bound work of density-filter and prune-pdbs jobs,
+- a thread pool runs the blocking search jobs.
+
+Jobs run concurrently, also jobs on the same session directory.
+The server owns a [SessionWriter][protein_detective.writer.SessionWriter] for each session with running jobs,
+which all jobs of the session save their results with, so the server is the one process that opens the session database.
+Worker processes return their results to the server instead of opening the database.
+DuckDB does not allow other processes to open the database of a session while it has running jobs,
+so submit work on such a session as a job instead of running the CLI on it.
+
+Submit a job with `POST /jobs` and a JSON body like:
+
+```json
+{"command": "density-filter", "session_dir": "./mysession", "options": {"confidence_threshold": 50}}
+```
+
+The option names are the same as the long options of the CLI subcommand, with dashes replaced by underscores.
+The server answers with status 202 and the id of the job, without waiting for the job to finish.
+Get the status of the job, and its result or error when it is done, with `GET /jobs/{id}`.
+"""
+
+import asyncio
+import uuid
+from collections import Counter, deque
+from collections.abc import AsyncIterator, Awaitable, Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import timedelta
+from functools import partial
+from pathlib import Path
+from typing import Any, Literal
+
+from aiohttp import web
+
+from protein_detective.alphafold.density import DensityFilterQuery
+from protein_detective.uniprot import Query
+from protein_detective.utils import FriendlyClient, friendly_session
+from protein_detective.workflow import (
+    density_filter,
+    prune_pdbs,
+    retrieve_structures_async,
+    search_backend_choices,
+    search_structures_in_uniprot,
+    what_retrieve_choices,
+)
+from protein_detective.writer import SessionWriter
+
+type JobResult = dict[str, Any]
+type Job = Callable[["WarmState", SessionWriter], Awaitable[JobResult]]
+type JobStatus = Literal["running", "done", "failed"]
+
+
+@dataclass
+class JobRecord:
+    """A submitted job.
+
+    Parameters:
+        id: The id of the job.
+        command: The command of the job.
+        session_dir: The session directory of the job.
+        status: Whether the job is running, done or failed.
+        result: The result of the job, when it is done.
+        error: The error of the job, when it failed.
+    """
+
+    id: str
+    command: str
+    session_dir: Path
+    status: JobStatus = "running"
+    result: JobResult | None = None
+    error: str | None = None
+
+    def to_json(self) -> dict[str, Any]:
+        """The job as a JSON response body, with the result or error only when the job has one."""
+        body: dict[str, Any] = {
+            "id": self.id,
+            "command": self.command,
+            "session_dir": str(self.session_dir),
+            "status": self.status,
+        }
+        if self.result is not None:
+            body["result"] = self.result
+        if self.error is not None:
+            body["error"] = self.error
+        return body
+
+
+@dataclass
+class WarmState:
+    """State that is kept between jobs.
+
+    Parameters:
+        session: HTTP session shared by all retrieve jobs.
+        processes: Executor for the CPU bound work of jobs.
+        threads: Executor for blocking I/O bound jobs.
+        max_parallel_downloads: The maximum number of parallel downloads per host.
+        max_finished_jobs: The number of finished jobs to keep the result of, older ones are forgotten.
+        jobs: Submitted jobs by id, the running ones and the most recently finished ones.
+        writers: Writer of each session directory with running jobs,
+            opened for the first job of the session and closed after its last job.
+    """
+
+    session: FriendlyClient
+    processes: Executor
+    threads: Executor
+    max_parallel_downloads: int = 5
+    max_finished_jobs: int = 1000
+    jobs: dict[str, JobRecord] = field(default_factory=dict)
+    writers: dict[Path, asyncio.Future[SessionWriter]] = field(default_factory=dict)
+    _writer_users: Counter[Path] = field(default_factory=Counter, init=False, repr=False)
+    _finished: deque[str] = field(default_factory=deque, init=False, repr=False)
+    _tasks: set[asyncio.Task] = field(default_factory=set, init=False, repr=False)
+
+    @asynccontextmanager
+    async def writer(self, session_dir: Path) -> AsyncIterator[SessionWriter]:
+        """Use the writer of a session directory."""
+        loop = asyncio.get_running_loop()
+        if session_dir not in self.writers:
+            # Opening migrates the database, which blocks
+            self.writers[session_dir] = loop.run_in_executor(self.threads, SessionWriter, session_dir)
+        opened = self.writers[session_dir]
+        self._writer_users[session_dir] += 1
+        try:
+            # Other jobs of the session wait for the same writer, so do not cancel opening it
+            yield await asyncio.shield(opened)
+        finally:
+            self._writer_users[session_dir] -= 1
+            if not self._writer_users[session_dir]:
+                del self._writer_users[session_dir]
+                del self.writers[session_dir]
+                await asyncio.wait([opened])
+                if opened.exception() is None:
+                    # Closing commits the pending writes, which blocks
+                    await loop.run_in_executor(self.threads, opened.result().close)
+
+    def start(self, command: str, session_dir: Path, job: Job) -> JobRecord:
+        """Run a job in the background.
+
+        Args:
+            command: The command of the job.
+            session_dir: The session directory of the job.
+            job: The job to run.
+
+        Returns:
+            The record of the job, which is updated when the job finishes.
+        """
+        record = JobRecord(id=uuid.uuid4().hex, command=command, session_dir=session_dir)
+        self.jobs[record.id] = record
+        task = asyncio.create_task(self._run(record, job))
+        # The event loop only keeps a weak reference to tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return record
+
+    async def _run(self, record: JobRecord, job: Job):
+        try:
+            async with self.writer(record.session_dir) as writer:
+                record.result = await job(self, writer)
+            record.status = "done"
+        except Exception as e:  # noqa: BLE001 any failure of a job is reported to the client
+            record.error = f"{type(e).__name__}: {e}"
+            record.status = "failed"
+        self._finished.append(record.id)
+        while len(self._finished) > self.max_finished_jobs:
+            del self.jobs[self._finished.popleft()]
+
+    async def wait(self):
+        """Wait for all running jobs to finish."""
+        await asyncio.gather(*self._tasks)
+
+
+warm_state_key = web.AppKey("warm_state", WarmState)
+
+
+def _warm_up():
+    """Import the workflow in a worker process, so the first job does not pay for it."""
+    import protein_detective.workflow  # noqa: F401, PLC0415
+
+
+def _with_defaults(options: dict[str, Any], defaults: dict[str, Any]) -> dict[str, Any]:
+    unknown = set(options) - set(defaults)
+    if unknown:
+        msg = f"Unknown options: {', '.join(sorted(unknown))}. Allowed are: {', '.join(sorted(defaults))}"
+        raise ValueError(msg)
+    return defaults | options
+
+
+def search_job(session_dir: Path, options: dict[str, Any]) -> Job:
+    opts = _with_defaults(
+        options,
+        {
+            "taxon_id": None,
+            "reviewed": None,
+            "subcellular_location_uniprot": None,
+            "subcellular_location_go": None,
+            "molecular_function_go": None,
+            "limit": 10_000,
+            "incremental": False,
+            "refresh_after": None,
+            "go_ontology": None,
+            "backend": "sparql",
+        },
+    )
+    limit = int(opts.pop("limit"))
+    incremental = bool(opts.pop("incremental"))
+    refresh_after_days = opts.pop("refresh_after")
+    refresh_after = None if refresh_after_days is None else timedelta(days=float(refresh_after_days))
+    go_ontology_path = opts.pop("go_ontology")
+    go_ontology = None if go_ontology_path is None else Path(go_ontology_path)
+    backend = opts.pop("backend")
+    if backend not in search_backend_choices:
+        msg = f"Invalid backend: {backend}. Must be one of {sorted(search_backend_choices)}."
+        raise ValueError(msg)
+    query = Query(**opts)
+
+    async def run(state: WarmState, writer: SessionWriter) -> JobResult:
+        loop = asyncio.get_running_loop()
+        nr_uniprot, nr_pdbes, nr_afs = await loop.run_in_executor(
+            state.threads,
+            partial(
+                search_structures_in_uniprot,
+                query,
+                session_dir,
+                limit,
+                writer,
+                incremental=incremental,
+                refresh_after=refresh_after,
+                go_ontology=go_ontology,
+                backend=backend,
+            ),
+        )
+        return {"nr_uniprot": nr_uniprot, "nr_pdbes": nr_pdbes, "nr_afs": nr_afs}
+
+    return run
+
+
+def retrieve_job(session_dir: Path, options: dict[str, Any]) -> Job:
+    opts = _with_defaults(
+        options, {"what": None, "what_af_formats": None, "pdb_mirror": None, "alphafold_mirror": None}
+    )
+    what = set(opts["what"]) if opts["what"] else None
+    if what is not None and not what <= what_retrieve_choices:
+        msg = f"Invalid what: {what}. Must be a subset of {what_retrieve_choices}"
+        raise ValueError(msg)
+    what_af_formats = set(opts["what_af_formats"]) if opts["what_af_formats"] else None
+
+    async def run(state: WarmState, writer: SessionWriter) -> JobResult:
+        download_dir, nr_pdbes, nr_afs = await retrieve_structures_async(
+            session_dir,
+            what,
+            what_af_formats,
+            max_parallel_downloads=state.max_parallel_downloads,
+            session=state.session,
+            writer=writer,
+            pdb_mirror=Path(opts["pdb_mirror"]) if opts["pdb_mirror"] else None,
+            alphafold_mirror=Path(opts["alphafold_mirror"]) if opts["alphafold_mirror"] else None,
+            executor=state.threads,
+        )
+        return {"download_dir": str(download_dir), "nr_pdbes": nr_pdbes, "nr_afs": nr_afs}
+
+    return run
+
+
+def density_filter_job(session_dir: Path, options: dict[str, Any]) -> Job:
+    opts = _with_defaults(
+        options,
+        {"confidence_threshold": 70.0, "min_residues": 0, "max_residues": 1_000_000, "packed": False, "eager": False},
+    )
+    packed = bool(opts["packed"])
+    eager = bool(opts["eager"])
+    query = DensityFilterQuery(
+        confidence=float(opts["confidence_threshold"]),
+        min_threshold=int(opts["min_residues"]),
+        max_threshold=int(opts["max_residues"]),
+    )
+
+    async def run(state: WarmState, writer: SessionWriter) -> JobResult:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            state.threads,
+            partial(
+                density_filter, session_dir, query, writer=writer, packed=packed, eager=eager, executor=state.processes
+            ),
+        )
+        return {
+            "density_filtered_dir": str(result.density_filtered_dir),
+            "nr_kept": result.nr_kept,
+            "nr_discarded": result.nr_discarded,
+            "nr_unchanged": result.nr_unchanged,
+        }
+
+    return run
+
+
+def prune_pdbs_job(session_dir: Path, options: dict[str, Any]) -> Job:
+    opts = _with_defaults(options, {"packed": False})
+    packed = bool(opts["packed"])
+
+    async def run(state: WarmState, writer: SessionWriter) -> JobResult:
+        loop = asyncio.get_running_loop()
+        single_chain_dir, nr_files = await loop.run_in_executor(
+            state.threads, partial(prune_pdbs, session_dir, writer=writer, packed=packed, executor=state.processes)
+        )
+        return {"single_chain_dir": str(single_chain_dir), "nr_files": nr_files}
+
+    return run
+
+
+job_factories: dict[str, Callable[[Path, dict[str, Any]], Job]] = {
+    "search": search_job,
+    "retrieve": retrieve_job,
+    "density-filter": density_filter_job,
+    "prune-pdbs": prune_pdbs_job,
+}
+
+
+def parse_job(body: Any) -> tuple[str, Path, Job]:
+    """Parse a job request body.
+
+    Args:
+        body: Decoded JSON body with command, session_dir and optional options keys.
+
+    Returns:
+        A tuple containing the command, the session directory and the job to run.
+
+    Raises:
+        ValueError: If the body is not a valid job.
+    """
+    if not isinstance(body, dict):
+        msg = "Job must be a JSON object"
+        raise ValueError(msg)  # noqa: TRY004 surfaced as bad request like other invalid jobs
+    command = body.get("command")
+    if command not in job_factories:
+        msg = f"Invalid command: {command}. Must be one of {sorted(job_factories)}"
+        raise ValueError(msg)
+    if "session_dir" not in body:
+        msg = "Job is missing session_dir"
+        raise ValueError(msg)
+    session_dir = Path(body["session_dir"]).resolve()
+    options = body.get("options") or {}
+    if not isinstance(options, dict):
+        msg = "Job options must be a JSON object"
+        raise ValueError(msg)  # noqa: TRY004 surfaced as bad request like other invalid jobs
+    return command, session_dir, job_factories[command](session_dir, options)
+
+
+async def handle_job(request: web.Request) -> web.Response:
+    try:
+        command, session_dir, job = parse_job(await request.json())
+    except (ValueError, TypeError) as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    record = request.app[warm_state_key].start(command, session_dir, job)
+    return web.json_response(record.to_json(), status=202, headers={"Location": f"/jobs/{record.id}"})
+
+
+async def handle_job_status(request: web.Request) -> web.Response:
+    job_id = request.match_info["id"]
+    record = request.app[warm_state_key].jobs.get(job_id)
+    if record is None:
+        return web.json_response({"error": f"Unknown job: {job_id}"}, status=404)
+    return web.json_response(record.to_json())
+
+
+async def handle_health(_request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+
+def make_app(
+    max_workers: int | None = None,
+    max_parallel_downloads: int = 5,
+    processes: Executor | None = None,
+) -> web.Application:
+    """Create the server application.
+
+    Args:
+        max_workers: The number of worker processes for the CPU bound work of jobs. If None, the number of CPUs.
+        max_parallel_downloads: The maximum number of parallel downloads per host.
+        processes: Executor for the CPU bound work of jobs. If None, a process pool with max_workers is created.
+
+    Returns:
+        The aiohttp application.
+    """
+    app = web.Application()
+    app.router.add_post("/jobs", handle_job)
+    app.router.add_get("/jobs/{id}", handle_job_status)
+    app.router.add_get("/health", handle_health)
+
+    async def warm_state(app: web.Application):
+        own_processes = processes is None
+        pool = ProcessPoolExecutor(max_workers, initializer=_warm_up) if processes is None else processes
+        threads = ThreadPoolExecutor(thread_name_prefix="protein-detective-job")
+        async with friendly_session(max_parallel_per_host=max_parallel_downloads) as session:
+            state = WarmState(
+                session=session,
+                processes=pool,
+                threads=threads,
+                max_parallel_downloads=max_parallel_downloads,
+            )
+            app[warm_state_key] = state
+            yield
+            # Running jobs use the HTTP session and the executors
+            await state.wait()
+        threads.shutdown()
+        if own_processes:
+            pool.shutdown()
+
+    app.cleanup_ctx.append(warm_state)
+    return app
+
+
+def serve(host: str = "127.0.0.1", port: int = 8000, max_workers: int | None = None, max_parallel_downloads: int = 5):
+    """Run the server until interrupted.
+
+    Args:
+        host: The host to listen on.
+        port: The port to listen on.
+        max_workers: The number of worker processes for the CPU bound work of jobs. If None, the number of CPUs.
+        max_parallel_downloads: The maximum number of parallel downloads per host.
+    """
+    app = make_app(max_workers=max_workers, max_parallel_downloads=max_parallel_downloads)
+    web.run_app(app, host=host, port=port)
@@ -0,0 +1,120 @@
+"""Query many session databases at once.
+
+Each session database is attached read-only to an in-memory DuckDB database.
+For each table of a session a view with the same name is made
+that combines the rows of all sessions and has an extra `session_dir` column.
+So a cross-session question is a single SQL query instead of a Python loop over sessions.
+"""
+
+from collections.abc import Iterable
+from pathlib import Path
+
+from duckdb import DuckDBPyConnection
+from duckdb import connect as duckdb_connect
+
+from protein_detective.db import db_path, quote_literal
+
+session_tables = (
+    "uniprot_searches",
+    "proteins",
+    "pdbs",
+    "proteins_pdbs",
+    "alphafolds",
+    "density_filters",
+    "density_filtered_alphafolds",
+    "stage_timings",
+)
+"""Tables of a session database that are combined into a view."""
+
+presets = {
+    "shared-pdbs": """\
+SELECT
+    pdb_id,
+    count(DISTINCT session_dir) AS nr_sessions,
+    list(DISTINCT session_dir ORDER BY session_dir) AS session_dirs
+FROM proteins_pdbs
+GROUP BY pdb_id
+HAVING nr_sessions > 1
+ORDER BY nr_sessions DESC, pdb_id
+""",
+    "density-filtered": """\
+SELECT
+    session_dir,
+    confidence,
+    min_threshold,
+    max_threshold,
+    uniprot_acc,
+    nr_residues_above_confidence,
+    keep,
+    pdb_file
+FROM density_filtered_alphafolds
+JOIN density_filters USING (session_dir, density_filter_id)
+ORDER BY session_dir, confidence, min_threshold, max_threshold, uniprot_acc
+""",
+}
+"""Queries for frequently asked cross-session questions."""
+
+
+def attach_sessions(session_dirs: Iterable[Path], con: DuckDBPyConnection | None = None) -> DuckDBPyConnection:
+    """Attach the databases of many sessions and combine their tables into views.
+
+    A session that is being written to by another process can not be attached.
+
+    Args:
+        session_dirs: The session directories to attach.
+        con: The connection to attach the sessions to. If None, a new in-memory database is used.
+
+    Returns:
+        The connection with a view per session table.
+
+    Raises:
+        ValueError: If no session directories are given or a session directory has no database.
+    """
+    if con is None:
+        con = duckdb_connect()
+    selects: dict[str, list[str]] = {table: [] for table in session_tables}
+    for index, session_dir in enumerate(session_dirs):
+        database = db_path(session_dir)
+        if not database.exists():
+            msg = f"Session directory {session_dir} has no database at {database}"
+            raise ValueError(msg)
+        alias = f"session{index}"
+        con.execute(f"ATTACH {quote_literal(str(database))} AS {alias} (READ_ONLY)")
+        # Sessions made by older versions can miss tables or columns
+        rows = con.execute(
+            "SELECT table_name FROM duckdb_tables() WHERE database_name = ?",
+            (alias,),
+        ).fetchall()
+        for (table,) in rows:
+            if table in selects:
+                # table is one of session_tables and session_dir is quoted
+                select = f"SELECT {quote_literal(str(session_dir))} AS session_dir, * FROM {alias}.main.{table}"  # noqa: S608
+                selects[table].append(select)
+    if not any(selects.values()):
+        msg = "No session databases to attach"
+        raise ValueError(msg)
+    for table, table_selects in selects.items():
+        if table_selects:
+            con.execute(f"CREATE OR REPLACE TEMP VIEW {table} AS {' UNION ALL BY NAME '.join(table_selects)}")
+    return con
+
+
+def query_sessions(session_dirs: Iterable[Path], sql: str, output: Path | None = None):
+    """Run a query over many sessions.
+
+    Args:
+        session_dirs: The session directories to query.
+        sql: The SQL query or the name of a preset query, see `presets`.
+        output: File to write the result to, Parquet if it ends with `.parquet` otherwise CSV.
+            If None, the result is printed.
+    """
+    sql = presets.get(sql, sql)
+    con = attach_sessions(session_dirs)
+    try:
+        if output is None:
+            con.sql(sql).show(max_rows=100)
+            return
+        file_format = "PARQUET" if output.suffix == ".parquet" else "CSV"
+        con.execute(f"COPY ({sql}) TO {quote_literal(str(output))} (FORMAT {file_format})")
+    finally:
+        con.close()
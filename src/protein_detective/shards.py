@@ -0,0 +1,316 @@
+"""Split the work of a session into shards that can run on different nodes.
+
+A shard reads the session database read-only, so many shards can run at the same time
+on a shared file system. Instead of writing to the session database,
+a shard writes its results to a Parquet file in the `shards` directory of the session.
+Each run of a shard writes its own files, named after the step, a run id and the shard,
+like `density-filter-20250101T120000000000-1a2b3c4d-003-of-008.parquet`,
+so runs of a step with other parameters never overwrite each other.
+Afterwards `merge_shards` inserts the results of all shards into the session database,
+in the order they were run, and removes the merged files.
+So it is safe to merge again after a shard has been rerun.
+"""
+
+import uuid
+import zlib
+from collections.abc import Iterable
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from pathlib import Path
+
+from duckdb import DuckDBPyConnection
+from duckdb import connect as duckdb_connect
+
+from protein_detective.alphafold import AlphaFoldEntry
+from protein_detective.alphafold.density import DensityFilterQuery, DensityFilterResult
+from protein_detective.db import alphafolds_files_columns, alphafolds_files_rows, connect, quote_literal
+from protein_detective.pdbe.io import SingleChainResult
+
+
+@dataclass(frozen=True)
+class Shard:
+    """A part of the work of a session.
+
+    Work items are assigned to a shard by a stable hash of their key,
+    for example the UniProt accession or PDB ID.
+
+    Parameters:
+        index: Index of this shard, starting at 0.
+        count: Total number of shards.
+    """
+
+    index: int
+    count: int
+
+    def __post_init__(self):
+        if self.count < 1 or not 0 <= self.index < self.count:
+            msg = f"Invalid shard {self.index}/{self.count}, index must be between 0 and count - 1"
+            raise ValueError(msg)
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        """Parse a shard from a string like "3/8", which is shard index 3 of 8 shards.
+
+        Args:
+            value: The string to parse.
+
+        Returns:
+            The shard.
+
+        Raises:
+            ValueError: If the string is not a valid shard.
+        """
+        index, sep, count = value.partition("/")
+        if not sep:
+            msg = f"Invalid shard {value}, must be formatted as INDEX/COUNT, like 3/8"
+            raise ValueError(msg)
+        return cls(int(index), int(count))
+
+    @property
+    def name(self) -> str:
+        return f"{self.index:03d}-of-{self.count:03d}"
+
+    def __contains__(self, key: str) -> bool:
+        return zlib.crc32(key.encode()) % self.count == self.index
+
+
+def shards_dir(session_dir: Path) -> Path:
+    """Return the directory where shards write their results.
+
+    Args:
+        session_dir: The directory where the session data is stored.
+
+    Returns:
+        Path to the shards directory.
+    """
+    return session_dir / "shards"
+
+
+def new_run_id() -> str:
+    """Return a unique id for a run of a shard.
+
+    Ids start with the time of the run, so sorting them sorts runs by when they started.
+
+    Returns:
+        The run id.
+    """
+    return f"{datetime.now(UTC):%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+
+
+def _shard_file(session_dir: Path, step: str, shard: Shard, run_id: str) -> Path:
+    return shards_dir(session_dir) / f"{step}-{run_id}-{shard.name}.parquet"
+
+
+density_filtered_columns = {
+    "confidence": "REAL",
+    "min_threshold": "INTEGER",
+    "max_threshold": "INTEGER",
+    "uniprot_acc": "TEXT",
+    "nr_residues_above_confidence": "INTEGER",
+    "keep": "BOOLEAN",
+    "pdb_file": "TEXT",
+    "kept_residues": "TEXT",
+    "input_fingerprint": "TEXT",
+    "output_fingerprint": "TEXT",
+}
+single_chain_columns = {"uniprot_acc": "TEXT", "pdb_id": "TEXT", "single_chain_pdb_file": "TEXT", "fingerprint": "TEXT"}
+pdb_files_columns = {"pdb_id": "TEXT", "mmcif_file": "TEXT"}
+alphafolds_files_types = dict.fromkeys(alphafolds_files_columns, "TEXT") | {"summary": "JSON"}
+
+
+def _write_rows(path: Path, columns: dict[str, str], rows: list[tuple]):
+    # Write to a temporary file first, so a merge never reads a half written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part = path.with_name(path.name + ".part")
+    con = duckdb_connect()
+    try:
+        con.execute(f"CREATE TABLE result ({', '.join(f'{name} {type_}' for name, type_ in columns.items())})")
+        if rows:
+            placeholders = ", ".join("?" for _ in columns)
+            con.executemany(f"INSERT INTO result VALUES ({placeholders})", rows)  # noqa: S608 no values in query
+        con.execute(f"COPY result TO {quote_literal(str(part))} (FORMAT PARQUET)")
+    finally:
+        con.close()
+    part.replace(path)
+
+
+def write_density_filtered(
+    session_dir: Path,
+    shard: Shard,
+    query: DensityFilterQuery,
+    results: Iterable[tuple[str, DensityFilterResult]],
+) -> Path:
+    """Write the density filter results of a shard.
+
+    Args:
+        session_dir: The directory where the session data is stored.
+        shard: The shard the results belong to.
+        query: The density filter query that was used.
+        results: Pairs of UniProt accession and density filter result.
+
+    Returns:
+        Path to the written file.
+    """
+    rows = [
+        (
+            query.confidence,
+            query.min_threshold,
+            query.max_threshold,
+            uniprot_acc,
+            result.count,
+            result.density_filtered_file is not None,
+            str(result.density_filtered_file) if result.density_filtered_file else None,
+            result.kept_residues,
+            result.input_fingerprint,
+            result.output_fingerprint,
+        )
+        for uniprot_acc, result in results
+    ]
+    path = _shard_file(session_dir, "density-filter", shard, new_run_id())
+    _write_rows(path, density_filtered_columns, rows)
+    return path
+
+
+def write_single_chain_pdb_files(session_dir: Path, shard: Shard, files: Iterable[SingleChainResult]) -> Path:
+    """Write the pruned PDB files of a shard.
+
+    Args:
+        session_dir: The directory where the session data is stored.
+        shard: The shard the results belong to.
+        files: The written single chain PDB files.
+
+    Returns:
+        Path to the written file.
+    """
+    rows = [(file.uniprot_acc, file.pdb_id, str(file.output_file), file.fingerprint) for file in files]
+    path = _shard_file(session_dir, "prune-pdbs", shard, new_run_id())
+    _write_rows(path, single_chain_columns, rows)
+    return path
+
+
+def write_retrieved(
+    session_dir: Path, shard: Shard, mmcif_files: dict[str, Path], afs: list[AlphaFoldEntry]
+) -> tuple[Path, Path]:
+    """Write the retrieved files of a shard.
+
+    Args:
+        session_dir: The directory where the session data is stored.
+        shard: The shard the results belong to.
+        mmcif_files: A mapping of PDB IDs to their file paths, relative to the session directory.
+        afs: The AlphaFold entries with file paths relative to the session directory.
+
+    Returns:
+        Paths to the written files of PDBe and AlphaFold results.
+    """
+    run_id = new_run_id()
+    pdbs_path = _shard_file(session_dir, "retrieve-pdbe", shard, run_id)
+    _write_rows(pdbs_path, pdb_files_columns, [(pdb_id, str(file)) for pdb_id, file in mmcif_files.items()])
+    afs_path = _shard_file(session_dir, "retrieve-alphafold", shard, run_id)
+    _write_rows(afs_path, alphafolds_files_types, alphafolds_files_rows(afs))
+    return pdbs_path, afs_path
+
+
+def _merge_density_filtered(files: list[str], con: DuckDBPyConnection):
+    con.execute(
+        """INSERT OR IGNORE INTO density_filters (confidence, min_threshold, max_threshold)
+        SELECT DISTINCT confidence, min_threshold, max_threshold FROM read_parquet(?)""",
+        (files,),
+    )
+    # Shards only have results that changed since the previous run, so they replace the saved results
+    con.execute(
+        """INSERT OR REPLACE INTO density_filtered_alphafolds
+        (density_filter_id, uniprot_acc, nr_residues_above_confidence, keep, pdb_file, kept_residues, input_fingerprint)
+        SELECT df.density_filter_id, s.uniprot_acc, s.nr_residues_above_confidence, s.keep, s.pdb_file, s.kept_residues,
+            s.input_fingerprint
+        FROM read_parquet(?) AS s
+        JOIN density_filters AS df
+            ON df.confidence = s.confidence
+            AND df.min_threshold = s.min_threshold
+            AND df.max_threshold = s.max_threshold
+        """,
+        (files,),
+    )
+    _merge_output_fingerprints(files, "pdb_file", "output_fingerprint", con)
+
+
+def _merge_single_chain_pdb_files(files: list[str], con: DuckDBPyConnection):
+    con.execute(
+        """UPDATE proteins_pdbs SET single_chain_pdb_file = s.single_chain_pdb_file
+        FROM read_parquet(?) AS s
+        WHERE proteins_pdbs.uniprot_acc = s.uniprot_acc AND proteins_pdbs.pdb_id = s.pdb_id
+        """,
+        (files,),
+    )
+    _merge_output_fingerprints(files, "single_chain_pdb_file", "fingerprint", con)
+
+
+def _merge_output_fingerprints(files: list[str], path_column: str, fingerprint_column: str, con: DuckDBPyConnection):
+    # column names are constants
+    con.execute(
+        f"""INSERT OR REPLACE INTO output_fingerprints (path, fingerprint)
+        SELECT DISTINCT {path_column}, {fingerprint_column} FROM read_parquet(?)
+        WHERE {path_column} IS NOT NULL AND {fingerprint_column} IS NOT NULL
+        """,  # noqa: S608
+        (files,),
+    )
+
+
+def _merge_pdb_files(files: list[str], con: DuckDBPyConnection):
+    con.execute(
+        """UPDATE pdbs SET mmcif_file = s.mmcif_file
+        FROM read_parquet(?) AS s
+        WHERE pdbs.pdb_id = s.pdb_id
+        """,
+        (files,),
+    )
+
+
+def _merge_alphafolds_files(files: list[str], con: DuckDBPyConnection):
+    columns = [column for column in alphafolds_files_columns if column != "uniprot_acc"]
+    # column names are constants
+    con.execute(
+        f"""UPDATE alphafolds SET {", ".join(f"{column} = s.{column}" for column in columns)}
+        FROM read_parquet(?) AS s
+        WHERE alphafolds.uniprot_acc = s.uniprot_acc
+        """,  # noqa: S608
+        (files,),
+    )
+
+
+mergers = {
+    "retrieve-pdbe": _merge_pdb_files,
+    "retrieve-alphafold": _merge_alphafolds_files,
+    "density-filter": _merge_density_filtered,
+    "prune-pdbs": _merge_single_chain_pdb_files,
+}
+"""How to merge shard results by file name prefix, in the order the workflow steps run."""
+
+
+def merge_shards(session_dir: Path) -> dict[str, int]:
+    """Merge the results of all shards into the session database and remove the merged shard files.
+
+    Files are merged one by one in the order of their run id,
+    so results of a later run of a shard replace those of an earlier run.
+    Files are only removed after all of them are merged.
+
+    Args:
+        session_dir: The directory where the session data is stored.
+
+    Returns:
+        The number of merged shard files per kind of result.
+    """
+    directory = shards_dir(session_dir)
+    merged: dict[str, int] = {}
+    merged_files: list[Path] = []
+    with connect(session_dir) as con:
+        con.begin()
+        for prefix, merger in mergers.items():
+            files = sorted(directory.glob(f"{prefix}-*-of-*.parquet"))
+            for file in files:
+                merger([str(file)], con)
+            merged[prefix] = len(files)
+            merged_files.extend(files)
+        con.commit()
+    for file in merged_files:
+        file.unlink()
+    return merged
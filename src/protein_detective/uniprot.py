@@ -1,9 +1,15 @@
 import logging
-from collections.abc import Iterable
+import time
+import urllib.error
+from collections.abc import Callable, Iterable
 from dataclasses import dataclass
 from textwrap import dedent
+from typing import TYPE_CHECKING
 
-from SPARQLWrapper import JSON, SPARQLWrapper
+from protein_detective.instrumentation import timed
+
+if TYPE_CHECKING:
+    from protein_detective.gene_ontology import GoOntology
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +33,23 @@ class Query:
     molecular_function_go: str | None
 
 
+@dataclass(frozen=True)
+class SearchCounts:
+    """Number of results a search finds when it is not limited.
+
+    Parameters:
+        nr_uniprot: Number of UniProt accessions.
+        nr_pdb_rows: Number of pairs of UniProt accession and PDB entry, which are rows in the session database.
+        nr_pdbs: Number of distinct PDB entries, which are files to retrieve.
+        nr_alphafolds: Number of UniProt accessions with an AlphaFold entry, which are files to retrieve.
+    """
+
+    nr_uniprot: int
+    nr_pdb_rows: int
+    nr_pdbs: int
+    nr_alphafolds: int
+
+
 @dataclass(frozen=True)
 class PdbResult:
     """Result of a PDB search in UniProtKB.
@@ -44,7 +67,28 @@ class PdbResult:
     resolution: str | None = None
 
 
-def _query2dynamic_sparql_triples(query: Query):
+max_go_terms = 1_000
+"""Maximum number of GO terms to list in a query, GO terms with more descendants are matched with a property path."""
+
+
+def _go_term_triples(term: str, variable: str, go_ontology: "GoOntology | None") -> str:
+    if go_ontology is not None and term in go_ontology:
+        terms = go_ontology.descendants(term)
+        if len(terms) <= max_go_terms:
+            values = " ".join(sorted(terms))
+            return dedent(f"""
+                VALUES ?{variable} {{ {values} }}
+                ?protein up:classifiedWith ?{variable} .
+            """)
+        logger.info("%s has %d descendants, matching its subclasses in the query instead", term, len(terms))
+    elif go_ontology is not None:
+        logger.warning("%s is not in the GO ontology, matching its subclasses in the query instead", term)
+    return dedent(f"""
+        ?protein up:classifiedWith|(up:classifiedWith/rdfs:subClassOf) {term} .
+    """)
+
+
+def _query2dynamic_sparql_triples(query: Query, go_ontology: "GoOntology | None" = None):
     parts: list[str] = []
     if query.taxon_id:
         parts.append(f"?protein up:organism taxon:{query.taxon_id} .")
@@ -54,22 +98,18 @@ def _query2dynamic_sparql_triples(query: Query):
     elif query.reviewed is False:
         parts.append("?protein up:reviewed false .")
 
-    parts.append(_append_subcellular_location_filters(query))
+    parts.append(_append_subcellular_location_filters(query, go_ontology))
 
     if query.molecular_function_go:
         if not query.molecular_function_go.startswith("GO:"):
             msg = "Molecular function GO term must start with 'GO:'."
             raise ValueError(msg)
-        parts.append(
-            dedent(f"""
-            ?protein up:classifiedWith|(up:classifiedWith/rdfs:subClassOf) {query.molecular_function_go} .
-        """)
-        )
+        parts.append(_go_term_triples(query.molecular_function_go, "function_go", go_ontology))
 
     return "\n".join(parts)
 
 
-def _append_subcellular_location_filters(query: Query) -> str:
+def _append_subcellular_location_filters(query: Query, go_ontology: "GoOntology | None" = None) -> str:
     subcellular_location_uniprot_part = ""
     subcellular_location_go_part = ""
     if query.subcellular_location_uniprot:
@@ -82,9 +122,7 @@ def _append_subcellular_location_filters(query: Query) -> str:
         if not query.subcellular_location_go.startswith("GO:"):
             msg = "Subcellular location GO term must start with 'GO:'."
             raise ValueError(msg)
-        subcellular_location_go_part = dedent(f"""
-            ?protein up:classifiedWith|(up:classifiedWith/rdfs:subClassOf) {query.subcellular_location_go} .
-        """)
+        subcellular_location_go_part = _go_term_triples(query.subcellular_location_go, "location_go", go_ontology)
     if query.subcellular_location_uniprot and query.subcellular_location_go:
         # If both are provided include results for both with logical OR
         return dedent(f"""
@@ -143,8 +181,8 @@ def _build_sparql_generic_by_uniprot_accesions_query(
     )
 
 
-def _build_sparql_query_uniprot(query: Query, limit=10_000) -> str:
-    dynamic_triples = _query2dynamic_sparql_triples(query)
+def _build_sparql_query_uniprot(query: Query, limit=10_000, go_ontology: "GoOntology | None" = None) -> str:
+    dynamic_triples = _query2dynamic_sparql_triples(query, go_ontology)
     # TODO add usefull columns that have 1:1 mapping to protein
     # like uniprot_id with `?protein up:mnemonic ?mnemonic .`
     # and sequence, take care to take first isoform
@@ -159,6 +197,65 @@ def _build_sparql_query_uniprot(query: Query, limit=10_000) -> str:
     return _build_sparql_generic_query(select_clause, dedent(where_clause), limit)
 
 
+def _build_sparql_count_query(
+    query: Query, select_clause: str, where_clause: str, go_ontology: "GoOntology | None" = None
+) -> str:
+    dynamic_triples = _query2dynamic_sparql_triples(query, go_ontology)
+    # A protein can match the query in more than one way, so select distinct proteins before counting
+    where_clause2 = dedent(f"""
+        {{
+            SELECT DISTINCT ?protein
+            WHERE {{
+                # --- Protein Selection ---
+                ?protein a up:Protein .
+                {dynamic_triples}
+            }}
+        }}
+        {where_clause}
+    """)
+    return _build_sparql_generic_query(select_clause, where_clause2, limit=1)
+
+
+def _build_sparql_count_query_uniprot(query: Query, go_ontology: "GoOntology | None" = None) -> str:
+    return _build_sparql_count_query(query, "(COUNT(?protein) AS ?count)", "", go_ontology)
+
+
+_pdb_where_clause = dedent("""
+    # --- PDB Info ---
+    ?protein rdfs:seeAlso ?pdb_db .
+    ?pdb_db up:database <http://purl.uniprot.org/database/PDB> .
+    ?pdb_db up:method ?pdb_method .
+    ?pdb_db up:chainSequenceMapping ?chainSequenceMapping .
+    BIND(STRAFTER(STR(?chainSequenceMapping), "isoforms/") AS ?isoformPart)
+    FILTER(STRSTARTS(?isoformPart, CONCAT(?ac, "-")))
+    ?chainSequenceMapping up:chain ?pdb_chain .
+""")
+"""Patterns a PDB entry of ?protein with accession ?ac must match to be found, shared by search and count queries."""
+
+
+def _build_sparql_count_query_pdb(query: Query, go_ontology: "GoOntology | None" = None) -> str:
+    # A pair of protein and PDB entry matches once per chain, so count distinct pairs
+    where_clause = (
+        dedent("""
+        BIND(STRAFTER(STR(?protein), "http://purl.uniprot.org/uniprot/") AS ?ac)
+    """)
+        + _pdb_where_clause
+    )
+    select_clause = (
+        '(COUNT(DISTINCT CONCAT(STR(?protein), " ", STR(?pdb_db))) AS ?rows) (COUNT(DISTINCT ?pdb_db) AS ?count)'
+    )
+    return _build_sparql_count_query(query, select_clause, where_clause, go_ontology)
+
+
+def _build_sparql_count_query_af(query: Query, go_ontology: "GoOntology | None" = None) -> str:
+    where_clause = dedent("""
+        # --- AlphaFoldDB Info ---
+        ?protein rdfs:seeAlso ?af_db .
+        ?af_db up:database <http://purl.uniprot.org/database/AlphaFoldDB> .
+    """)
+    return _build_sparql_count_query(query, "(COUNT(DISTINCT ?protein) AS ?count)", where_clause, go_ontology)
+
+
 def _build_sparql_query_pdb(uniprot_accs: Iterable[str], limit=10_000) -> str:
     # For http://purl.uniprot.org/uniprot/O00268 + http://rdf.wwpdb.org/pdb/1H3O
     # the chainSequenceMapping are
@@ -178,17 +275,7 @@ def _build_sparql_query_pdb(uniprot_accs: Iterable[str], limit=10_000) -> str:
          (GROUP_CONCAT(DISTINCT ?pdb_chain; separator=",") AS ?pdb_chains)
     """)
 
-    where_clause = dedent("""
-        # --- PDB Info ---
-        ?protein rdfs:seeAlso ?pdb_db .
-        ?pdb_db up:database <http://purl.uniprot.org/database/PDB> .
-        ?pdb_db up:method ?pdb_method .
-        ?pdb_db up:chainSequenceMapping ?chainSequenceMapping .
-        BIND(STRAFTER(STR(?chainSequenceMapping), "isoforms/") AS ?isoformPart)
-        FILTER(STRSTARTS(?isoformPart, CONCAT(?ac, "-")))
-        ?chainSequenceMapping up:chain ?pdb_chain .
-        OPTIONAL { ?pdb_db up:resolution ?pdb_resolution . }
-    """)
+    where_clause = _pdb_where_clause + "OPTIONAL { ?pdb_db up:resolution ?pdb_resolution . }\n"
 
     groupby_clause = "?protein ?pdb_db ?pdb_method ?pdb_resolution"
     return _build_sparql_generic_by_uniprot_accesions_query(
@@ -222,6 +309,7 @@ def _build_sparql_query_emdb(uniprot_accs: Iterable[str], limit=10_000) -> str:
     return _build_sparql_generic_by_uniprot_accesions_query(uniprot_accs, select_clause, dedent(where_clause), limit)
 
 
+@timed
 def _execute_sparql_search(
     sparql_query: str,
     timeout: int,
@@ -233,6 +321,8 @@ def _execute_sparql_search(
         msg = "Uniprot SPARQL timeout is limited to 2,700 seconds (45 minutes)."
         raise ValueError(msg)
 
+    from SPARQLWrapper import JSON, SPARQLWrapper  # noqa: PLC0415 slow to import, only needed here
+
     # Execute the query
     sparql = SPARQLWrapper("https://sparql.uniprot.org/sparql")
     sparql.setReturnFormat(JSON)
@@ -253,6 +343,84 @@ def _execute_sparql_search(
     return bindings
 
 
+def _is_timeout(error: Exception) -> bool:
+    if isinstance(error, TimeoutError):
+        return True
+    return isinstance(error, urllib.error.URLError) and isinstance(error.reason, TimeoutError)
+
+
+def _is_server_error(error: Exception) -> bool:
+    from SPARQLWrapper.SPARQLExceptions import EndPointInternalError  # noqa: PLC0415 slow to import, only needed here
+
+    if isinstance(error, EndPointInternalError):
+        return True
+    return isinstance(error, urllib.error.HTTPError) and error.code >= 500
+
+
+def _is_connection_error(error: Exception) -> bool:
+    return isinstance(error, urllib.error.URLError) and not isinstance(error, urllib.error.HTTPError)
+
+
+retries = 3
+"""Number of times a failed SPARQL query is retried before it is split or the search fails."""
+retry_backoff = 5.0
+"""Seconds to wait before the first retry of a SPARQL query, doubled for each next retry."""
+
+
+def _execute_sparql_search_by_accessions(
+    what: str,
+    build_query: Callable[[list[str]], str],
+    uniprot_accs: Iterable[str],
+    timeout: int,
+    limit: int,
+) -> list:
+    """Execute a SPARQL query with a VALUES list of accessions, splitting the list when the query is too heavy.
+
+    A query that times out is split into two queries, each for half of the accessions.
+    A query that fails with a server error or connection error is retried with exponential backoff.
+    When retries of a server error run out, the query is split as well.
+    A query for a single accession that keeps failing makes the whole search fail.
+
+    Args:
+        what: What is searched for, used in log messages.
+        build_query: Function that builds the SPARQL query for a list of accessions.
+        uniprot_accs: UniProt accessions.
+        timeout: Timeout for each SPARQL query in seconds.
+        limit: Maximum number of results to return.
+
+    Returns:
+        The bindings of all queries, at most `limit`.
+    """
+    pending = [list(uniprot_accs)]
+    bindings: list = []
+    while pending and len(bindings) < limit:
+        accs = pending.pop()
+        for attempt in range(retries + 1):
+            sparql_query = build_query(accs)
+            logger.info("Executing SPARQL query for %s: %s", what, sparql_query)
+            try:
+                bindings.extend(_execute_sparql_search(sparql_query=sparql_query, timeout=timeout))
+                break
+            except Exception as error:
+                split = len(accs) > 1 and (_is_timeout(error) or (_is_server_error(error) and attempt == retries))
+                if split:
+                    logger.warning(
+                        "SPARQL query for %d accessions failed with %r, splitting it in two", len(accs), error
+                    )
+                    half = len(accs) // 2
+                    # Pushed in reverse, so the first half is executed first
+                    pending.extend([accs[half:], accs[:half]])
+                    break
+                retryable = _is_timeout(error) or _is_server_error(error) or _is_connection_error(error)
+                if not retryable or attempt == retries:
+                    raise
+                delay = retry_backoff * 2**attempt
+                logger.warning("SPARQL query failed with %r, retrying in %g seconds", error, delay)
+                time.sleep(delay)
+    return bindings[:limit]
+
+
+@timed
 def _flatten_results_pdb(rawresults: Iterable) -> dict[str, set[PdbResult]]:
     pdb_entries: dict[str, set[PdbResult]] = {}
     for result in rawresults:
@@ -277,6 +445,7 @@ def _flatten_results_pdb(rawresults: Iterable) -> dict[str, set[PdbResult]]:
     return pdb_entries
 
 
+@timed
 def _flatten_results_af(rawresults: Iterable) -> dict[str, set[str]]:
     alphafold_entries: dict[str, set[str]] = {}
     for result in rawresults:
@@ -289,6 +458,7 @@ def _flatten_results_af(rawresults: Iterable) -> dict[str, set[str]]:
     return alphafold_entries
 
 
+@timed
 def _flatten_results_emdb(rawresults: Iterable) -> dict[str, set[str]]:
     emdb_entries: dict[str, set[str]] = {}
     for result in rawresults:
@@ -301,6 +471,41 @@ def _flatten_results_emdb(rawresults: Iterable) -> dict[str, set[str]]:
     return emdb_entries
 
 
+def _execute_sparql_count(what: str, sparql_query: str, timeout: int) -> dict[str, int]:
+    logger.info("Executing SPARQL count query for %s: %s", what, sparql_query)
+    raw_results = _execute_sparql_search(sparql_query=sparql_query, timeout=timeout)
+    if not raw_results:
+        return {}
+    return {name: int(value["value"]) for name, value in raw_results[0].items()}
+
+
+def count4search(query: Query, timeout: int = 1_800, go_ontology: "GoOntology | None" = None) -> SearchCounts:
+    """
+    Count the results of a search without retrieving them.
+
+    Runs COUNT variants of the queries of [search4uniprot][protein_detective.uniprot.search4uniprot],
+    [search4pdb][protein_detective.uniprot.search4pdb] and [search4af][protein_detective.uniprot.search4af],
+    which are not limited and do not transfer the results.
+
+    Args:
+        query: Query object containing search parameters.
+        timeout: Timeout for each SPARQL query in seconds.
+        go_ontology: Local copy of the Gene Ontology, to expand GO terms of the query.
+
+    Returns:
+        The counts.
+    """
+    uniprot = _execute_sparql_count("UniProt", _build_sparql_count_query_uniprot(query, go_ontology), timeout)
+    pdb = _execute_sparql_count("PDB", _build_sparql_count_query_pdb(query, go_ontology), timeout)
+    af = _execute_sparql_count("AlphaFold", _build_sparql_count_query_af(query, go_ontology), timeout)
+    return SearchCounts(
+        nr_uniprot=uniprot.get("count", 0),
+        nr_pdb_rows=pdb.get("rows", 0),
+        nr_pdbs=pdb.get("count", 0),
+        nr_alphafolds=af.get("count", 0),
+    )
+
+
 def limit_check(what: str, limit: int, len_raw_results: int):
     if len_raw_results >= limit:
         logger.warning(
@@ -314,7 +519,9 @@ def limit_check(what: str, limit: int, len_raw_results: int):
         )
 
 
-def search4uniprot(query: Query, limit: int = 10_000, timeout: int = 1_800) -> set[str]:
+def search4uniprot(
+    query: Query, limit: int = 10_000, timeout: int = 1_800, go_ontology: "GoOntology | None" = None
+) -> set[str]:
     """
     Search for UniProtKB entries based on the given query.
 
@@ -322,11 +529,13 @@ def search4uniprot(query: Query, limit: int = 10_000, timeout: int = 1_800) -> s
         query: Query object containing search parameters.
         limit: Maximum number of results to return.
         timeout: Timeout for the SPARQL query in seconds.
+        go_ontology: Local copy of the Gene Ontology. If given, GO terms of the query are expanded
+            to a list of their descendants, which is faster to search than subclasses of a term.
 
     Returns:
         Set of uniprot accessions.
     """
-    sparql_query = _build_sparql_query_uniprot(query, limit)
+    sparql_query = _build_sparql_query_uniprot(query, limit, go_ontology)
     logger.info("Executing SPARQL query for UniProt: %s", sparql_query)
 
     # Type assertion is needed because _execute_sparql_search returns a Union
@@ -345,18 +554,18 @@ def search4pdb(uniprot_accs: Iterable[str], limit: int = 10_000, timeout: int =
     Args:
         uniprot_accs: UniProt accessions.
         limit: Maximum number of results to return.
-        timeout: Timeout for the SPARQL query in seconds.
+        timeout: Timeout for each SPARQL query in seconds.
+            A query that times out is split into queries for fewer accessions.
 
     Returns:
         Dictionary with protein IDs as keys and sets of PDB results as values.
     """
-    sparql_query = _build_sparql_query_pdb(uniprot_accs, limit)
-    logger.info("Executing SPARQL query for PDB: %s", sparql_query)
-
-    # Type assertion is needed because _execute_sparql_search returns a Union
-    raw_results = _execute_sparql_search(
-        sparql_query=sparql_query,
+    raw_results = _execute_sparql_search_by_accessions(
+        "PDB",
+        lambda accs: _build_sparql_query_pdb(accs, limit),
+        uniprot_accs,
         timeout=timeout,
+        limit=limit,
     )
     limit_check("Search for pdbs on uniprot", limit, len(raw_results))
     return _flatten_results_pdb(raw_results)
@@ -369,18 +578,18 @@ def search4af(uniprot_accs: Iterable[str], limit: int = 10_000, timeout: int = 1
     Args:
         uniprot_accs: UniProt accessions.
         limit: Maximum number of results to return.
-        timeout: Timeout for the SPARQL query in seconds.
+        timeout: Timeout for each SPARQL query in seconds.
+            A query that times out is split into queries for fewer accessions.
 
     Returns:
         Dictionary with protein IDs as keys and sets of AlphaFold IDs as values.
     """
-    sparql_query = _build_sparql_query_af(uniprot_accs, limit)
-    logger.info("Executing SPARQL query for AlphaFold: %s", sparql_query)
-
-    # Type assertion is needed because _execute_sparql_search returns a Union
-    raw_results = _execute_sparql_search(
-        sparql_query=sparql_query,
+    raw_results = _execute_sparql_search_by_accessions(
+        "AlphaFold",
+        lambda accs: _build_sparql_query_af(accs, limit),
+        uniprot_accs,
         timeout=timeout,
+        limit=limit,
     )
     limit_check("Search for alphafold entries on uniprot", limit, len(raw_results))
     return _flatten_results_af(raw_results)
@@ -393,17 +602,18 @@ def search4emdb(uniprot_accs: Iterable[str], limit: int = 10_000, timeout: int =
     Args:
         uniprot_accs: UniProt accessions.
         limit: Maximum number of results to return.
-        timeout: Timeout for the SPARQL query in seconds.
+        timeout: Timeout for each SPARQL query in seconds.
+            A query that times out is split into queries for fewer accessions.
 
     Returns:
         Dictionary with protein IDs as keys and sets of EMDB IDs as values.
     """
-    sparql_query = _build_sparql_query_emdb(uniprot_accs, limit)
-    logger.info("Executing SPARQL query for EMDB: %s", sparql_query)
-
-    raw_results = _execute_sparql_search(
-        sparql_query=sparql_query,
+    raw_results = _execute_sparql_search_by_accessions(
+        "EMDB",
+        lambda accs: _build_sparql_query_emdb(accs, limit),
+        uniprot_accs,
         timeout=timeout,
+        limit=limit,
     )
     limit_check("Search for EMDB entries on uniprot", limit, len(raw_results))
     return _flatten_results_emdb(raw_results)
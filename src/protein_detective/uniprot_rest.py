@@ -0,0 +1,179 @@
+"""Search UniProtKB with the [UniProt REST API](https://www.uniprot.org/help/api) instead of SPARQL.
+
+A single streamed request to the `stream` endpoint returns the UniProt accessions of a query
+together with their PDB and AlphaFold cross-references,
+instead of the three SPARQL queries of [protein_detective.uniprot][protein_detective.uniprot].
+Entries are parsed as they arrive, so they can be saved while the rest is still streaming.
+"""
+
+import codecs
+import json
+import logging
+import re
+import urllib.parse
+import urllib.request
+from collections.abc import Iterator
+from dataclasses import dataclass
+from typing import BinaryIO
+
+from protein_detective.uniprot import PdbResult, Query, limit_check
+
+logger = logging.getLogger(__name__)
+
+stream_url = "https://rest.uniprot.org/uniprotkb/stream"
+"""URL of the stream endpoint of UniProtKB."""
+
+# Methods as named in the REST API, mapped to how they are named in SPARQL results,
+# so a session has the same methods whichever backend searched it.
+_methods = {
+    "X-ray": "X-Ray_Crystallography",
+    "NMR": "NMR_Spectroscopy",
+    "EM": "Electron_Microscopy",
+    "Neutron": "Neutron_Diffraction",
+    "Fiber": "Fiber_Diffraction",
+}
+
+
+@dataclass(frozen=True)
+class UniProtEntry:
+    """A UniProtKB entry with its structure cross-references.
+
+    Parameters:
+        uniprot_acc: UniProt accession.
+        pdbs: PDB entries of the accession.
+        alphafolds: AlphaFold entries of the accession.
+    """
+
+    uniprot_acc: str
+    pdbs: frozenset[PdbResult]
+    alphafolds: frozenset[str]
+
+
+def _query2rest_query(query: Query) -> str:
+    parts: list[str] = []
+    if query.taxon_id:
+        parts.append(f"organism_id:{query.taxon_id}")
+
+    if query.reviewed:
+        parts.append("reviewed:true")
+    elif query.reviewed is False:
+        parts.append("reviewed:false")
+
+    locations: list[str] = []
+    if query.subcellular_location_uniprot:
+        locations.append(f'cc_scl_term:"{query.subcellular_location_uniprot}"')
+    if query.subcellular_location_go:
+        if not query.subcellular_location_go.startswith("GO:"):
+            msg = "Subcellular location GO term must start with 'GO:'."
+            raise ValueError(msg)
+        # The go field also matches descendants of the term
+        locations.append(f"go:{query.subcellular_location_go.removeprefix('GO:')}")
+    if locations:
+        # If both are provided include results for both with logical OR
+        parts.append(f"({' OR '.join(locations)})")
+
+    if query.molecular_function_go:
+        if not query.molecular_function_go.startswith("GO:"):
+            msg = "Molecular function GO term must start with 'GO:'."
+            raise ValueError(msg)
+        parts.append(f"go:{query.molecular_function_go.removeprefix('GO:')}")
+
+    return " AND ".join(parts) if parts else "*"
+
+
+def _build_stream_url(query: Query, url: str = stream_url) -> str:
+    params = {
+        "query": _query2rest_query(query),
+        "format": "json",
+        "fields": "accession,xref_pdb,xref_alphafolddb",
+    }
+    return f"{url}?{urllib.parse.urlencode(params)}"
+
+
+_results_start = re.compile(r'"results"\s*:\s*\[')
+
+
+def _iter_json_results(stream: BinaryIO, chunk_size: int = 65536) -> Iterator[dict]:
+    """Parse the items of the results list of a `{"results": [...]}` JSON document while it is being read.
+
+    Raises:
+        ValueError: If the document has no results list, or the stream ends before the end of the list.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    in_results = False
+    while chunk := stream.read(chunk_size):
+        buffer += text.decode(chunk)
+        if not in_results:
+            start = _results_start.search(buffer)
+            if start is None:
+                continue
+            buffer = buffer[start.end() :]
+            in_results = True
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,")
+            if buffer.startswith("]"):
+                return
+            if not buffer:
+                break
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # The item is not complete yet, read more
+                break
+            yield item
+            buffer = buffer[end:]
+    if not in_results:
+        msg = f"UniProt response has no results: {buffer[:200]}"
+        raise ValueError(msg)
+    msg = "UniProt stream ended before the results were complete"
+    raise ValueError(msg)
+
+
+def _entry_from_result(result: dict) -> UniProtEntry:
+    pdbs: set[PdbResult] = set()
+    alphafolds: set[str] = set()
+    for xref in result.get("uniProtKBCrossReferences", []):
+        if xref["database"] == "AlphaFoldDB":
+            alphafolds.add(xref["id"])
+        elif xref["database"] == "PDB":
+            properties = {prop["key"]: prop["value"] for prop in xref.get("properties", [])}
+            method = properties.get("Method", "")
+            resolution = properties.get("Resolution", "-").removesuffix(" A").strip()
+            pdbs.add(
+                PdbResult(
+                    id=xref["id"],
+                    method=_methods.get(method, method),
+                    # Same separator as the chains of SPARQL results
+                    uniprot_chains=properties.get("Chains", "").replace(", ", ","),
+                    resolution=None if resolution in ("", "-") else str(float(resolution)),
+                )
+            )
+    return UniProtEntry(uniprot_acc=result["primaryAccession"], pdbs=frozenset(pdbs), alphafolds=frozenset(alphafolds))
+
+
+def iter_search4structures(
+    query: Query, limit: int = 10_000, timeout: int = 1_800, url: str = stream_url
+) -> Iterator[UniProtEntry]:
+    """Search for UniProtKB entries and their PDB and AlphaFold entries, yielding entries as they are streamed.
+
+    Args:
+        query: Query object containing search parameters.
+        limit: Maximum number of UniProt entries to return.
+        timeout: Timeout in seconds for connecting and for each read of the stream.
+        url: URL of the stream endpoint of UniProtKB.
+
+    Yields:
+        UniProt entries with their cross-references.
+    """
+    request_url = _build_stream_url(query, url)
+    logger.info("Streaming UniProt entries from %s", request_url)
+    nr_entries = 0
+    with urllib.request.urlopen(request_url, timeout=timeout) as response:  # noqa: S310 url is http(s)
+        for result in _iter_json_results(response):
+            yield _entry_from_result(result)
+            nr_entries += 1
+            if nr_entries >= limit:
+                break
+    limit_check("Search for uniprot entries", limit, nr_entries)
@@ -1,13 +1,254 @@
 import asyncio
-from collections.abc import Iterable
-from contextlib import asynccontextmanager
+import logging
+import time
+from collections.abc import AsyncGenerator, AsyncIterable, Awaitable, Callable, Coroutine, Iterable, Sized
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from typing import Any
+from urllib.parse import urlsplit
 
 import aiofiles
 import aiohttp
 from aiohttp_retry import ExponentialRetry, RetryClient
 from tqdm.asyncio import tqdm
 
+from protein_detective.instrumentation import instrumentation, timed
+from protein_detective.validation import DownloadValidator, InvalidDownloadError
+
+logger = logging.getLogger(__name__)
+
+
+def run_async[R](coro: Coroutine[Any, Any, R]) -> R:
+    """Run a coroutine to completion from synchronous code.
+
+    When called from a thread that already runs an event loop (like a Jupyter notebook),
+    the coroutine is run in a new event loop in a separate thread.
+
+    Args:
+        coro: The coroutine to run.
+
+    Returns:
+        The result of the coroutine.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+throttle_statuses = {429, 503}
+"""HTTP statuses with which a server tells us to slow down."""
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """Parse the value of a Retry-After header.
+
+    Args:
+        value: Either a number of seconds or a HTTP date.
+
+    Returns:
+        The number of seconds to wait or None if value could not be parsed.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+@dataclass
+class _HostState:
+    limit: float
+    in_flight: int = 0
+    latency: float | None = None
+    blocked_until: float = 0.0
+    last_decrease: float = 0.0
+    condition: asyncio.Condition | None = None
+
+
+class AdaptiveLimiter:
+    """Limits the number of concurrent requests per host with additive increase/multiplicative decrease (AIMD).
+
+    Each host starts with `initial_concurrency` slots.
+    Every successful request adds `increase / limit` slots, so the limit grows by about `increase` per round trip.
+    When a host responds with 429 or 503, or a request takes more than `latency_spike` times
+    the running average latency, the limit is multiplied by `decrease`.
+    A Retry-After header pauses all requests to that host for the requested time.
+
+    Examples:
+        >>> limiter = AdaptiveLimiter(max_concurrency=10)
+        >>> async with limiter.limit("https://alphafold.ebi.ac.uk/files/AF-P05067-F1-model_v4.pdb"):
+        >>>     ...
+
+    Args:
+        max_concurrency: Maximum number of concurrent requests per host.
+        min_concurrency: Minimum number of concurrent requests per host.
+        initial_concurrency: Number of concurrent requests per host to start with.
+            Defaults to half of max_concurrency.
+        increase: Number of slots added after a round trip of successful requests.
+        decrease: Factor with which the limit is multiplied when a host is overloaded.
+        latency_spike: Ratio of request latency to average latency that is considered overloaded.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 5,
+        min_concurrency: int = 1,
+        initial_concurrency: int | None = None,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_spike: float = 3.0,
+    ):
+        if min_concurrency < 1 or max_concurrency < min_concurrency:
+            msg = f"Invalid concurrency bounds: min={min_concurrency}, max={max_concurrency}"
+            raise ValueError(msg)
+        if initial_concurrency is None:
+            initial_concurrency = max(max_concurrency // 2, min_concurrency)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.initial_concurrency = min(max(initial_concurrency, min_concurrency), max_concurrency)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_spike = latency_spike
+        self._hosts: dict[str, _HostState] = {}
+
+    def _state(self, host: str) -> _HostState:
+        if host not in self._hosts:
+            self._hosts[host] = _HostState(limit=self.initial_concurrency)
+        return self._hosts[host]
+
+    def concurrency(self, host: str) -> int:
+        """Current number of allowed concurrent requests for a host."""
+        return int(self._state(host).limit)
+
+    @asynccontextmanager
+    async def limit(self, url: str) -> AsyncGenerator[None]:
+        """Wait for a free slot for the host of the url.
+
+        Throttle responses raised as `aiohttp.ClientResponseError` inside the context
+        shrink the limit of the host, successful requests grow it.
+
+        Args:
+            url: The URL that is going to be requested.
+        """
+        host = urlsplit(url).hostname or ""
+        state = self._state(host)
+        if state.condition is None:
+            state.condition = asyncio.Condition()
+        condition = state.condition
+        async with condition:
+            while True:
+                delay = state.blocked_until - time.monotonic()
+                if delay > 0:
+                    with suppress(TimeoutError):
+                        await asyncio.wait_for(condition.wait(), delay)
+                    continue
+                if state.in_flight < int(state.limit):
+                    break
+                await condition.wait()
+            state.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield
+        except aiohttp.ClientResponseError as e:
+            if e.status in throttle_statuses:
+                retry_after = _parse_retry_after(e.headers.get("Retry-After") if e.headers else None)
+                self.throttle(host, retry_after)
+            raise
+        else:
+            self._record_success(host, time.monotonic() - start)
+        finally:
+            async with condition:
+                state.in_flight -= 1
+                condition.notify_all()
+
+    def throttle(self, host: str, retry_after: float | None = None):
+        """Shrink the limit of a host, because it told us to slow down.
+
+        Args:
+            host: The host that was overloaded.
+            retry_after: Number of seconds to pause all requests to the host.
+        """
+        state = self._state(host)
+        now = time.monotonic()
+        if retry_after is not None:
+            state.blocked_until = max(state.blocked_until, now + retry_after)
+        self._decrease(state, now)
+
+    def _decrease(self, state: _HostState, now: float):
+        # Requests that were in flight together tend to fail together,
+        # so only back off once per round trip.
+        if now - state.last_decrease < (state.latency or 1.0):
+            return
+        state.last_decrease = now
+        state.limit = max(state.limit * self.decrease, self.min_concurrency)
+        logger.debug("Decreased concurrency to %.1f", state.limit)
+
+    def _record_success(self, host: str, latency: float):
+        state = self._state(host)
+        if state.latency is not None and latency > self.latency_spike * state.latency:
+            self._decrease(state, time.monotonic())
+        else:
+            state.limit = min(state.limit + self.increase / state.limit, self.max_concurrency)
+        # Exponentially weighted moving average of latency
+        state.latency = latency if state.latency is None else 0.8 * state.latency + 0.2 * latency
+
+
+retries_stage = "utils.friendly_session"
+"""Instrumentation stage that counts all retries of requests and downloads made with a friendly session."""
+
+
+class FriendlyRetry(ExponentialRetry):
+    """Exponential retry that also retries throttled requests and honors the Retry-After header.
+
+    Args:
+        attempts: The number of attempts.
+        limiter: When given, throttled responses shrink the limit of the host in the limiter.
+        **kwargs: Other arguments passed to `aiohttp_retry.ExponentialRetry`.
+    """
+
+    def __init__(self, attempts: int = 3, limiter: AdaptiveLimiter | None = None, **kwargs: Any):
+        super().__init__(attempts=attempts, statuses=throttle_statuses, **kwargs)
+        self.limiter = limiter
+
+    def get_timeout(self, attempt: int, response: aiohttp.ClientResponse | None = None) -> float:
+        # Called once before each retry
+        instrumentation.count(retries_stage, retries=1)
+        timeout = super().get_timeout(attempt, response)
+        if response is None or response.status not in throttle_statuses:
+            return timeout
+        retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+        if self.limiter is not None:
+            self.limiter.throttle(response.url.host or "", retry_after)
+        if retry_after is None:
+            return timeout
+        return max(timeout, retry_after)
+
+
+class FriendlyClient(RetryClient):
+    """Retry client with an adaptive per host concurrency limiter.
+
+    Args:
+        limiter: The limiter to use for requests made with this client.
+        *args: Arguments passed to `aiohttp_retry.RetryClient`.
+        **kwargs: Keyword arguments passed to `aiohttp_retry.RetryClient`.
+    """
+
+    def __init__(self, *args: Any, limiter: AdaptiveLimiter, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
 
 async def retrieve_files(
     urls: Iterable[tuple[str, str]],
@@ -16,68 +257,261 @@ async def retrieve_files(
     retries: int = 3,
     total_timeout: int = 300,
     desc: str = "Downloading files",
+    session: FriendlyClient | None = None,
+    validator: DownloadValidator | None = None,
 ) -> list[Path]:
     """Retrieve files from a list of URLs and save them to a directory.
 
+    The number of parallel downloads per host adapts to how the server responds,
+    see [AdaptiveLimiter][protein_detective.utils.AdaptiveLimiter].
+
     Args:
         urls: A list of tuples, where each tuple contains a URL and a filename.
         save_dir: The directory to save the downloaded files to.
-        max_parallel_downloads: The maximum number of files to download in parallel.
+        max_parallel_downloads: The maximum number of files to download in parallel from a single host.
         retries: The number of times to retry a failed download.
         total_timeout: The total timeout for a download in seconds.
         desc: Description for the progress bar.
+        session: Session to download with. If None, a new session is created for these downloads.
+        validator: Validator to check downloads with while they are written.
+            If None, the length and format of each download are checked.
 
     Returns:
-        A list of paths to the downloaded files.
+        A list of paths to the downloaded files, in the order they finished downloading.
+    """
+    return [
+        path
+        async for path in iter_retrieve_files(
+            urls,
+            save_dir,
+            max_parallel_downloads=max_parallel_downloads,
+            retries=retries,
+            total_timeout=total_timeout,
+            desc=desc,
+            session=session,
+            validator=validator,
+        )
+    ]
+
+
+async def iter_retrieve_files(
+    urls: Iterable[tuple[str, str]] | AsyncIterable[tuple[str, str]],
+    save_dir: Path,
+    max_parallel_downloads: int = 5,
+    retries: int = 3,
+    total_timeout: int = 300,
+    desc: str = "Downloading files",
+    session: FriendlyClient | None = None,
+    validator: DownloadValidator | None = None,
+) -> AsyncGenerator[Path]:
+    """Retrieve files from URLs and yield their paths as they finish downloading.
+
+    A fixed number of workers pull URLs from `urls` one at a time,
+    so memory use does not grow with the number of URLs.
+
+    Examples:
+        >>> urls = ((f"https://www.ebi.ac.uk/pdbe/entry-files/download/{i}.cif", f"{i}.cif") for i in pdb_ids)
+        >>> async for path in iter_retrieve_files(urls, Path("downloads")):
+        >>>     print(path)
+
+    Args:
+        urls: (Async) iterable of tuples, where each tuple contains a URL and a filename.
+        save_dir: The directory to save the downloaded files to.
+        max_parallel_downloads: The maximum number of files to download in parallel from a single host.
+            Also the number of workers.
+        retries: The number of times to retry a failed download.
+        total_timeout: The total timeout for a download in seconds.
+        desc: Description for the progress bar.
+        session: Session to download with. If None, a new session is created for these downloads.
+            Retries and timeout of a given session are used instead of `retries` and `total_timeout`.
+        validator: Validator to check downloads with while they are written.
+            Invalid downloads are retried. If None, the length and format of each download are checked.
+
+    Yields:
+        Paths to the downloaded files, in the order they finished downloading.
     """
     save_dir.mkdir(parents=True, exist_ok=True)
-    semaphore = asyncio.Semaphore(max_parallel_downloads)
-    async with friendly_session(retries, total_timeout) as session:
-        tasks = [_retrieve_file(session, url, save_dir / filename, semaphore) for url, filename in urls]
-        files: list[Path] = await tqdm.gather(*tasks, desc=desc)
-        return files
+    total = len(urls) if isinstance(urls, Sized) else None
+    if validator is None:
+        validator = DownloadValidator()
+    async with reuse_session(session, retries, total_timeout, max_parallel_downloads) as client:
+        with tqdm(total=total, desc=desc) as progress:
+            async for path in _worker_pool(
+                urls,
+                lambda url, filename: _retrieve_file(client, url, save_dir / filename, validator=validator),
+                max_parallel_downloads,
+            ):
+                progress.update()
+                yield path
+
+
+_done = object()
+
+
+def _shared_next(items: Iterable | AsyncIterable) -> Callable[[], Awaitable[Any]]:
+    """Return a coroutine function that returns the next item or `_done`, safe to call from concurrent tasks."""
+    if isinstance(items, AsyncIterable):
+        iterator = aiter(items)
+        lock = asyncio.Lock()
+
+        async def next_async_item():
+            async with lock:
+                return await anext(iterator, _done)
+
+        return next_async_item
 
+    sync_iterator = iter(items)
+
+    async def next_item():
+        return next(sync_iterator, _done)
+
+    return next_item
+
+
+async def _worker_pool[R](
+    items: Iterable[tuple] | AsyncIterable[tuple],
+    work: Callable[..., Awaitable[R]],
+    nr_workers: int,
+) -> AsyncGenerator[R]:
+    """Run `work` on items with a fixed number of workers and yield results as they finish.
+
+    At most `nr_workers` items are in progress and
+    at most `nr_workers` results are waiting to be consumed.
+
+    Args:
+        items: (Async) iterable of tuples, each tuple is unpacked as arguments to `work`.
+        work: The coroutine function to call for each item.
+        nr_workers: The number of workers.
 
+    Yields:
+        Results of `work`.
+
+    Raises:
+        Exception: The first exception raised by `work`. Other workers are cancelled.
+    """
+    next_item = _shared_next(items)
+    results: asyncio.Queue = asyncio.Queue(maxsize=nr_workers)
+
+    async def worker():
+        while (item := await next_item()) is not _done:
+            await results.put(await work(*item))
+
+    async def run_workers():
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(nr_workers):
+                    tg.create_task(worker())
+        except BaseExceptionGroup as e:
+            # Report the first failure like asyncio.gather would
+            await results.put(e.exceptions[0])
+        else:
+            await results.put(_done)
+
+    runner = asyncio.create_task(run_workers())
+    try:
+        while (result := await results.get()) is not _done:
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+    finally:
+        runner.cancel()
+        with suppress(asyncio.CancelledError):
+            await runner
+
+
+@timed
 async def _retrieve_file(
-    session: RetryClient,
+    session: FriendlyClient,
     url: str,
     save_path: Path,
-    semaphore: asyncio.Semaphore,
     ovewrite: bool = False,
     chunk_size: int = 131072,  # 128 KiB
+    validator: DownloadValidator | None = None,
 ) -> Path:
     """Retrieve a single file from a URL and save it to a specified path.
 
+    The file is written to a `.part` file next to `save_path` and
+    only renamed to `save_path` when the download is complete and valid.
+    Invalid downloads are retried as many times as the session retries failed requests.
+
     Args:
         session: The aiohttp session to use for the request.
         url: The URL to download the file from.
         save_path: The path where the file should be saved.
-        semaphore: A semaphore to limit the number of concurrent downloads.
         ovewrite: Whether to overwrite the file if it already exists.
         chunk_size: The size of each chunk to read from the response.
+        validator: Validator to check the download with while it is being written.
+            If None, the download is not validated.
 
     Returns:
         The path to the saved file.
+
+    Raises:
+        InvalidDownloadError: If the last attempt to download the file was invalid.
     """
     if save_path.exists():
         if ovewrite:
             save_path.unlink()
         else:
             return save_path
+    part_path = save_path.with_name(save_path.name + ".part")
+    attempts = session.retry_options.attempts
+    for attempt in range(1, attempts + 1):
+        try:
+            await _download(session, url, part_path, save_path, chunk_size, validator)
+        except InvalidDownloadError:
+            part_path.unlink(missing_ok=True)
+            if attempt == attempts:
+                raise
+            instrumentation.count(retries_stage, retries=1)
+            logger.warning("Invalid download of %s, retrying (attempt %d of %d)", url, attempt + 1, attempts)
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            raise
+        else:
+            part_path.replace(save_path)
+            break
+    return save_path
+
+
+async def _download(
+    session: FriendlyClient,
+    url: str,
+    part_path: Path,
+    save_path: Path,
+    chunk_size: int,
+    validator: DownloadValidator | None,
+):
     async with (
-        semaphore,
-        aiofiles.open(save_path, "xb") as f,
+        session.limiter.limit(url),
+        aiofiles.open(part_path, "wb") as f,
         session.get(url) as resp,
     ):
         resp.raise_for_status()
+        validation = validator.stream(save_path, resp.headers) if validator else None
+        nbytes = 0
         async for chunk in resp.content.iter_chunked(chunk_size):
+            nbytes += len(chunk)
+            if validation:
+                validation.update(chunk)
             await f.write(chunk)
-    return save_path
+        instrumentation.count("utils._retrieve_file", nbytes=nbytes)
+        if validation:
+            validation.finish()
 
 
 @asynccontextmanager
-async def friendly_session(retries: int = 3, total_timeout: int = 300):
-    """Create an aiohttp session with retry capabilities.
+async def friendly_session(
+    retries: int = 3,
+    total_timeout: int = 300,
+    max_parallel_per_host: int = 5,
+    keepalive_timeout: float = 60,
+    dns_cache_ttl: int = 600,
+) -> AsyncGenerator[FriendlyClient]:
+    """Create an aiohttp session with retry capabilities and an adaptive per host concurrency limiter.
+
+    The session keeps connections alive and caches DNS lookups,
+    so it is worthwhile to reuse a single session for many requests to the same hosts.
 
     Examples:
         Use as async context:
@@ -91,9 +525,44 @@ async def friendly_session(retries: int = 3, total_timeout: int = 300):
     Args:
         retries: The number of retry attempts for failed requests.
         total_timeout: The total timeout for a request in seconds.
+        max_parallel_per_host: The maximum number of concurrent requests per host
+            for requests made within `session.limiter.limit(url)`.
+            Also the maximum number of open connections per host.
+        keepalive_timeout: Seconds to keep an idle connection open for reuse.
+        dns_cache_ttl: Seconds to cache resolved host names.
     """
-    retry_options = ExponentialRetry(attempts=retries)
+    limiter = AdaptiveLimiter(max_concurrency=max_parallel_per_host)
+    retry_options = FriendlyRetry(attempts=retries, limiter=limiter)
     timeout = aiohttp.ClientTimeout(total=total_timeout)  # pyrefly: ignore false positive
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        client = RetryClient(client_session=session, retry_options=retry_options)
+    connector = aiohttp.TCPConnector(
+        limit_per_host=max_parallel_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=dns_cache_ttl,
+    )
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        client = FriendlyClient(client_session=session, retry_options=retry_options, limiter=limiter)
         yield client
+
+
+@asynccontextmanager
+async def reuse_session(
+    session: FriendlyClient | None,
+    retries: int = 3,
+    total_timeout: int = 300,
+    max_parallel_per_host: int = 5,
+) -> AsyncGenerator[FriendlyClient]:
+    """Use the given session or create a new friendly session if None is given.
+
+    A given session is not closed on exit, the caller owns it.
+
+    Args:
+        session: The session to reuse or None.
+        retries: The number of retry attempts for failed requests of a new session.
+        total_timeout: The total timeout for a request in seconds of a new session.
+        max_parallel_per_host: The maximum number of concurrent requests per host of a new session.
+    """
+    if session is not None:
+        yield session
+        return
+    async with friendly_session(retries, total_timeout, max_parallel_per_host) as new_session:
+        yield new_session
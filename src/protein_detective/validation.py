@@ -0,0 +1,195 @@
+"""Validation of downloads while they are being written to disk.
+
+Catches truncated downloads and error pages served in place of structure files,
+before they fail much later while being parsed.
+"""
+
+import hashlib
+import re
+import zlib
+from collections.abc import Callable, Mapping
+from dataclasses import dataclass, field
+from pathlib import Path
+
+
+class InvalidDownloadError(Exception):
+    """Raised when a downloaded file is truncated or not in the format expected from its file name."""
+
+
+def _is_pdb(head: bytes) -> bool:
+    # First line is a record like HEADER, REMARK, ATOM or MODEL
+    return re.match(rb"[A-Z][A-Z0-9]{0,5}(\s|$)", head) is not None
+
+
+def _is_mmcif(head: bytes) -> bool:
+    # Optional comment lines followed by a data block
+    return re.match(rb"\s*(#[^\n]*\n\s*)*data_", head) is not None
+
+
+def _is_bcif(head: bytes) -> bool:
+    # BinaryCIF is a MessagePack map
+    return len(head) > 0 and (0x80 <= head[0] <= 0x8F or head[0] in (0xDE, 0xDF))
+
+
+def _is_json(head: bytes) -> bool:
+    return head.lstrip()[:1] in (b"{", b"[")
+
+
+def _is_png(head: bytes) -> bool:
+    return head.startswith(b"\x89PNG\r\n\x1a\n")
+
+
+def _is_gzip(head: bytes) -> bool:
+    return head.startswith(b"\x1f\x8b")
+
+
+def _is_not_html(head: bytes) -> bool:
+    start = head.lstrip()[:14].lower()
+    return not (start.startswith((b"<!doctype html", b"<html")))
+
+
+format_sniffers: dict[str, Callable[[bytes], bool]] = {
+    ".pdb": _is_pdb,
+    ".ent": _is_pdb,
+    ".cif": _is_mmcif,
+    ".bcif": _is_bcif,
+    ".json": _is_json,
+    ".png": _is_png,
+    ".gz": _is_gzip,
+}
+"""Functions that check whether the first bytes of a file look like the format of the file extension."""
+
+
+def looks_like(filename: str | Path, head: bytes) -> bool:
+    """Check whether the first bytes of a file look like the format expected from its file name.
+
+    Files with an unknown extension are only checked for not being a HTML page.
+
+    Args:
+        filename: The name of the file. Its extension determines the expected format.
+        head: The first bytes of the file, a few hundred bytes is enough.
+
+    Returns:
+        True if the bytes look like the expected format.
+    """
+    suffix = Path(filename).suffix.lower()
+    sniffer = format_sniffers.get(suffix, _is_not_html)
+    return sniffer(head)
+
+
+_sniff_size = 512
+
+
+@dataclass
+class DownloadValidator:
+    """Validates downloads while they are streamed to disk.
+
+    Examples:
+        >>> validator = DownloadValidator(hash_algorithm="sha256")
+        >>> await retrieve_files(urls, save_dir, validator=validator)
+        >>> validator.digests
+        {PosixPath('downloads/8was.cif'): 'e3b0c442...'}
+
+    Parameters:
+        check_length: Whether the number of received bytes should match the Content-Length header.
+        check_format: Whether the first bytes should look like the format of the file extension.
+            For gzipped files the whole stream is decompressed to catch truncated archives.
+        hash_algorithm: Name of the [hashlib][] algorithm to compute a digest of each download with,
+            for example "sha256". No digests are computed when None.
+        digests: Hex digests of the downloaded files, filled when hash_algorithm is set.
+    """
+
+    check_length: bool = True
+    check_format: bool = True
+    hash_algorithm: str | None = None
+    digests: dict[Path, str] = field(default_factory=dict)
+
+    def stream(self, save_path: Path, headers: Mapping[str, str] | None = None) -> "StreamValidation":
+        """Start validating a single download.
+
+        Args:
+            save_path: The path where the download will be saved.
+            headers: The headers of the response.
+
+        Returns:
+            The validation state to feed chunks to.
+        """
+        return StreamValidation(self, save_path, headers)
+
+
+class StreamValidation:
+    """Validation state of a single download, see [DownloadValidator][protein_detective.validation.DownloadValidator].
+
+    Args:
+        validator: The validator with the checks to perform.
+        save_path: The path where the download will be saved.
+        headers: The headers of the response.
+    """
+
+    def __init__(self, validator: DownloadValidator, save_path: Path, headers: Mapping[str, str] | None = None):
+        self.validator = validator
+        self.save_path = save_path
+        self.size = 0
+        self.expected_size: int | None = None
+        if validator.check_length and headers is not None and "Content-Encoding" not in headers:
+            # aiohttp decompresses encoded bodies, so the length header does not match the bytes we get
+            content_length = headers.get("Content-Length")
+            self.expected_size = int(content_length) if content_length and content_length.isdigit() else None
+        self._head = b"" if validator.check_format else None
+        self._hash = hashlib.new(validator.hash_algorithm) if validator.hash_algorithm else None
+        self._gunzip = (
+            zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            if validator.check_format and save_path.suffix.lower() == ".gz"
+            else None
+        )
+
+    def update(self, chunk: bytes):
+        """Feed the next chunk of the download.
+
+        Args:
+            chunk: The bytes received.
+
+        Raises:
+            InvalidDownloadError: If the chunk shows the download is invalid.
+        """
+        self.size += len(chunk)
+        if self._hash is not None:
+            self._hash.update(chunk)
+        if self._head is not None:
+            self._head += chunk
+            if len(self._head) >= _sniff_size:
+                self._check_head()
+        if self._gunzip is not None:
+            try:
+                # Only interested in whether it can be decompressed, so keep output small
+                self._gunzip.decompress(chunk, 65536)
+                while self._gunzip.unconsumed_tail:
+                    self._gunzip.decompress(self._gunzip.unconsumed_tail, 65536)
+            except zlib.error as e:
+                msg = f"Download of {self.save_path} is not a valid gzip file: {e}"
+                raise InvalidDownloadError(msg) from e
+
+    def _check_head(self):
+        if self._head is None:
+            return
+        head = self._head
+        self._head = None
+        if not looks_like(self.save_path, head):
+            msg = f"Download of {self.save_path} does not look like a {self.save_path.suffix} file: {head[:40]!r}"
+            raise InvalidDownloadError(msg)
+
+    def finish(self):
+        """Check the download after the last chunk and record its digest.
+
+        Raises:
+            InvalidDownloadError: If the download is invalid.
+        """
+        self._check_head()
+        if self.expected_size is not None and self.size != self.expected_size:
+            msg = f"Download of {self.save_path} is truncated: got {self.size} of {self.expected_size} bytes"
+            raise InvalidDownloadError(msg)
+        if self._gunzip is not None and not self._gunzip.eof:
+            msg = f"Download of {self.save_path} is a truncated gzip file"
+            raise InvalidDownloadError(msg)
+        if self._hash is not None:
+            self.validator.digests[self.save_path] = self._hash.hexdigest()
@@ -1,56 +1,174 @@
 """Workflow steps"""
 
+import logging
+from collections.abc import Awaitable, Callable, Iterable, Iterator, Mapping
+from concurrent.futures import Executor, as_completed
 from dataclasses import dataclass
+from datetime import timedelta
+from itertools import batched
 from pathlib import Path
-from typing import Literal
+from typing import TYPE_CHECKING, Literal
 
-from protein_detective.alphafold import DownloadableFormat
-from protein_detective.alphafold import fetch_many as af_fetch
+from duckdb import DuckDBPyConnection
+
+from protein_detective.alphafold import AlphaFoldEntry, DownloadableFormat, entry_fields
 from protein_detective.alphafold import relative_to as af_relative_to
-from protein_detective.alphafold.density import DensityFilterQuery, filter_on_density
+from protein_detective.alphafold.density import (
+    DensityFilteredRow,
+    DensityFilterQuery,
+    DensityFilterResult,
+    density_filtered_file,
+    density_filtered_fingerprint,
+    filter_on_density,
+    filter_out_low_confidence_residues,
+    parse_residue_ranges,
+)
 from protein_detective.db import (
     connect,
+    delete_packed_files,
     load_alphafold_ids,
     load_alphafolds,
+    load_density_filter_results,
+    load_density_filtered,
+    load_fresh_uniprot_accessions,
+    load_output_fingerprints,
+    load_packed_files,
     load_pdb_ids,
     load_pdbs,
     save_alphafolds,
     save_alphafolds_files,
     save_density_filtered,
+    save_output_fingerprints,
+    save_packed_files,
     save_pdb_files,
     save_pdbs,
     save_query,
+    save_refreshed,
     save_single_chain_pdb_files,
     save_uniprot_accessions,
 )
-from protein_detective.pdbe.fetch import fetch as pdbe_fetch
-from protein_detective.pdbe.io import write_single_chain_pdb_files
+from protein_detective.gene_ontology import load_go_ontology
+from protein_detective.packed import PackedFile, PackedStore
+from protein_detective.pdbe.io import (
+    ProteinPdbRow,
+    SingleChainResult,
+    first_chain_from_uniprot_chains,
+    single_chain_pdb_file,
+    write_single_chain_pdb_file_for_row,
+    write_single_chain_pdb_files,
+)
+from protein_detective.shards import Shard
+from protein_detective.shards import write_density_filtered as write_density_filtered_shard
+from protein_detective.shards import write_retrieved as write_retrieved_shard
+from protein_detective.shards import write_single_chain_pdb_files as write_single_chain_pdb_files_shard
 from protein_detective.uniprot import Query, search4af, search4pdb, search4uniprot
-
-
-def search_structures_in_uniprot(query: Query, session_dir: Path, limit: int = 10_000) -> tuple[int, int, int]:
+from protein_detective.uniprot_rest import iter_search4structures
+from protein_detective.writer import SessionWriter, reuse_writer
+
+if TYPE_CHECKING:
+    from protein_detective.utils import FriendlyClient
+
+logger = logging.getLogger(__name__)
+
+SearchBackend = Literal["sparql", "rest"]
+"""Backends to search UniProt with."""
+search_backend_choices: set[SearchBackend] = {"sparql", "rest"}
+"""Set of backends to search UniProt with."""
+
+
+def _stream_structures_from_uniprot(
+    query: Query, limit: int, session_writer: SessionWriter
+) -> tuple[set[str], set[str], set[str]]:
+    uniprot_accessions: set[str] = set()
+    pdb_ids: set[str] = set()
+    af_ids: set[str] = set()
+    last_saved = None
+    for batch in batched(iter_search4structures(query, limit), session_writer.batch_size, strict=False):
+        pdbs = {entry.uniprot_acc: entry.pdbs for entry in batch}
+        afs = {entry.uniprot_acc: set(entry.alphafolds) for entry in batch}
+        # Saves the accessions without PDB entries too
+        session_writer.submit(save_pdbs, pdbs)
+        session_writer.submit(save_alphafolds, afs)
+        last_saved = session_writer.submit(save_refreshed, list(pdbs))
+        uniprot_accessions.update(pdbs)
+        pdb_ids.update(pdb.id for entry in batch for pdb in entry.pdbs)
+        af_ids.update(af_id for entry in batch for af_id in entry.alphafolds)
+    if last_saved is not None:
+        last_saved.result()
+    return uniprot_accessions, pdb_ids, af_ids
+
+
+def search_structures_in_uniprot(
+    query: Query,
+    session_dir: Path,
+    limit: int = 10_000,
+    writer: SessionWriter | None = None,
+    incremental: bool = False,
+    refresh_after: timedelta | None = None,
+    go_ontology: Path | None = None,
+    backend: SearchBackend = "sparql",
+) -> tuple[int, int, int]:
     """Searches for protein structures in UniProt database.
 
     Args:
         query: The search query.
         session_dir: The directory to store the search results.
         limit: The maximum number of results to return from each database query.
+        writer: Writer of the session database. If None, a writer is opened for this step.
+        incremental: Only search PDB and AlphaFold cross-references of UniProt accessions
+            that are new to the session or whose cross-references are older than `refresh_after`.
+            Cross-references that were removed from UniProt are kept in the session.
+        refresh_after: In incremental mode, how long ago cross-references may have been searched
+            before they are searched again. If None, they are never searched again.
+        go_ontology: Local copy of the Gene Ontology, see
+            [load_go_ontology][protein_detective.gene_ontology.load_go_ontology].
+            If given, GO terms of the query are searched as a list of the term and its descendants.
+        backend: How to search UniProt. With "sparql" the UniProt accessions, their PDB entries and
+            their AlphaFold entries are searched with a SPARQL query each.
+            With "rest" they are streamed from the UniProt REST API in one request and saved while streaming.
+            As all cross-references are in the stream, `incremental` and `go_ontology` are not supported.
 
     Returns:
         A tuple containing the number of UniProt accessions, the number of PDB structures,
         and the number of AlphaFold structures found.
+        In incremental mode, only the structures of the searched cross-references are counted.
+
+    Raises:
+        ValueError: If `backend` is unknown, or is "rest" with `incremental` or `go_ontology`.
     """
+    if backend not in search_backend_choices:
+        msg = f"Invalid backend: {backend}. Must be one of {search_backend_choices}."
+        raise ValueError(msg)
+    if backend == "rest" and (incremental or go_ontology is not None):
+        msg = "The rest backend does not support incremental searches or a local Gene Ontology."
+        raise ValueError(msg)
     session_dir.mkdir(parents=True, exist_ok=True)
 
-    uniprot_accessions = search4uniprot(query, limit)
-    pdbs = search4pdb(uniprot_accessions, limit=limit)
-    af_result = search4af(uniprot_accessions, limit=limit)
-
-    with connect(session_dir) as con:
-        save_query(query, con)
-        save_uniprot_accessions(uniprot_accessions, con)
-        save_pdbs(pdbs, con)
-        save_alphafolds(af_result, con)
+    if backend == "rest":
+        with reuse_writer(session_dir, writer) as session_writer:
+            session_writer.submit(save_query, query)
+            uniprot_ids, pdb_ids, af_ids = _stream_structures_from_uniprot(query, limit, session_writer)
+        return len(uniprot_ids), len(pdb_ids), len(af_ids)
+
+    ontology = None if go_ontology is None else load_go_ontology(go_ontology)
+    uniprot_accessions = search4uniprot(query, limit, go_ontology=ontology)
+
+    with reuse_writer(session_dir, writer) as session_writer:
+        to_refresh = uniprot_accessions
+        if incremental:
+            with session_writer.reader() as con:
+                to_refresh = uniprot_accessions - load_fresh_uniprot_accessions(con, refresh_after)
+            logger.info(
+                "Searching cross-references of %d of %d UniProt accessions", len(to_refresh), len(uniprot_accessions)
+            )
+        pdbs = search4pdb(to_refresh, limit=limit) if to_refresh else {}
+        af_result = search4af(to_refresh, limit=limit) if to_refresh else {}
+
+        session_writer.submit(save_query, query)
+        session_writer.submit(save_uniprot_accessions, uniprot_accessions)
+        session_writer.submit(save_pdbs, pdbs)
+        session_writer.submit(save_alphafolds, af_result)
+        session_writer.submit(save_refreshed, to_refresh).result()
 
     nr_pdbs = len(set().union(*pdbs.values()))
     nr_afs = len(set().union(*af_result.values()))
@@ -64,19 +182,93 @@ what_retrieve_choices: set[WhatRetrieve] = {"pdbe", "alphafold"}
 
 
 def retrieve_structures(
-    session_dir: Path, what: set[WhatRetrieve] | None = None, what_af_formats: set[DownloadableFormat] | None = None
+    session_dir: Path,
+    what: set[WhatRetrieve] | None = None,
+    what_af_formats: set[DownloadableFormat] | None = None,
+    max_parallel_downloads: int = 5,
+    shard: Shard | None = None,
+    writer: SessionWriter | None = None,
+    pdb_mirror: Path | None = None,
+    alphafold_mirror: Path | None = None,
+) -> tuple[Path, int, int]:
+    """Retrieve structure files from PDBe and AlphaFold databases for the Uniprot entries in the session.
+
+    Synchronous wrapper around [retrieve_structures_async][protein_detective.workflow.retrieve_structures_async].
+
+    Args:
+        session_dir: The directory to store downloaded files and the session database.
+        what: A tuple of strings indicating which databases to retrieve files from.
+        what_af_formats: A tuple of formats to download from AlphaFold (e.g., "pdb", "cif").
+        max_parallel_downloads: The maximum number of parallel downloads per host.
+        shard: Only retrieve the structures of this shard and write the results to a shard file
+            instead of the session database. Use `protein_detective.shards.merge_shards` to merge them.
+        writer: Writer of the session database. If None, a writer is opened for this step.
+        pdb_mirror: Directory of a wwPDB mirror with divided mmCIF files, to link PDBe files from.
+        alphafold_mirror: Directory with AlphaFold files, to link AlphaFold files from.
+
+    Returns:
+        A tuple containing the download directory, the number of PDBe mmCIF files downloaded,
+        and the number of AlphaFold files downloaded.
+    """
+    from protein_detective.utils import run_async  # noqa: PLC0415 only import HTTP stack when needed
+
+    return run_async(
+        retrieve_structures_async(
+            session_dir,
+            what,
+            what_af_formats,
+            max_parallel_downloads,
+            shard=shard,
+            writer=writer,
+            pdb_mirror=pdb_mirror,
+            alphafold_mirror=alphafold_mirror,
+        )
+    )
+
+
+async def retrieve_structures_async(
+    session_dir: Path,
+    what: set[WhatRetrieve] | None = None,
+    what_af_formats: set[DownloadableFormat] | None = None,
+    max_parallel_downloads: int = 5,
+    session: "FriendlyClient | None" = None,
+    shard: Shard | None = None,
+    writer: SessionWriter | None = None,
+    pdb_mirror: Path | None = None,
+    alphafold_mirror: Path | None = None,
+    executor: Executor | None = None,
 ) -> tuple[Path, int, int]:
     """Retrieve structure files from PDBe and AlphaFold databases for the Uniprot entries in the session.
 
+    PDBe and AlphaFold files are downloaded concurrently using a single HTTP session.
+    Structures of which the files are packed are not downloaded again,
+    see [load_packed_retrieved][protein_detective.workflow.load_packed_retrieved].
+    Opening, reading and writing the session database blocks, so it runs on an executor
+    instead of the event loop.
+
     Args:
         session_dir: The directory to store downloaded files and the session database.
         what: A tuple of strings indicating which databases to retrieve files from.
         what_af_formats: A tuple of formats to download from AlphaFold (e.g., "pdb", "cif").
+        max_parallel_downloads: The maximum number of parallel downloads per host.
+        session: HTTP session to download with. If None, a new session is created.
+        shard: Only retrieve the structures of this shard and write the results to a shard file
+            instead of the session database. Use `protein_detective.shards.merge_shards` to merge them.
+        writer: Writer of the session database. If None, a writer is opened for this step.
+        pdb_mirror: Directory of a wwPDB mirror with divided mmCIF files, to link PDBe files from.
+        alphafold_mirror: Directory with AlphaFold files, to link AlphaFold files from.
+        executor: Executor for the blocking work on the session database.
+            If None, the default executor of the event loop is used.
 
     Returns:
         A tuple containing the download directory, the number of PDBe mmCIF files downloaded,
         and the number of AlphaFold files downloaded.
     """
+    # Only import HTTP stack when needed
+    import asyncio  # noqa: PLC0415
+
+    loop = asyncio.get_running_loop()
+
     session_dir.mkdir(parents=True, exist_ok=True)
     download_dir = session_dir / "downloads"
     download_dir.mkdir(parents=True, exist_ok=True)
@@ -87,34 +279,181 @@ def retrieve_structures(
         msg = f"Invalid 'what' argument: {what}. Must be a subset of {what_retrieve_choices}."
         raise ValueError(msg)
 
-    sr_mmcif_files = {}
-    if "pdbe" in what:
-        # mmCIF files from PDBe for the Uniprot entries in the session.
-        pdb_ids = set()
-        with connect(session_dir) as con:
-            pdb_ids = load_pdb_ids(con)
+    if shard is not None:
+        pdb_ids, af_ids = await loop.run_in_executor(
+            executor, _read_ids_to_retrieve, session_dir, what, what_af_formats
+        )
+        pdb_ids = {pdb_id for pdb_id in pdb_ids if pdb_id in shard}
+        af_ids = {af_id for af_id in af_ids if af_id in shard}
+        mmcif_files: dict[str, Path] = {}
+        afs: list[AlphaFoldEntry] = []
+
+        async def keep_mmcif_files(files: dict[str, Path]):
+            mmcif_files.update(files)
+
+        async def keep_afs(entries: list[AlphaFoldEntry]):
+            afs.extend(entries)
+
+        try:
+            await _retrieve(
+                session_dir,
+                pdb_ids,
+                af_ids,
+                what_af_formats,
+                max_parallel_downloads,
+                session,
+                pdb_mirror,
+                alphafold_mirror,
+                keep_mmcif_files,
+                keep_afs,
+            )
+        finally:
+            # When one database failed, the results of the other are still written
+            if mmcif_files or afs:
+                await loop.run_in_executor(executor, write_retrieved_shard, session_dir, shard, mmcif_files, afs)
+        return download_dir, len(mmcif_files), len(afs)
+
+    session_writer = writer if writer is not None else await loop.run_in_executor(executor, SessionWriter, session_dir)
+    try:
+        pdb_ids, af_ids = await loop.run_in_executor(
+            executor, _read_ids_to_retrieve_with, session_writer, what, what_af_formats
+        )
 
-        mmcif_files = pdbe_fetch(pdb_ids, download_dir)
+        async def save_mmcif_files(files: dict[str, Path]):
+            await asyncio.wrap_future(session_writer.submit(save_pdb_files, files))
+
+        async def save_afs(entries: list[AlphaFoldEntry]):
+            await asyncio.wrap_future(session_writer.submit(save_alphafolds_files, entries))
+
+        nr_mmcif_files, nr_afs = await _retrieve(
+            session_dir,
+            pdb_ids,
+            af_ids,
+            what_af_formats,
+            max_parallel_downloads,
+            session,
+            pdb_mirror,
+            alphafold_mirror,
+            save_mmcif_files,
+            save_afs,
+        )
+    finally:
+        if writer is None:
+            await loop.run_in_executor(executor, session_writer.close)
 
-        # make paths relative to session_dir, so db stores paths relative to session_dir
-        sr_mmcif_files = {pdb_id: mmcif_file.relative_to(session_dir) for pdb_id, mmcif_file in mmcif_files.items()}
-        with connect(session_dir) as con:
-            save_pdb_files(sr_mmcif_files, con)
+    return download_dir, nr_mmcif_files, nr_afs
 
-    afs = []
-    if "alphafold" in what:
-        # AlphaFold entries for the given query
-        af_ids = set()
-        with connect(session_dir) as con:
-            af_ids = load_alphafold_ids(con)
 
-        afs = af_fetch(af_ids, download_dir, what=what_af_formats)
+def load_packed_retrieved(
+    what_af_formats: set[DownloadableFormat] | None, con: DuckDBPyConnection
+) -> tuple[dict[str, Path], dict[str, AlphaFoldEntry]]:
+    """Load the retrieved structures of which the files are packed.
 
-        sr_afs = [af_relative_to(af, session_dir) for af in afs]
-        with connect(session_dir) as con:
-            save_alphafolds_files(sr_afs, con)
+    Packing removes the downloaded files, so checking whether a file exists
+    is not enough to know whether a structure has to be downloaded again.
+
+    Args:
+        what_af_formats: The AlphaFold formats that are retrieved. Defaults to {"pdb"}.
+            An AlphaFold entry is only returned when its files of all these formats are packed.
+        con: The DuckDB connection to use for fetching the data.
 
-    return download_dir, len(sr_mmcif_files), len(afs)
+    Returns:
+        The packed mmCIF file per PDB ID and the AlphaFold entries with packed files per UniProt accession,
+        with paths relative to the session directory.
+    """
+    if what_af_formats is None:
+        what_af_formats = {"pdb"}
+    packed = {packed_file.path for packed_file in load_packed_files(con)}
+    if not packed:
+        return {}, {}
+    mmcif_files = {row.id: row.mmcif_file for row in load_pdbs(con) if row.mmcif_file in packed}
+    afs = {
+        af.uniprot_acc: af
+        for af in load_alphafolds(con)
+        if all(getattr(af, entry_fields[fmt]) in packed for fmt in what_af_formats)
+    }
+    return mmcif_files, afs
+
+
+def _load_ids_to_retrieve(
+    what: set[WhatRetrieve], what_af_formats: set[DownloadableFormat] | None, con: DuckDBPyConnection
+) -> tuple[set[str], set[str]]:
+    # mmCIF files from PDBe and AlphaFold entries for the Uniprot entries in the session,
+    # except those that are already retrieved and packed.
+    packed_mmcif_files, packed_afs = load_packed_retrieved(what_af_formats, con)
+    pdb_ids = load_pdb_ids(con) - packed_mmcif_files.keys() if "pdbe" in what else set()
+    af_ids = load_alphafold_ids(con) - packed_afs.keys() if "alphafold" in what else set()
+    return pdb_ids, af_ids
+
+
+def _read_ids_to_retrieve(
+    session_dir: Path, what: set[WhatRetrieve], what_af_formats: set[DownloadableFormat] | None
+) -> tuple[set[str], set[str]]:
+    with connect(session_dir, read_only=True) as con:
+        return _load_ids_to_retrieve(what, what_af_formats, con)
+
+
+def _read_ids_to_retrieve_with(
+    writer: SessionWriter, what: set[WhatRetrieve], what_af_formats: set[DownloadableFormat] | None
+) -> tuple[set[str], set[str]]:
+    with writer.reader() as con:
+        return _load_ids_to_retrieve(what, what_af_formats, con)
+
+
+async def _retrieve(
+    session_dir: Path,
+    pdb_ids: set[str],
+    af_ids: set[str],
+    what_af_formats: set[DownloadableFormat] | None,
+    max_parallel_downloads: int,
+    session: "FriendlyClient | None",
+    pdb_mirror: Path | None,
+    alphafold_mirror: Path | None,
+    save_mmcif_files: Callable[[dict[str, Path]], Awaitable[None]],
+    save_afs: Callable[[list[AlphaFoldEntry]], Awaitable[None]],
+) -> tuple[int, int]:
+    """Retrieve the files of both databases and save the results of each database as soon as it is done.
+
+    A failure of one database does not cancel the other, so the results of the other are still saved.
+    The first failure is raised afterwards.
+    Paths are saved relative to session_dir, so the database stores paths relative to session_dir.
+    """
+    import asyncio  # noqa: PLC0415
+
+    from protein_detective.alphafold.fetch import fetch_many_list_async as af_fetch_async  # noqa: PLC0415
+    from protein_detective.pdbe.fetch import fetch_async as pdbe_fetch_async  # noqa: PLC0415
+    from protein_detective.utils import reuse_session  # noqa: PLC0415
+
+    download_dir = session_dir / "downloads"
+
+    async def pdbe(client: "FriendlyClient") -> int:
+        mmcif_files = await pdbe_fetch_async(
+            pdb_ids, download_dir, max_parallel_downloads, session=client, mirror_dir=pdb_mirror
+        )
+        await save_mmcif_files(
+            {pdb_id: mmcif_file.relative_to(session_dir) for pdb_id, mmcif_file in mmcif_files.items()}
+        )
+        return len(mmcif_files)
+
+    async def alphafold(client: "FriendlyClient") -> int:
+        afs = await af_fetch_async(
+            af_ids,
+            download_dir,
+            what=what_af_formats,
+            max_parallel_downloads=max_parallel_downloads,
+            session=client,
+            mirror_dir=alphafold_mirror,
+        )
+        await save_afs([af_relative_to(af, session_dir) for af in afs])
+        return len(afs)
+
+    async with reuse_session(session, max_parallel_per_host=max_parallel_downloads) as client:
+        nr_mmcif_files, nr_afs = await asyncio.gather(pdbe(client), alphafold(client), return_exceptions=True)
+    if isinstance(nr_mmcif_files, BaseException):
+        raise nr_mmcif_files
+    if isinstance(nr_afs, BaseException):
+        raise nr_afs
+    return nr_mmcif_files, nr_afs
 
 
 @dataclass
@@ -122,72 +461,527 @@ class DensityFilterSessionResult:
     """Stats of density filtering.
 
     Parameters:
-        density_filtered_dir: The directory where the filtered PDB files are stored.
+        density_filtered_dir: The directory where the filtered PDB files are stored or will be materialized.
         nr_kept: The number of structures that were kept after filtering.
         nr_discarded: The number of structures that were discarded after filtering.
+        nr_unchanged: The number of kept or discarded structures that were not filtered again,
+            because their structure file did not change since the previous run of the same density filter.
     """
 
     density_filtered_dir: Path
     nr_kept: int
     nr_discarded: int
-
-
-def density_filter(session_dir: Path, query: DensityFilterQuery) -> DensityFilterSessionResult:
+    nr_unchanged: int = 0
+
+
+def density_filter(
+    session_dir: Path,
+    query: DensityFilterQuery,
+    shard: Shard | None = None,
+    writer: SessionWriter | None = None,
+    packed: bool = False,
+    eager: bool = False,
+    executor: Executor | None = None,
+) -> DensityFilterSessionResult:
     """Filter the AlphaFoldDB structures based on density confidence.
 
     In AlphaFold PDB files, the b-factor column has the
     predicted local distance difference test (pLDDT).
     All residues with a b-factor above the confidence threshold are counted.
     Then if the count is outside the min and max threshold, the structure is filtered out.
-    The remaining structures have the residues with a b-factor below the confidence threshold removed.
-    And are written to the session_dir / "density_filtered" directory.
+    For the remaining structures the residues with a b-factor above the confidence threshold
+    are stored in the session database.
+    Use [materialize][protein_detective.workflow.materialize] to write the structures
+    without the other residues to the directory of the confidence threshold,
+    see [density_filtered_dir_of][protein_detective.workflow.density_filtered_dir_of].
+
+    Structures whose file did not change since a previous run of the same density filter are not filtered again.
+    Density filtered files are written again when their structure file or the confidence threshold changed,
+    see [PackedStore.fingerprint][protein_detective.packed.PackedStore.fingerprint].
 
     Args:
         session_dir: The directory where the session database is stored.
         query: The density filter query containing the confidence thresholds.
+        shard: Only filter the structures of this shard and write the results to a shard file
+            instead of the session database. Use `protein_detective.shards.merge_shards` to merge them.
+        writer: Writer of the session database. If None, a writer is opened for this step.
+            Results are saved in batches while filtering.
+        packed: Append the filtered structures to a pack file of the session,
+            instead of writing a file per structure. See `protein_detective.packed`.
+            Only has effect when eager, as otherwise no structures are written.
+        eager: Write the filtered structures while filtering, instead of when they are materialized.
+        executor: Executor to filter on, like a process pool.
+            Structures are sent to it in batches and the results are saved by the writer in this process,
+            so worker processes never open the session database.
+            If None, structures are filtered in this thread. Ignored for shards.
 
     Returns:
         Stats of density filtering.
+
+    Raises:
+        ValueError: If both shard and packed are given.
     """
-    density_filtered_dir = session_dir / "density_filtered"
+    if shard is not None and packed:
+        msg = "Packed output is not supported for shards"
+        raise ValueError(msg)
+    density_filtered_dir = density_filtered_dir_of(session_dir, query)
     density_filtered_dir.mkdir(parents=True, exist_ok=True)
 
-    with connect(session_dir) as conn:
-        afs = load_alphafolds(conn)
-        alphafold_pdb_files = [session_dir / e.pdb_file for e in afs if e.pdb_file is not None]
-        uniproc_accs = [e.uniprot_acc for e in afs]
-
-        density_filtered = list(filter_on_density(alphafold_pdb_files, query, density_filtered_dir))
-        for e in density_filtered:
-            if e.density_filtered_file is not None:
-                e.density_filtered_file = e.density_filtered_file.relative_to(session_dir)
-
-        save_density_filtered(
-            query,
-            density_filtered,
-            uniproc_accs,
-            conn,
-        )
-        nr_kept = len([e for e in density_filtered if e.density_filtered_file is not None])
-        nr_discarded = len(density_filtered) - nr_kept
-        return DensityFilterSessionResult(
-            density_filtered_dir=density_filtered_dir,
-            nr_kept=nr_kept,
-            nr_discarded=nr_discarded,
-        )
+    results: list[tuple[str, DensityFilterResult]] = []
+    if shard is not None:
+        with connect(session_dir, read_only=True) as conn:
+            afs = [e for e in load_alphafolds(conn) if e.uniprot_acc in shard]
+            packed_files = load_packed_files(conn)
+            previous = load_density_filter_results(query, conn)
+            fingerprints = load_output_fingerprints(conn)
+        with PackedStore(session_dir, packed_files) as store:
+            afs, unchanged = _changed_alphafolds(afs, query, session_dir, store, eager, previous, fingerprints)
+            filtered = _filter_on_density(afs, query, session_dir, density_filtered_dir, store, eager, fingerprints)
+            results.extend(filtered)
+        write_density_filtered_shard(session_dir, shard, query, results)
+    else:
+        with reuse_writer(session_dir, writer) as session_writer:
+            with session_writer.reader() as conn:
+                afs = load_alphafolds(conn)
+                packed_files = load_packed_files(conn)
+                previous = load_density_filter_results(query, conn)
+                fingerprints = load_output_fingerprints(conn)
+            saved = []
+            with PackedStore(session_dir, packed_files, pack_writes=packed) as store:
+                afs, unchanged = _changed_alphafolds(afs, query, session_dir, store, eager, previous, fingerprints)
+                batches = _density_filtered_batches(
+                    afs,
+                    query,
+                    session_dir,
+                    density_filtered_dir,
+                    store,
+                    eager,
+                    fingerprints,
+                    session_writer.batch_size,
+                    executor,
+                )
+                for batch, added in batches:
+                    files = [result for _, result in batch]
+                    uniprot_accs = [uniprot_acc for uniprot_acc, _ in batch]
+                    saved.append(session_writer.submit(save_packed_files, added))
+                    saved.append(session_writer.submit(save_density_filtered, query, files, uniprot_accs))
+                    results.extend(batch)
+            for future in saved:
+                future.result()
+
+    all_results = [result for _, result in results] + unchanged
+    nr_kept = len([e for e in all_results if e.density_filtered_file is not None])
+    nr_discarded = len(all_results) - nr_kept
+    return DensityFilterSessionResult(
+        density_filtered_dir=density_filtered_dir,
+        nr_kept=nr_kept,
+        nr_discarded=nr_discarded,
+        nr_unchanged=len(unchanged),
+    )
+
+
+def density_filtered_dir_of(session_dir: Path, query: DensityFilterQuery) -> Path:
+    """Directory in a session of the structures filtered by a density filter.
+
+    Each confidence threshold has its own directory, so the structures of different density filters
+    exist side by side. Density filters that only differ in their min and max threshold share a directory,
+    as they keep the same residues of a structure.
 
+    Args:
+        session_dir: The directory where the session database is stored.
+        query: The density filter query.
 
-def prune_pdbs(session_dir: Path) -> tuple[Path, int]:
+    Returns:
+        The directory, like `session_dir / "density_filtered" / "confidence_70"`.
+    """
+    return session_dir / "density_filtered" / f"confidence_{query.confidence:g}"
+
+
+def _take_added(store: PackedStore) -> list[PackedFile]:
+    # Packed files must be on disk before the database refers to them
+    store.flush()
+    added, store.added = store.added, []
+    return added
+
+
+def _changed_alphafolds(
+    afs: Iterable[AlphaFoldEntry],
+    query: DensityFilterQuery,
+    session_dir: Path,
+    store: PackedStore,
+    eager: bool,
+    previous: Mapping[str, DensityFilterResult],
+    fingerprints: Mapping[Path, str],
+) -> tuple[list[AlphaFoldEntry], list[DensityFilterResult]]:
+    """Split entries into those that need filtering and the saved results of those that are up to date."""
+    changed = []
+    unchanged = []
+    for entry in afs:
+        result = previous.get(entry.uniprot_acc)
+        if entry.pdb_file is None or result is None:
+            changed.append(entry)
+            continue
+        input_fingerprint = store.fingerprint(session_dir / entry.pdb_file)
+        is_current = result.input_fingerprint == input_fingerprint
+        if is_current and eager and result.density_filtered_file is not None:
+            # Eager filtering also needs an up to date density filtered file
+            is_current = fingerprints.get(result.density_filtered_file) == density_filtered_fingerprint(
+                input_fingerprint, query.confidence
+            ) and store.exists(session_dir / result.density_filtered_file)
+        if is_current:
+            unchanged.append(result)
+        else:
+            changed.append(entry)
+    return changed, unchanged
+
+
+type _Batch[R] = tuple[list[R], list[PackedFile]]
+"""Results of a batch of structures and the files that were packed for them."""
+
+
+def _files_of(
+    paths: Iterable[Path], store: PackedStore, fingerprints: Mapping[Path, str]
+) -> tuple[list[PackedFile], dict[Path, str]]:
+    """The packed files and output fingerprints of session relative paths.
+
+    Workers get only those of the files they read or write, as sending those of the whole session is slow.
+    """
+    paths = set(paths)
+    return (
+        [store.index[path] for path in paths if path in store.index],
+        {path: fingerprints[path] for path in paths if path in fingerprints},
+    )
+
+
+def _density_filtered_batches(
+    afs: list[AlphaFoldEntry],
+    query: DensityFilterQuery,
+    session_dir: Path,
+    density_filtered_dir: Path,
+    store: PackedStore,
+    eager: bool,
+    fingerprints: Mapping[Path, str],
+    batch_size: int,
+    executor: Executor | None,
+) -> Iterator[_Batch[tuple[str, DensityFilterResult]]]:
+    if executor is None:
+        filtered = _filter_on_density(afs, query, session_dir, density_filtered_dir, store, eager, fingerprints)
+        for batch in batched(filtered, batch_size, strict=False):
+            yield list(batch), _take_added(store)
+        return
+    relative_dir = density_filtered_dir.relative_to(session_dir)
+    futures = []
+    for batch in batched(afs, batch_size, strict=False):
+        pdb_files = [e.pdb_file for e in batch if e.pdb_file is not None]
+        outputs = [density_filtered_file(pdb_file, relative_dir) for pdb_file in pdb_files]
+        packed_files, batch_fingerprints = _files_of(pdb_files + outputs, store, fingerprints)
+        futures.append(
+            executor.submit(
+                _density_filter_batch,
+                list(batch),
+                query,
+                session_dir,
+                density_filtered_dir,
+                packed_files,
+                batch_fingerprints,
+                store.pack_writes,
+                eager,
+            )
+        )
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def _density_filter_batch(
+    afs: list[AlphaFoldEntry],
+    query: DensityFilterQuery,
+    session_dir: Path,
+    density_filtered_dir: Path,
+    packed_files: list[PackedFile],
+    fingerprints: dict[Path, str],
+    packed: bool,
+    eager: bool,
+) -> _Batch[tuple[str, DensityFilterResult]]:
+    """Density filter a batch of structures in a worker."""
+    with PackedStore(session_dir, packed_files, pack_writes=packed) as store:
+        filtered = list(_filter_on_density(afs, query, session_dir, density_filtered_dir, store, eager, fingerprints))
+        return filtered, _take_added(store)
+
+
+def _session_paths(session_dir: Path, fingerprints: Mapping[Path, str]) -> dict[Path, str]:
+    # The database stores paths relative to the session directory
+    return {session_dir / path: fingerprint for path, fingerprint in fingerprints.items()}
+
+
+def _filter_on_density(
+    afs: Iterable[AlphaFoldEntry],
+    query: DensityFilterQuery,
+    session_dir: Path,
+    density_filtered_dir: Path,
+    store: PackedStore | None = None,
+    eager: bool = True,
+    fingerprints: Mapping[Path, str] | None = None,
+) -> Iterator[tuple[str, DensityFilterResult]]:
+    afs_with_file = [e for e in afs if e.pdb_file is not None]
+    alphafold_pdb_files = [session_dir / e.pdb_file for e in afs_with_file if e.pdb_file is not None]
+    if fingerprints is not None:
+        fingerprints = _session_paths(session_dir, fingerprints)
+    density_filtered = filter_on_density(alphafold_pdb_files, query, density_filtered_dir, store, eager, fingerprints)
+    for e, result in zip(afs_with_file, density_filtered, strict=True):
+        if result.density_filtered_file is not None:
+            result.density_filtered_file = result.density_filtered_file.relative_to(session_dir)
+        yield e.uniprot_acc, result
+
+
+def prune_pdbs(
+    session_dir: Path,
+    shard: Shard | None = None,
+    writer: SessionWriter | None = None,
+    packed: bool = False,
+    executor: Executor | None = None,
+) -> tuple[Path, int]:
     """Prune the PDB files to only keep the first chain of the found Uniprot entries.
 
     And rename that chain to A.
+    Single chain PDB files are only written again when their mmCIF file or chain changed since they were written,
+    see [PackedStore.fingerprint][protein_detective.packed.PackedStore.fingerprint].
+
+    Args:
+        session_dir: The directory where the session database is stored.
+        shard: Only prune the PDB files of this shard and write the results to a shard file
+            instead of the session database. Use `protein_detective.shards.merge_shards` to merge them.
+        writer: Writer of the session database. If None, a writer is opened for this step.
+            Results are saved in batches while pruning.
+        packed: Append the single chain PDB files to a pack file of the session,
+            instead of writing a file per structure. See `protein_detective.packed`.
+        executor: Executor to prune on, like a process pool.
+            PDB entries are sent to it in batches and the results are saved by the writer in this process,
+            so worker processes never open the session database.
+            If None, PDB entries are pruned in this thread. Ignored for shards.
+
+    Returns:
+        A tuple containing the directory with the single chain PDB files and the number of files written.
+
+    Raises:
+        ValueError: If both shard and packed are given.
     """
+    if shard is not None and packed:
+        msg = "Packed output is not supported for shards"
+        raise ValueError(msg)
     single_chain_dir = session_dir / "single_chain"
     single_chain_dir.mkdir(parents=True, exist_ok=True)
 
-    with connect(session_dir) as conn:
-        proteinpdbs = load_pdbs(conn)
-        new_files = list(write_single_chain_pdb_files(proteinpdbs, session_dir, single_chain_dir))
-        save_single_chain_pdb_files(new_files, conn)
-
+    if shard is not None:
+        with connect(session_dir, read_only=True) as conn:
+            proteinpdbs = [row for row in load_pdbs(conn) if row.id in shard]
+            packed_files = load_packed_files(conn)
+            fingerprints = _session_paths(session_dir, load_output_fingerprints(conn))
+        with PackedStore(session_dir, packed_files) as store:
+            new_files = list(
+                write_single_chain_pdb_files(proteinpdbs, session_dir, single_chain_dir, store, fingerprints)
+            )
+        write_single_chain_pdb_files_shard(session_dir, shard, new_files)
         return single_chain_dir, len(new_files)
+
+    nr_files = 0
+    with reuse_writer(session_dir, writer) as session_writer:
+        with session_writer.reader() as conn:
+            proteinpdbs = load_pdbs(conn)
+            packed_files = load_packed_files(conn)
+            fingerprints = load_output_fingerprints(conn)
+        saved = []
+        with PackedStore(session_dir, packed_files, pack_writes=packed) as store:
+            batches = _single_chain_batches(
+                proteinpdbs, session_dir, single_chain_dir, store, fingerprints, session_writer.batch_size, executor
+            )
+            for batch, added in batches:
+                saved.append(session_writer.submit(save_packed_files, added))
+                saved.append(session_writer.submit(save_single_chain_pdb_files, batch))
+                nr_files += len(batch)
+        for future in saved:
+            future.result()
+
+    return single_chain_dir, nr_files
+
+
+def _single_chain_batches(
+    proteinpdbs: list[ProteinPdbRow],
+    session_dir: Path,
+    single_chain_dir: Path,
+    store: PackedStore,
+    fingerprints: Mapping[Path, str],
+    batch_size: int,
+    executor: Executor | None,
+) -> Iterator[_Batch[SingleChainResult]]:
+    if executor is None:
+        new_files = write_single_chain_pdb_files(
+            proteinpdbs, session_dir, single_chain_dir, store, _session_paths(session_dir, fingerprints)
+        )
+        for batch in batched(new_files, batch_size, strict=False):
+            yield list(batch), _take_added(store)
+        return
+    relative_dir = single_chain_dir.relative_to(session_dir)
+    futures = []
+    for batch in batched(proteinpdbs, batch_size, strict=False):
+        paths = []
+        for row in batch:
+            if row.mmcif_file is not None:
+                chain2keep = first_chain_from_uniprot_chains(row.uniprot_chains)
+                paths.append(row.mmcif_file)
+                paths.append(single_chain_pdb_file(row.mmcif_file, chain2keep, row.uniprot_acc, relative_dir))
+        packed_files, batch_fingerprints = _files_of(paths, store, fingerprints)
+        futures.append(
+            executor.submit(
+                _prune_batch,
+                list(batch),
+                session_dir,
+                single_chain_dir,
+                packed_files,
+                batch_fingerprints,
+                store.pack_writes,
+            )
+        )
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def _prune_batch(
+    proteinpdbs: list[ProteinPdbRow],
+    session_dir: Path,
+    single_chain_dir: Path,
+    packed_files: list[PackedFile],
+    fingerprints: dict[Path, str],
+    packed: bool,
+) -> _Batch[SingleChainResult]:
+    """Prune a batch of PDB entries in a worker."""
+    session_fingerprints = _session_paths(session_dir, fingerprints)
+    new_files = []
+    with PackedStore(session_dir, packed_files, pack_writes=packed) as store:
+        for row in proteinpdbs:
+            result = write_single_chain_pdb_file_for_row(
+                row, session_dir, single_chain_dir, store, session_fingerprints
+            )
+            if result is not None:
+                new_files.append(result)
+        return new_files, _take_added(store)
+
+
+packable_dirs = ("downloads", "density_filtered", "single_chain")
+"""Directories of a session with structure files that can be packed."""
+
+
+def pack_session(session_dir: Path, directories: Iterable[str] = packable_dirs) -> int:
+    """Move the structure files of a session into pack files.
+
+    Files are removed after their location in the pack is saved in the session database.
+    Symlinks, like those to files in a mirror, and `.part` files of unfinished downloads are left alone.
+
+    Args:
+        session_dir: The directory where the session database is stored.
+        directories: Directories in the session to pack the files of.
+
+    Returns:
+        The number of packed files.
+    """
+    files = [
+        file
+        for directory in directories
+        for file in sorted((session_dir / directory).rglob("*"))
+        if file.is_file() and not file.is_symlink() and file.suffix != ".part"
+    ]
+    with connect(session_dir) as con:
+        with PackedStore(session_dir, pack_writes=True) as store:
+            for file in files:
+                store.add(file.relative_to(session_dir), file.read_bytes())
+        save_packed_files(store.added, con)
+    for file in files:
+        file.unlink()
+    return len(files)
+
+
+def materialize(session_dir: Path, paths: Iterable[Path] = (), output_dir: Path | None = None) -> list[Path]:
+    """Write files of a session that are not on disk, for tools that need files.
+
+    These are the packed files and the density filtered structures that were not filtered eagerly.
+    Density filtered structures are written from their AlphaFoldDB file and the residues kept by the filter,
+    to the directory of the confidence threshold of the filter,
+    see [density_filtered_dir_of][protein_detective.workflow.density_filtered_dir_of].
+    Files that already exist in the output directory are not written again,
+    except packed files of another size and density filtered structures in the session directory that are out of date.
+    Packed files materialized in the session directory are unpacked,
+    so they are read from disk and a later [pack_session][protein_detective.workflow.pack_session] packs them again.
+
+    Args:
+        session_dir: The directory where the session database is stored.
+        paths: Session relative paths of files or directories to write. If empty, all files are written.
+        output_dir: Directory to write files to, under their session relative path.
+            If None, files are written to where they would have been in the session directory.
+
+    Returns:
+        Paths of the written files.
+    """
+    if output_dir is None:
+        output_dir = session_dir
+    wanted = list(paths)
+
+    def is_wanted(path: Path) -> bool:
+        return not wanted or any(path.is_relative_to(wanted_path) for wanted_path in wanted)
+
+    with connect(session_dir) as con:
+        packed_files = load_packed_files(con)
+        density_filtered = load_density_filtered(con)
+        fingerprints = load_output_fingerprints(con)
+    written = []
+    unpacked = []
+    with PackedStore(session_dir, packed_files) as store:
+        for packed_file in packed_files:
+            if not is_wanted(packed_file.path):
+                continue
+            unpacked.append(packed_file.path)
+            output_file = output_dir / packed_file.path
+            if output_file.exists() and output_file.stat().st_size == packed_file.size:
+                continue
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            output_file.write_bytes(store.read_bytes(session_dir / packed_file.path))
+            written.append(output_file)
+
+        rows = [row for row in density_filtered if is_wanted(row.density_filtered_file)]
+        new_fingerprints = _materialize_density_filtered(rows, session_dir, output_dir, store, fingerprints)
+    written.extend(output_dir / path for path in new_fingerprints)
+
+    if output_dir == session_dir and (new_fingerprints or unpacked):
+        with connect(session_dir) as con:
+            con.begin()
+            delete_packed_files(unpacked, con)
+            save_output_fingerprints(new_fingerprints, con)
+            con.commit()
+    return written
+
+
+def _materialize_density_filtered(
+    rows: Iterable[DensityFilteredRow],
+    session_dir: Path,
+    output_dir: Path,
+    store: PackedStore,
+    fingerprints: Mapping[Path, str],
+) -> dict[Path, str]:
+    """Write density filtered structures that are not packed, returns the fingerprints of the written files."""
+    # Density filters with the same confidence threshold keep the same residues at the same path,
+    # see density_filtered_dir_of, so each path is written once.
+    lazy_files: dict[Path, DensityFilteredRow] = {}
+    for row in rows:
+        if row.density_filtered_file not in store.index:
+            lazy_files.setdefault(row.density_filtered_file, row)
+    written = {}
+    for path, row in lazy_files.items():
+        output_file = output_dir / path
+        fingerprint = density_filtered_fingerprint(store.fingerprint(session_dir / row.pdb_file), row.confidence)
+        # Only files in the session directory have a known fingerprint
+        if output_file.exists() and (output_dir != session_dir or fingerprints.get(path) == fingerprint):
+            continue
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        filter_out_low_confidence_residues(
+            session_dir / row.pdb_file, parse_residue_ranges(row.kept_residues), output_file, store, overwrite=True
+        )
+        written[path] = fingerprint
+    return written
@@ -0,0 +1,182 @@
+"""Single writer of a session database.
+
+DuckDB allows only one process to open a database read-write,
+and a connection can not be used by many threads at the same time.
+A `SessionWriter` owns the read-write connection of a session and
+writes batches of results from a queue in its own thread, committing them in transactions.
+Other threads or tasks of the same process submit results to it and read from it with cursors on the same database,
+so workflow steps can run at the same time on one session.
+Worker processes do not open the database, they return their results to the process that owns the writer,
+see the `executor` argument of [density_filter][protein_detective.workflow.density_filter].
+
+A writer can not be shared with another program, like a second CLI invocation on the same session.
+To run steps of several programs on one session at the same time, submit them as jobs to the server,
+which owns the writer of each session with running jobs, see `protein_detective.server`.
+"""
+
+import queue
+import threading
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from duckdb import DuckDBPyConnection
+
+from protein_detective.db import connect
+
+
+@dataclass
+class _Write:
+    save: Callable[..., Any]
+    args: tuple[Any, ...]
+    future: Future = field(default_factory=Future)
+
+
+class SessionWriter:
+    """Writes to a session database from a single thread.
+
+    Use as a context manager, on exit all submitted writes are committed and the connection is closed.
+
+    Example:
+        ```python
+        with SessionWriter(session_dir) as writer:
+            with writer.reader() as con:
+                afs = load_alphafolds(con)
+            writer.submit(save_density_filtered, query, results, uniprot_accessions)
+        ```
+
+    Args:
+        session_dir: The directory where the session database is stored.
+        batch_size: Maximum number of queued writes to commit in one transaction.
+            Also a hint for callers on how many results to submit at once.
+    """
+
+    def __init__(self, session_dir: Path, batch_size: int = 100):
+        self.session_dir = session_dir
+        self.batch_size = batch_size
+        self._stack = ExitStack()
+        self._con: DuckDBPyConnection = self._stack.enter_context(connect(session_dir))
+        # Cursors are connections to the same database that can be used from another thread
+        self._write_con = self._con.cursor()
+        self._cursor_lock = threading.Lock()
+        self._queue: queue.SimpleQueue[_Write | None] = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=f"session-writer-{session_dir.name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, save: Callable[..., Any], *args: Any) -> Future:
+        """Submit a write.
+
+        Args:
+            save: Function that writes, called as `save(*args, con)`, like the save functions in
+                `protein_detective.db`.
+            *args: Arguments for the save function, without the connection.
+
+        Returns:
+            Future with the return value of the save function,
+            which is set after the transaction with the write has been committed.
+            Use `asyncio.wrap_future` to await it.
+
+        Raises:
+            RuntimeError: If the writer is closed.
+        """
+        if not self._thread.is_alive():
+            msg = "Session writer is closed"
+            raise RuntimeError(msg)
+        write = _Write(save, args)
+        self._queue.put(write)
+        return write.future
+
+    def flush(self):
+        """Wait until all writes submitted so far are committed."""
+        self.submit(_noop).result()
+
+    @contextmanager
+    def reader(self) -> Iterator[DuckDBPyConnection]:
+        """Connection for reading the session database from the current thread.
+
+        Sees all writes that have been committed when the connection was made.
+
+        Yields:
+            The DuckDB connection.
+        """
+        with self._cursor_lock:
+            cursor = self._con.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def close(self):
+        """Commit all submitted writes and close the connection."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._write_con.close()
+        self._stack.close()
+
+    def __enter__(self) -> "SessionWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            write = self._queue.get()
+            if write is None:
+                break
+            batch = [write]
+            while len(batch) < self.batch_size:
+                try:
+                    write = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if write is None:
+                    stop = True
+                    break
+                batch.append(write)
+            self._write(batch)
+
+    def _write(self, batch: list[_Write]):
+        con = self._write_con
+        try:
+            con.begin()
+            results = [write.save(*write.args, con) for write in batch]
+            con.commit()
+        except Exception as e:  # noqa: BLE001 error is passed to the future of the failed write
+            con.rollback()
+            if len(batch) > 1:
+                # Retry one by one, so only the failed write fails
+                for write in batch:
+                    self._write([write])
+            else:
+                batch[0].future.set_exception(e)
+            return
+        for write, result in zip(batch, results, strict=True):
+            write.future.set_result(result)
+
+
+def _noop(_con: DuckDBPyConnection):
+    pass
+
+
+@contextmanager
+def reuse_writer(session_dir: Path, writer: SessionWriter | None = None) -> Iterator[SessionWriter]:
+    """Yield the given writer, or create a new one that is closed on exit.
+
+    Args:
+        session_dir: The directory where the session database is stored.
+        writer: Writer to reuse. If None, a new writer is created.
+
+    Yields:
+        The session writer.
+    """
+    if writer is not None:
+        yield writer
+        return
+    with SessionWriter(session_dir) as new_writer:
+        yield new_writer
@@ -2,7 +2,14 @@ from pathlib import Path
 
 import pytest
 
-from protein_detective.alphafold.density import filter_out_low_confidence_residues, find_high_confidence_residues
+from protein_detective.alphafold.density import (
+    DensityFilterQuery,
+    filter_on_density,
+    filter_out_low_confidence_residues,
+    find_high_confidence_residues,
+    format_residue_ranges,
+    parse_residue_ranges,
+)
 
 
 @pytest.fixture
@@ -23,3 +30,27 @@ def test_filter_out_low_confidence_residues(sample_pdb: Path, tmp_path: Path):
     filter_out_low_confidence_residues(sample_pdb, residues, out_pdb_file)
 
     assert out_pdb_file.stat().st_size < sample_pdb.stat().st_size
+
+
+@pytest.mark.parametrize(
+    ("residues", "ranges"),
+    [
+        (set(), ""),
+        ({5}, "5"),
+        ({1, 2, 3, 7, 9, 10}, "1-3,7,9-10"),
+    ],
+)
+def test_residue_ranges(residues: set[int], ranges: str):
+    assert format_residue_ranges(residues) == ranges
+    assert parse_residue_ranges(ranges) == residues
+
+
+def test_filter_on_density_lazy(sample_pdb: Path, tmp_path: Path):
+    query = DensityFilterQuery(confidence=90, min_threshold=1, max_threshold=100)
+
+    [result] = filter_on_density([sample_pdb], query, tmp_path, eager=False)
+
+    assert result.density_filtered_file == tmp_path / sample_pdb.name
+    assert not result.density_filtered_file.exists()
+    assert result.kept_residues is not None
+    assert parse_residue_ranges(result.kept_residues) == set(find_high_confidence_residues(sample_pdb, 90))
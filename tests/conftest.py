@@ -0,0 +1,54 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from protein_detective.alphafold import AlphaFoldEntry
+from protein_detective.alphafold.entry_summary import EntrySummary
+from protein_detective.db import connect, save_alphafolds, save_alphafolds_files, save_uniprot_accessions
+
+
+@pytest.fixture
+def af_summary() -> EntrySummary:
+    """Summary of the AlphaFold entry in tests/alpafold."""
+    return EntrySummary(
+        entryId="AF-A1YPR0-F1",
+        gene=None,
+        sequenceChecksum=None,
+        sequenceVersionDate=None,
+        uniprotAccession="A1YPR0",
+        uniprotId="A1YPR0_HUMAN",
+        uniprotDescription="Test",
+        taxId=9606,
+        organismScientificName="Homo sapiens",
+        uniprotStart=1,
+        uniprotEnd=2,
+        uniprotSequence="AA",
+        modelCreatedDate="2022-06-01T00:00:00Z",
+        latestVersion=4,
+        allVersions=[4],
+        bcifUrl="",
+        cifUrl="",
+        pdbUrl="https://alphafold.ebi.ac.uk/files/AF-A1YPR0-F1-model_v4.pdb",
+        paeImageUrl="",
+        paeDocUrl="",
+        amAnnotationsUrl=None,
+        amAnnotationsHg19Url=None,
+        amAnnotationsHg38Url=None,
+        isReviewed=None,
+        isReferenceProteome=None,
+    )
+
+
+@pytest.fixture
+def af_session_dir(tmp_path: Path, af_summary: EntrySummary) -> Path:
+    """Session with one AlphaFold entry with a downloaded PDB file."""
+    session_dir = tmp_path / "session"
+    (session_dir / "downloads").mkdir(parents=True)
+    shutil.copy(Path(__file__).parent / "alpafold" / "AF-A1YPR0-F1-model_v4.pdb", session_dir / "downloads")
+    entry = AlphaFoldEntry("A1YPR0", af_summary, pdb_file=Path("downloads/AF-A1YPR0-F1-model_v4.pdb"))
+    with connect(session_dir) as con:
+        save_uniprot_accessions(["A1YPR0"], con)
+        save_alphafolds({"A1YPR0": {"A1YPR0"}}, con)
+        save_alphafolds_files([entry], con)
+    return session_dir
@@ -0,0 +1,106 @@
+import gzip
+import io
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from protein_detective.alphafold import AlphaFoldEntry
+from protein_detective.archive import ArchiveMember, extract_member, index_path, load_index
+from protein_detective.mirror import AlphaFoldMirror, link_from_alphafold_mirror
+
+sample_pdb_file = Path(__file__).parent / "alpafold" / "AF-A1YPR0-F1-model_v4.pdb"
+
+
+@pytest.fixture
+def proteome_archive(tmp_path: Path) -> Path:
+    """Synthetic proteome archive with gzipped files, like the ones of the AlphaFold database."""
+    archive = tmp_path / "mirror" / "UP000005640_9606_HUMAN_v4.tar"
+    archive.parent.mkdir()
+    members = {
+        "AF-A1YPR0-F1-model_v4.pdb.gz": gzip.compress(sample_pdb_file.read_bytes()),
+        "AF-A1YPR0-F1-model_v4.cif.gz": gzip.compress(b"data_AF-A1YPR0-F1\n"),
+        "AF-P12345-F1-model_v4.cif.gz": gzip.compress(b"data_AF-P12345-F1\n"),
+    }
+    with tarfile.open(archive, "w") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return archive
+
+
+def test_load_index(proteome_archive: Path):
+    members = load_index(proteome_archive)
+
+    assert [member.name for member in members] == [
+        "AF-A1YPR0-F1-model_v4.pdb.gz",
+        "AF-A1YPR0-F1-model_v4.cif.gz",
+        "AF-P12345-F1-model_v4.cif.gz",
+    ]
+    assert index_path(proteome_archive).exists()
+
+
+def test_load_index_uses_stored_index(proteome_archive: Path, monkeypatch: pytest.MonkeyPatch):
+    members = load_index(proteome_archive)
+
+    def fail(*_):
+        msg = "archive should not be scanned again"
+        raise AssertionError(msg)
+
+    monkeypatch.setattr("protein_detective.archive.build_index", fail)
+    assert load_index(proteome_archive) == members
+
+
+def test_extract_member(proteome_archive: Path, tmp_path: Path):
+    member = next(m for m in load_index(proteome_archive) if m.name == "AF-P12345-F1-model_v4.cif.gz")
+
+    extracted = extract_member(member, tmp_path / "downloads")
+
+    assert extracted == tmp_path / "downloads" / "AF-P12345-F1-model_v4.cif.gz"
+    assert gzip.decompress(extracted.read_bytes()) == b"data_AF-P12345-F1\n"
+
+
+def test_extract_member_of_truncated_archive(proteome_archive: Path, tmp_path: Path):
+    member = ArchiveMember(proteome_archive, "AF-X-F1-model_v4.pdb.gz", proteome_archive.stat().st_size - 10, 100)
+
+    with pytest.raises(ValueError, match="ended before end of member"):
+        extract_member(member, tmp_path / "downloads")
+
+
+def test_link_from_alphafold_mirror_with_archive(proteome_archive: Path, tmp_path: Path):
+    save_dir = tmp_path / "downloads"
+
+    entries, missing = link_from_alphafold_mirror(
+        ["A1YPR0", "P12345"], proteome_archive.parent, save_dir, {"pdb", "cif"}
+    )
+
+    assert entries == [
+        AlphaFoldEntry(
+            "A1YPR0",
+            None,
+            pdb_file=save_dir / "AF-A1YPR0-F1-model_v4.pdb.gz",
+            cif_file=save_dir / "AF-A1YPR0-F1-model_v4.cif.gz",
+        )
+    ]
+    assert missing == {"P12345"}
+    assert gzip.decompress((save_dir / "AF-A1YPR0-F1-model_v4.pdb.gz").read_bytes()) == sample_pdb_file.read_bytes()
+    assert not (save_dir / "AF-P12345-F1-model_v4.cif.gz").exists()
+
+
+def test_alphafold_mirror_with_archive_is_scanned_once(proteome_archive: Path, monkeypatch: pytest.MonkeyPatch):
+    scans = []
+    scan = AlphaFoldMirror.scan
+
+    def counted_scan(*args, **kwargs):
+        scans.append(args)
+        return scan(*args, **kwargs)
+
+    monkeypatch.setattr(AlphaFoldMirror, "scan", counted_scan)
+
+    first = AlphaFoldMirror.load(proteome_archive.parent)
+    second = AlphaFoldMirror.load(proteome_archive.parent)
+
+    assert len(scans) == 1
+    assert second == first
+    assert index_path(proteome_archive).exists()
@@ -0,0 +1,58 @@
+import subprocess
+import sys
+
+import pytest
+
+from protein_detective.cli import backend_arguments_error, make_parser, search_backend_choices, what_retrieve_choices
+from protein_detective.workflow import search_backend_choices as workflow_search_backend_choices
+from protein_detective.workflow import what_retrieve_choices as workflow_what_retrieve_choices
+
+heavy_modules = ["aiohttp", "atomium", "duckdb", "SPARQLWrapper", "cattrs", "tqdm"]
+
+
+def imported_heavy_modules(code: str) -> list[str]:
+    script = f"import sys\n{code}\nprint(' '.join(m for m in {heavy_modules!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)  # noqa: S603
+    return result.stdout.split()
+
+
+def test_what_retrieve_choices_in_sync_with_workflow():
+    assert what_retrieve_choices == workflow_what_retrieve_choices
+
+
+def test_search_backend_choices_in_sync_with_workflow():
+    assert search_backend_choices == workflow_search_backend_choices
+
+
+@pytest.mark.parametrize(
+    ("argv", "expected"),
+    [
+        (["search", "session"], None),
+        (["search", "--backend", "rest", "session"], None),
+        (["search", "--backend", "sparql", "--incremental", "session"], None),
+        (
+            ["search", "--backend", "rest", "--incremental", "session"],
+            "the rest backend does not support --incremental",
+        ),
+        (
+            ["run", "--backend", "rest", "--go-ontology", "go-basic.obo", "session"],
+            "the rest backend does not support --go-ontology",
+        ),
+    ],
+)
+def test_backend_arguments_error(argv: list[str], expected: str | None):
+    args = make_parser().parse_args(argv)
+
+    assert backend_arguments_error(args) == expected
+
+
+def test_help_imports_no_heavy_modules():
+    code = "from protein_detective.cli import make_parser; make_parser().format_help()"
+
+    assert imported_heavy_modules(code) == []
+
+
+def test_density_filter_imports_no_network_stack():
+    code = "import protein_detective.cli; from protein_detective.workflow import density_filter"
+
+    assert imported_heavy_modules(code) == ["duckdb", "cattrs"]
@@ -0,0 +1,53 @@
+from pathlib import Path
+
+import pytest
+from duckdb import connect as duckdb_connect
+
+from protein_detective.db import (
+    connect,
+    current_schema_version,
+    db_path,
+    ddl,
+    load_alphafold_ids,
+    migrate,
+    save_alphafolds,
+    save_uniprot_accessions,
+    schema_version,
+)
+
+
+def test_connect_new_session(tmp_path: Path):
+    with connect(tmp_path) as con:
+        assert current_schema_version(con) == schema_version
+
+
+def test_connect_existing_session_does_not_migrate_again(tmp_path: Path):
+    with connect(tmp_path) as con:
+        save_uniprot_accessions(["P12345"], con)
+        save_alphafolds({"P12345": {"P12345"}}, con)
+
+    with connect(tmp_path) as con:
+        assert migrate(con) == 0
+        assert load_alphafold_ids(con) == {"P12345"}
+
+
+def test_connect_session_from_before_schema_versioning(tmp_path: Path):
+    con = duckdb_connect(db_path(tmp_path))
+    con.sql(ddl)
+    con.execute("INSERT INTO proteins (uniprot_acc) VALUES ('P12345')")
+    con.execute("INSERT INTO alphafolds (uniprot_acc) VALUES ('P12345')")
+    con.close()
+
+    with connect(tmp_path) as con:
+        assert current_schema_version(con) == schema_version
+        assert load_alphafold_ids(con) == {"P12345"}
+        # Table added by a later migration exists
+        con.execute("SELECT * FROM stage_timings")
+
+
+def test_connect_session_from_newer_version(tmp_path: Path):
+    with connect(tmp_path) as con:
+        con.execute("INSERT INTO schema_migrations (version) VALUES (?)", (schema_version + 1,))
+
+    with pytest.raises(ValueError, match="Please upgrade protein-detective"), connect(tmp_path):
+        pass
@@ -0,0 +1,105 @@
+from pathlib import Path
+
+import pytest
+
+from protein_detective.alphafold.density import DensityFilterQuery, DensityFilterResult
+from protein_detective.db import (
+    connect,
+    load_alphafold_ids,
+    load_output_fingerprints,
+    load_pdbs,
+    save_alphafolds,
+    save_density_filtered,
+    save_pdbs,
+    save_uniprot_accessions,
+)
+from protein_detective.export import export_session, import_session, load_manifest
+from protein_detective.uniprot import PdbResult
+
+
+@pytest.fixture
+def session_dir(tmp_path: Path) -> Path:
+    session_dir = tmp_path / "session"
+    (session_dir / "density_filtered").mkdir(parents=True)
+    (session_dir / "density_filtered" / "AF-Q11111-F1-model_v4.pdb").write_text("ATOM\n")
+    with connect(session_dir) as con:
+        save_pdbs({"P12345": [PdbResult(id="1ABC", method="X-Ray", uniprot_chains="A=1-100", resolution="2.0")]}, con)
+        save_uniprot_accessions(["Q11111", "Q22222"], con)
+        save_alphafolds({"Q11111": {"Q11111"}, "Q22222": {"Q22222"}}, con)
+        save_density_filtered(
+            DensityFilterQuery(confidence=70.0, min_threshold=0, max_threshold=1000),
+            [
+                DensityFilterResult(
+                    pdb_file="AF-Q11111-F1-model_v4.pdb",
+                    count=42,
+                    density_filtered_file=Path("density_filtered/AF-Q11111-F1-model_v4.pdb"),
+                    kept_residues="1-42",
+                    input_fingerprint="100:1",
+                    output_fingerprint="100:1;confidence=70",
+                ),
+                DensityFilterResult(
+                    pdb_file="AF-Q22222-F1-model_v4.pdb", count=1, density_filtered_file=None, input_fingerprint="200:2"
+                ),
+            ],
+            ["Q11111", "Q22222"],
+            con,
+        )
+    return session_dir
+
+
+def test_export_session(session_dir: Path, tmp_path: Path):
+    export_dir = tmp_path / "export"
+
+    manifest = export_session(session_dir, export_dir)
+
+    assert manifest == load_manifest(export_dir)
+    assert manifest.tables["proteins"].rows == 3
+    assert manifest.tables["density_filtered_alphafolds"].partition_by == ["density_filter_id"]
+    assert [f.path for f in manifest.tables["density_filtered_alphafolds"].files] == [
+        "density_filtered_alphafolds/density_filter_id=1/data_0.parquet"
+    ]
+    assert all((export_dir / f.path).stat().st_size == f.size for f in manifest.tables["pdbs"].files)
+    assert [(f.path, f.size) for f in manifest.structure_files] == [("density_filtered/AF-Q11111-F1-model_v4.pdb", 5)]
+
+
+def test_export_session_while_session_is_read(session_dir: Path, tmp_path: Path):
+    # A read-write connection can not be opened while a read-only one is open
+    with connect(session_dir, read_only=True):
+        manifest = export_session(session_dir, tmp_path / "export")
+
+    assert manifest.tables["proteins"].rows == 3
+
+
+def test_export_session_into_non_empty_dir(session_dir: Path):
+    with pytest.raises(ValueError, match="not empty"):
+        export_session(session_dir, session_dir)
+
+
+def test_import_session(session_dir: Path, tmp_path: Path):
+    export_dir = tmp_path / "export"
+    export_session(session_dir, export_dir)
+    other_session_dir = tmp_path / "other_session"
+    other_session_dir.mkdir()
+    # Make density filter ids differ between sessions
+    with connect(other_session_dir) as con:
+        con.execute("INSERT INTO density_filters (confidence, min_threshold, max_threshold) VALUES (50, 0, 10)")
+
+    rows = import_session(export_dir, other_session_dir)
+    # Importing again is harmless
+    import_session(export_dir, other_session_dir)
+
+    assert rows["density_filtered_alphafolds"] == 2
+    with connect(other_session_dir) as con:
+        assert load_alphafold_ids(con) == {"Q11111", "Q22222"}
+        assert [pdb.id for pdb in load_pdbs(con)] == ["1ABC"]
+        filtered = con.execute(
+            """SELECT confidence, uniprot_acc, keep, pdb_file, kept_residues, input_fingerprint
+            FROM density_filtered_alphafolds JOIN density_filters USING (density_filter_id)
+            ORDER BY uniprot_acc"""
+        ).fetchall()
+        fingerprints = load_output_fingerprints(con)
+    assert filtered == [
+        (70.0, "Q11111", True, "density_filtered/AF-Q11111-F1-model_v4.pdb", "1-42", "100:1"),
+        (70.0, "Q22222", False, None, None, "200:2"),
+    ]
+    assert fingerprints == {Path("density_filtered/AF-Q11111-F1-model_v4.pdb"): "100:1;confidence=70"}
@@ -0,0 +1,143 @@
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+from protein_detective.alphafold.density import DensityFilterQuery
+from protein_detective.db import connect, load_output_fingerprints, save_pdb_files, save_pdbs
+from protein_detective.uniprot import PdbResult
+from protein_detective.workflow import density_filter, materialize, prune_pdbs
+
+sample_pdb_file = Path(__file__).parent / "alpafold" / "AF-A1YPR0-F1-model_v4.pdb"
+
+
+def fail(*_args, **_kwargs):
+    msg = "up to date output should not be written again"
+    raise AssertionError(msg)
+
+
+def touch(path: Path):
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_density_filter_again_reuses_results(af_session_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+    density_filter(af_session_dir, query, eager=True)
+    monkeypatch.setattr("protein_detective.alphafold.density.find_high_confidence_residues", fail)
+
+    result = density_filter(af_session_dir, query, eager=True)
+
+    assert (result.nr_kept, result.nr_discarded, result.nr_unchanged) == (1, 0, 1)
+
+
+def test_density_filter_again_after_input_changed(af_session_dir: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+    density_filter(af_session_dir, query)
+    touch(af_session_dir / "downloads" / "AF-A1YPR0-F1-model_v4.pdb")
+
+    result = density_filter(af_session_dir, query)
+
+    assert (result.nr_kept, result.nr_unchanged) == (1, 0)
+
+
+def test_density_filter_eager_after_lazy_writes_file(af_session_dir: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+    density_filter(af_session_dir, query)
+
+    result = density_filter(af_session_dir, query, eager=True)
+
+    assert result.nr_unchanged == 0
+    assert (af_session_dir / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb").exists()
+
+
+def test_density_filter_with_other_confidence_keeps_file(af_session_dir: Path, tmp_path: Path):
+    expected = tmp_path / "expected"
+    shutil.copytree(af_session_dir, expected)
+    density_filter(expected, DensityFilterQuery(confidence=90, min_threshold=0, max_threshold=1000), eager=True)
+    density_filter(af_session_dir, DensityFilterQuery(confidence=50, min_threshold=0, max_threshold=1000), eager=True)
+    file50 = Path("density_filtered") / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb"
+    content50 = (af_session_dir / file50).read_text()
+
+    density_filter(af_session_dir, DensityFilterQuery(confidence=90, min_threshold=0, max_threshold=1000), eager=True)
+
+    file90 = Path("density_filtered") / "confidence_90" / "AF-A1YPR0-F1-model_v4.pdb"
+    assert (af_session_dir / file90).read_text() == (expected / file90).read_text()
+    assert (af_session_dir / file50).read_text() == content50 != (expected / file90).read_text()
+    with connect(af_session_dir) as con:
+        fingerprints = load_output_fingerprints(con)
+    assert fingerprints[file50].endswith(";confidence=50")
+    assert fingerprints[file90].endswith(";confidence=90")
+
+
+def test_materialize_rewrites_out_of_date_file(af_session_dir: Path, tmp_path: Path):
+    expected = tmp_path / "expected"
+    shutil.copytree(af_session_dir, expected)
+    density_filter(expected, DensityFilterQuery(confidence=90, min_threshold=0, max_threshold=1000), eager=True)
+    filtered_file = af_session_dir / "density_filtered" / "confidence_90" / "AF-A1YPR0-F1-model_v4.pdb"
+    filtered_file.parent.mkdir(parents=True)
+    filtered_file.write_text("stale\n")
+    density_filter(af_session_dir, DensityFilterQuery(confidence=90, min_threshold=0, max_threshold=1000))
+
+    assert materialize(af_session_dir) == [filtered_file]
+    assert filtered_file.read_text() == (expected / filtered_file.relative_to(af_session_dir)).read_text()
+    assert materialize(af_session_dir) == []
+
+
+def test_materialize_density_filters_with_other_confidence(af_session_dir: Path, tmp_path: Path):
+    expected = tmp_path / "expected"
+    shutil.copytree(af_session_dir, expected)
+    queries = [
+        DensityFilterQuery(confidence=confidence, min_threshold=0, max_threshold=1000) for confidence in (50, 90)
+    ]
+    for query in queries:
+        density_filter(expected, query, eager=True)
+        density_filter(af_session_dir, query)
+
+    written = materialize(af_session_dir)
+
+    assert sorted(path.relative_to(af_session_dir) for path in written) == [
+        Path("density_filtered") / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb",
+        Path("density_filtered") / "confidence_90" / "AF-A1YPR0-F1-model_v4.pdb",
+    ]
+    for path in written:
+        assert path.read_text() == (expected / path.relative_to(af_session_dir)).read_text()
+
+
+@pytest.fixture
+def pdb_session_dir(tmp_path: Path) -> Path:
+    session_dir = tmp_path / "session"
+    (session_dir / "downloads").mkdir(parents=True)
+    # The AlphaFold sample has a single chain A, so can stand in for a PDBe structure
+    shutil.copy(sample_pdb_file, session_dir / "downloads" / "1abc.pdb")
+    with connect(session_dir) as con:
+        save_pdbs({"A1YPR0": [PdbResult(id="1ABC", method="X-ray diffraction", uniprot_chains="A=1-100")]}, con)
+        save_pdb_files({"1ABC": Path("downloads/1abc.pdb")}, con)
+    return session_dir
+
+
+def test_prune_pdbs_rewrites_stale_file(pdb_session_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    single_chain_file = pdb_session_dir / "single_chain" / "A1YPR0_1abc_A2A.pdb"
+    single_chain_file.parent.mkdir()
+    single_chain_file.write_text("stale\n")
+
+    prune_pdbs(pdb_session_dir)
+
+    assert single_chain_file.read_text().startswith("ATOM")
+
+    monkeypatch.setattr("protein_detective.pdbe.io.write_single_chain_pdb_file", fail)
+    _, nr_files = prune_pdbs(pdb_session_dir)
+
+    assert nr_files == 1
+
+
+def test_prune_pdbs_after_input_changed(pdb_session_dir: Path):
+    prune_pdbs(pdb_session_dir)
+    single_chain_file = pdb_session_dir / "single_chain" / "A1YPR0_1abc_A2A.pdb"
+    single_chain_file.write_text("stale\n")
+    touch(pdb_session_dir / "downloads" / "1abc.pdb")
+
+    prune_pdbs(pdb_session_dir)
+
+    assert single_chain_file.read_text().startswith("ATOM")
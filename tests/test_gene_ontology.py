@@ -0,0 +1,101 @@
+import gzip
+import json
+from pathlib import Path
+
+import pytest
+
+from protein_detective.gene_ontology import load_go_ontology
+
+obo = """format-version: 1.2
+
+[Term]
+id: GO:0005634
+name: nucleus
+is_a: GO:0043231 ! intracellular membrane-bounded organelle
+
+[Term]
+id: GO:0031965
+name: nuclear membrane
+relationship: part_of GO:0005634 ! nucleus
+
+[Term]
+id: GO:0005654
+name: nucleoplasm
+is_a: GO:0005634 ! nucleus
+
+[Term]
+id: GO:0016604
+name: nuclear body
+is_a: GO:0005654 ! nucleoplasm
+
+[Term]
+id: GO:0000001
+name: obsolete term
+is_a: GO:0005634 ! nucleus
+is_obsolete: true
+
+[Typedef]
+id: part_of
+is_a: GO:0005634
+"""
+
+
+def iri(term: str) -> str:
+    return "http://purl.obolibrary.org/obo/" + term.replace(":", "_")
+
+
+obographs = {
+    "graphs": [
+        {
+            "nodes": [
+                {"id": iri("GO:0005634"), "type": "CLASS"},
+                {"id": iri("GO:0031965"), "type": "CLASS"},
+                {"id": iri("GO:0005654"), "type": "CLASS"},
+                {"id": iri("GO:0016604"), "type": "CLASS"},
+                {"id": iri("GO:0000001"), "type": "CLASS", "meta": {"deprecated": True}},
+            ],
+            "edges": [
+                {"sub": iri("GO:0005634"), "pred": "is_a", "obj": iri("GO:0043231")},
+                {
+                    "sub": iri("GO:0031965"),
+                    "pred": "http://purl.obolibrary.org/obo/BFO_0000050",
+                    "obj": iri("GO:0005634"),
+                },
+                {"sub": iri("GO:0005654"), "pred": "is_a", "obj": iri("GO:0005634")},
+                {"sub": iri("GO:0016604"), "pred": "is_a", "obj": iri("GO:0005654")},
+                {"sub": iri("GO:0000001"), "pred": "is_a", "obj": iri("GO:0005634")},
+            ],
+        }
+    ]
+}
+
+
+@pytest.fixture(params=["go-basic.obo", "go-basic.obo.gz", "go-basic.json"])
+def go_file(request: pytest.FixtureRequest, tmp_path: Path) -> Path:
+    path = tmp_path / request.param
+    content = json.dumps(obographs) if path.suffix == ".json" else obo
+    if path.suffix == ".gz":
+        path.write_bytes(gzip.compress(content.encode()))
+    else:
+        path.write_text(content)
+    return path
+
+
+def test_load_go_ontology(go_file: Path):
+    ontology = load_go_ontology(go_file)
+
+    assert ontology.descendants("GO:0005634") == {"GO:0005634", "GO:0005654", "GO:0016604"}
+    assert ontology.descendants("GO:0016604") == {"GO:0016604"}
+    assert "GO:0005634" in ontology
+    assert "GO:0000001" not in ontology
+
+
+def test_load_go_ontology_again_after_change(tmp_path: Path):
+    go_file = tmp_path / "go-basic.obo"
+    go_file.write_text(obo)
+    first = load_go_ontology(go_file)
+    assert load_go_ontology(go_file) is first
+
+    go_file.write_text(obo.replace("is_a: GO:0005654 ! nucleoplasm", "is_a: GO:0005634 ! nucleus"))
+
+    assert load_go_ontology(go_file) is not first
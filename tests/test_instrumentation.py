@@ -0,0 +1,98 @@
+import asyncio
+from collections.abc import Generator
+from pathlib import Path
+
+import pytest
+
+from protein_detective.instrumentation import instrumentation, timed, write_profile
+
+
+@timed
+def double(x: int) -> int:
+    return x * 2
+
+
+@timed
+def count_up(n: int) -> Generator[int]:
+    yield from range(n)
+
+
+@timed
+async def adouble(x: int) -> int:
+    await asyncio.sleep(0)
+    return x * 2
+
+
+@pytest.fixture
+def enabled():
+    instrumentation.enable()
+    yield instrumentation
+    instrumentation.disable()
+
+
+def test_timed_disabled():
+    instrumentation.stages = {}
+
+    assert double(2) == 4
+    assert instrumentation.stages == {}
+
+
+def test_timed_function(enabled):
+    double(1)
+    double(2)
+
+    stats = enabled.stages["test_instrumentation.double"]
+    assert stats.calls == 2
+    assert stats.items == 2
+    assert stats.total_seconds >= 0
+
+
+def test_timed_generator(enabled):
+    assert list(count_up(3)) == [0, 1, 2]
+
+    stats = enabled.stages["test_instrumentation.count_up"]
+    assert stats.calls == 1
+    assert stats.items == 3
+
+
+def test_timed_generator_closed_early(enabled):
+    closed = []
+
+    @timed
+    def items() -> Generator[int]:
+        try:
+            yield from range(3)
+        finally:
+            closed.append(True)
+
+    for item in items():
+        if item == 1:
+            break
+
+    assert closed == [True]
+    assert enabled.stages["test_instrumentation.items"].items == 2
+
+
+def test_timed_coroutine(enabled):
+    assert asyncio.run(adouble(3)) == 6
+
+    stats = enabled.stages["test_instrumentation.adouble"]
+    assert stats.calls == 1
+
+
+def test_count(enabled):
+    enabled.count("download", nbytes=10, retries=1)
+    enabled.count("download", nbytes=5)
+
+    stats = enabled.stages["download"]
+    assert stats.bytes == 15
+    assert stats.retries == 1
+
+
+def test_write_profile(tmp_path: Path):
+    with write_profile(tmp_path, "double") as profile_file:
+        double(21)
+
+    assert profile_file.parent == tmp_path
+    assert profile_file.name.startswith("double-")
+    assert profile_file.stat().st_size > 0
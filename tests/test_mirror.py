@@ -0,0 +1,170 @@
+import asyncio
+import gzip
+import shutil
+import threading
+from pathlib import Path
+
+import pytest
+
+from protein_detective.alphafold import AlphaFoldEntry
+from protein_detective.alphafold.density import DensityFilterQuery, filter_on_density
+from protein_detective.alphafold.fetch import fetch_many_async
+from protein_detective.db import connect, load_alphafolds, save_alphafolds, save_uniprot_accessions
+from protein_detective.mirror import (
+    AlphaFoldMirror,
+    link_from_alphafold_mirror,
+    link_from_pdb_mirror,
+    mirror_index_path,
+)
+from protein_detective.pdbe.fetch import fetch
+from protein_detective.workflow import retrieve_structures
+
+sample_pdb_file = Path(__file__).parent / "alpafold" / "AF-A1YPR0-F1-model_v4.pdb"
+
+
+def gzip_file(source: Path, target: Path) -> Path:
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with source.open("rb") as f, gzip.open(target, "wb") as g:
+        shutil.copyfileobj(f, g)
+    return target
+
+
+@pytest.fixture
+def pdb_mirror(tmp_path: Path) -> Path:
+    mirror_dir = tmp_path / "mmCIF"
+    (mirror_dir / "wa").mkdir(parents=True)
+    (mirror_dir / "wa" / "8was.cif.gz").write_bytes(b"")
+    return mirror_dir
+
+
+@pytest.fixture
+def alphafold_mirror(tmp_path: Path) -> Path:
+    mirror_dir = tmp_path / "alphafold"
+    gzip_file(sample_pdb_file, mirror_dir / "UP000005640_9606_HUMAN_v4" / "AF-A1YPR0-F1-model_v4.pdb.gz")
+    (mirror_dir / "AF-A1YPR0-F1-model_v3.pdb").write_text("")
+    (mirror_dir / "AF-P12345-F1-model_v4.cif").write_text("")
+    return mirror_dir
+
+
+def test_link_from_pdb_mirror(pdb_mirror: Path, tmp_path: Path):
+    save_dir = tmp_path / "downloads"
+
+    linked, missing = link_from_pdb_mirror(["8WAS", "1ABC"], pdb_mirror, save_dir)
+
+    assert linked == {"8WAS": save_dir / "8was.cif.gz"}
+    assert linked["8WAS"].is_symlink()
+    assert linked["8WAS"].resolve() == (pdb_mirror / "wa" / "8was.cif.gz").resolve()
+    assert missing == {"1ABC"}
+
+
+def test_pdbe_fetch_from_mirror_does_not_download(pdb_mirror: Path, tmp_path: Path):
+    save_dir = tmp_path / "downloads"
+
+    result = fetch(["8WAS"], save_dir, mirror_dir=pdb_mirror)
+
+    assert result == {"8WAS": save_dir / "8was.cif.gz"}
+
+
+def test_alphafold_mirror_scan_takes_newest_version(alphafold_mirror: Path):
+    mirror = AlphaFoldMirror.scan(alphafold_mirror)
+
+    assert mirror.files == {
+        "A1YPR0": {"pdb": alphafold_mirror / "UP000005640_9606_HUMAN_v4" / "AF-A1YPR0-F1-model_v4.pdb.gz"},
+        "P12345": {"cif": alphafold_mirror / "AF-P12345-F1-model_v4.cif"},
+    }
+
+
+def test_alphafold_mirror_load_reuses_index(alphafold_mirror: Path, monkeypatch: pytest.MonkeyPatch):
+    scanned = AlphaFoldMirror.load(alphafold_mirror)
+    # Read the index from its file, like a new process does
+    monkeypatch.setattr("protein_detective.mirror._mirrors", {})
+
+    def scan(*args, **kwargs):
+        msg = "Mirror should not be scanned again"
+        raise AssertionError(msg)
+
+    monkeypatch.setattr(AlphaFoldMirror, "scan", scan)
+    loaded = AlphaFoldMirror.load(alphafold_mirror)
+
+    assert mirror_index_path(alphafold_mirror).exists()
+    assert loaded == scanned
+
+
+def test_alphafold_mirror_load_rescans_changed_directory(alphafold_mirror: Path):
+    AlphaFoldMirror.load(alphafold_mirror)
+    new_file = alphafold_mirror / "UP000005640_9606_HUMAN_v4" / "AF-Q99999-F1-model_v4.pdb"
+    new_file.write_text("")
+
+    mirror = AlphaFoldMirror.load(alphafold_mirror)
+
+    assert mirror.find("Q99999", {"pdb"}) == {"pdb": new_file}
+
+
+def test_link_from_alphafold_mirror(alphafold_mirror: Path, tmp_path: Path):
+    save_dir = tmp_path / "downloads"
+
+    entries, missing = link_from_alphafold_mirror(["A1YPR0", "P12345", "Q99999"], alphafold_mirror, save_dir, {"pdb"})
+
+    assert entries == [AlphaFoldEntry("A1YPR0", None, pdb_file=save_dir / "AF-A1YPR0-F1-model_v4.pdb.gz")]
+    assert missing == {"P12345", "Q99999"}
+
+
+def test_filter_on_density_of_gzipped_file(tmp_path: Path):
+    gzipped_file = gzip_file(sample_pdb_file, tmp_path / "AF-A1YPR0-F1-model_v4.pdb.gz")
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+    (tmp_path / "plain").mkdir()
+    (tmp_path / "gzipped").mkdir()
+
+    [plain] = filter_on_density([sample_pdb_file], query, tmp_path / "plain")
+    [gzipped] = filter_on_density([gzipped_file], query, tmp_path / "gzipped")
+
+    assert gzipped.count == plain.count
+    assert gzipped.density_filtered_file == tmp_path / "gzipped" / "AF-A1YPR0-F1-model_v4.pdb"
+    assert plain.density_filtered_file is not None
+    assert gzipped.density_filtered_file.read_text() == plain.density_filtered_file.read_text()
+
+
+def test_retrieve_structures_from_alphafold_mirror(alphafold_mirror: Path, tmp_path: Path):
+    session_dir = tmp_path / "session"
+    session_dir.mkdir()
+    with connect(session_dir) as con:
+        save_uniprot_accessions(["A1YPR0"], con)
+        save_alphafolds({"A1YPR0": {"A1YPR0"}}, con)
+
+    _, nr_pdbes, nr_afs = retrieve_structures(session_dir, what={"alphafold"}, alphafold_mirror=alphafold_mirror)
+
+    assert (nr_pdbes, nr_afs) == (0, 1)
+    with connect(session_dir) as con:
+        assert load_alphafolds(con) == [
+            AlphaFoldEntry("A1YPR0", None, pdb_file=Path("downloads/AF-A1YPR0-F1-model_v4.pdb.gz"))
+        ]
+
+
+def test_alphafold_mirror_scan_does_not_block_event_loop(
+    alphafold_mirror: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    loop_ran = threading.Event()
+    scan = AlphaFoldMirror.scan
+
+    def slow_scan(*args, **kwargs):
+        # Only finishes when the event loop gets to run while the mirror is scanned
+        assert loop_ran.wait(timeout=5)
+        return scan(*args, **kwargs)
+
+    monkeypatch.setattr(AlphaFoldMirror, "scan", slow_scan)
+
+    async def run():
+        async def tick():
+            await asyncio.sleep(0.01)
+            loop_ran.set()
+
+        ticker = asyncio.create_task(tick())
+        entries = [
+            entry async for entry in fetch_many_async(["A1YPR0"], tmp_path / "downloads", mirror_dir=alphafold_mirror)
+        ]
+        await ticker
+        return entries
+
+    entries = asyncio.run(run())
+
+    assert [entry.uniprot_acc for entry in entries] == ["A1YPR0"]
@@ -0,0 +1,171 @@
+import gzip
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import get_context
+from pathlib import Path
+
+import pytest
+
+from protein_detective.alphafold.density import DensityFilterQuery
+from protein_detective.db import connect, load_packed_files, save_pdb_files, save_pdbs
+from protein_detective.packed import PackedStore
+from protein_detective.uniprot import PdbResult
+from protein_detective.workflow import density_filter, materialize, pack_session, prune_pdbs, retrieve_structures
+
+sample_pdb_file = Path(__file__).parent / "alpafold" / "AF-A1YPR0-F1-model_v4.pdb"
+
+
+def test_packed_store_reads_what_it_writes(tmp_path: Path):
+    with PackedStore(tmp_path, pack_writes=True, max_pack_size=10) as store:
+        store.write_text(tmp_path / "single_chain" / "a.pdb", "first file\n")
+        store.add(Path("downloads/b.pdb.gz"), gzip.compress(b"second file\n"))
+
+        assert store.exists(tmp_path / "single_chain" / "a.pdb")
+        assert not (tmp_path / "single_chain" / "a.pdb").exists()
+        assert store.read_bytes(tmp_path / "single_chain" / "a.pdb") == b"first file\n"
+        with store.open_text(tmp_path / "downloads" / "b.pdb.gz") as f:
+            assert f.read() == "second file\n"
+
+    # The first pack was full, so the second file is in another pack
+    assert len({file.pack for file in store.added}) == 2
+    with PackedStore(tmp_path, store.added) as reader:
+        assert reader.read_bytes(tmp_path / "single_chain" / "a.pdb") == b"first file\n"
+
+
+def test_packed_store_reads_unpacked_files_from_disk(tmp_path: Path):
+    (tmp_path / "a.pdb").write_text("on disk\n")
+
+    with PackedStore(tmp_path) as store:
+        store.write_text(tmp_path / "b.pdb", "also on disk\n")
+
+        assert store.read_bytes(tmp_path / "a.pdb") == b"on disk\n"
+    assert (tmp_path / "b.pdb").read_text() == "also on disk\n"
+    assert store.added == []
+
+
+@pytest.mark.parametrize("on_processes", [False, True])
+def test_density_filter_packed(af_session_dir: Path, tmp_path: Path, on_processes: bool):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+    expected = tmp_path / "expected"
+    shutil.copytree(af_session_dir, expected)
+    density_filter(expected, query, eager=True)
+
+    assert pack_session(af_session_dir) == 1
+    with ProcessPoolExecutor(1, mp_context=get_context("forkserver")) if on_processes else nullcontext() as executor:
+        result = density_filter(af_session_dir, query, packed=True, eager=True, executor=executor)
+
+    assert result.nr_kept == 1
+    assert not (af_session_dir / "downloads" / "AF-A1YPR0-F1-model_v4.pdb").exists()
+    assert not (af_session_dir / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb").exists()
+    with connect(af_session_dir) as con:
+        assert sorted(str(file.path) for file in load_packed_files(con)) == [
+            "density_filtered/confidence_50/AF-A1YPR0-F1-model_v4.pdb",
+            "downloads/AF-A1YPR0-F1-model_v4.pdb",
+        ]
+
+    written = materialize(af_session_dir, [Path("density_filtered")], tmp_path / "materialized")
+
+    assert written == [tmp_path / "materialized" / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb"]
+    assert (
+        written[0].read_text()
+        == (expected / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb").read_text()
+    )
+
+
+@pytest.mark.parametrize("on_processes", [False, True])
+def test_prune_pdbs_packed(tmp_path: Path, on_processes: bool):
+    session_dir = tmp_path / "session"
+    (session_dir / "downloads").mkdir(parents=True)
+    # The AlphaFold sample has a single chain A, so can stand in for a PDBe structure
+    shutil.copy(sample_pdb_file, session_dir / "downloads" / "1abc.pdb")
+    with connect(session_dir) as con:
+        save_pdbs({"A1YPR0": [PdbResult(id="1ABC", method="X-ray diffraction", uniprot_chains="A=1-100")]}, con)
+        save_pdb_files({"1ABC": Path("downloads/1abc.pdb")}, con)
+    pack_session(session_dir)
+
+    with ProcessPoolExecutor(1, mp_context=get_context("forkserver")) if on_processes else nullcontext() as executor:
+        single_chain_dir, nr_files = prune_pdbs(session_dir, packed=True, executor=executor)
+
+    assert nr_files == 1
+    assert list(single_chain_dir.iterdir()) == []
+    [written] = materialize(session_dir, [Path("single_chain")])
+    assert written == session_dir / "single_chain" / "A1YPR0_1abc_A2A.pdb"
+    assert written.read_text().startswith("ATOM")
+
+
+def test_materialize_lazy_density_filtered(af_session_dir: Path, tmp_path: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+    expected = tmp_path / "expected"
+    shutil.copytree(af_session_dir, expected)
+    density_filter(expected, query, eager=True)
+
+    result = density_filter(af_session_dir, query)
+
+    assert result.nr_kept == 1
+    filtered_file = af_session_dir / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb"
+    assert not filtered_file.exists()
+
+    assert materialize(af_session_dir, [Path("single_chain")]) == []
+    assert materialize(af_session_dir, [Path("density_filtered")]) == [filtered_file]
+    assert (
+        filtered_file.read_text()
+        == (expected / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb").read_text()
+    )
+    # Already materialized files are not written again
+    assert materialize(af_session_dir) == []
+
+
+def test_retrieve_does_not_download_packed_structures(af_session_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    requested: list[set[str]] = []
+
+    async def fake_fetch(ids, save_dir, *args, **kwargs):
+        requested.append(set(ids))
+        return [] if "what" in kwargs else {}
+
+    monkeypatch.setattr("protein_detective.alphafold.fetch.fetch_many_list_async", fake_fetch)
+    monkeypatch.setattr("protein_detective.pdbe.fetch.fetch_async", fake_fetch)
+    pack_session(af_session_dir)
+
+    _, nr_pdbes, nr_afs = retrieve_structures(af_session_dir, what={"alphafold"})
+
+    assert (nr_pdbes, nr_afs) == (0, 0)
+    assert requested == [set(), set()]
+    assert list((af_session_dir / "downloads").iterdir()) == []
+
+
+def test_materialize_packed_skips_existing_files(af_session_dir: Path, tmp_path: Path):
+    pack_session(af_session_dir)
+    output_dir = tmp_path / "materialized"
+
+    first = materialize(af_session_dir, [Path("downloads")], output_dir)
+    second = materialize(af_session_dir, [Path("downloads")], output_dir)
+
+    assert first == [output_dir / "downloads" / "AF-A1YPR0-F1-model_v4.pdb"]
+    assert second == []
+
+
+def test_materialize_in_session_unpacks_files(af_session_dir: Path):
+    pack_session(af_session_dir)
+
+    written = materialize(af_session_dir, [Path("downloads")])
+
+    assert written == [af_session_dir / "downloads" / "AF-A1YPR0-F1-model_v4.pdb"]
+    with connect(af_session_dir) as con:
+        assert load_packed_files(con) == []
+    assert materialize(af_session_dir, [Path("downloads")]) == []
+    # The file is on disk again, so it is packed once more
+    assert pack_session(af_session_dir) == 1
+    with connect(af_session_dir) as con:
+        assert [file.path for file in load_packed_files(con)] == [Path("downloads/AF-A1YPR0-F1-model_v4.pdb")]
+
+
+def test_pack_session_leaves_part_files(af_session_dir: Path):
+    part_file = af_session_dir / "downloads" / "1abc.cif.part"
+    part_file.write_text("unfinished download")
+
+    assert pack_session(af_session_dir) == 1
+
+    assert part_file.read_text() == "unfinished download"
+    with connect(af_session_dir) as con:
+        assert [file.path for file in load_packed_files(con)] == [Path("downloads/AF-A1YPR0-F1-model_v4.pdb")]
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import shutil
+from collections.abc import AsyncGenerator, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from protein_detective.alphafold import AlphaFoldEntry
+from protein_detective.alphafold.density import DensityFilterQuery
+from protein_detective.alphafold.entry_summary import EntrySummary
+from protein_detective.db import (
+    connect,
+    load_alphafolds,
+    load_output_fingerprints,
+    save_alphafolds,
+    save_pdbs,
+    save_uniprot_accessions,
+)
+from protein_detective.packed import PackedStore
+from protein_detective.pipeline import RunResult, _Run, run_pipeline
+from protein_detective.uniprot import PdbResult
+from protein_detective.workflow import pack_session
+from protein_detective.writer import SessionWriter
+
+sample_pdb_file = Path(__file__).parent / "alpafold" / "AF-A1YPR0-F1-model_v4.pdb"
+
+
+@pytest.fixture
+def found_session_dir(tmp_path: Path) -> Path:
+    """Session with one PDBe and one AlphaFold structure found, but not retrieved."""
+    session_dir = tmp_path / "session"
+    session_dir.mkdir()
+    with connect(session_dir) as con:
+        save_pdbs({"A1YPR0": [PdbResult(id="1ABC", method="X-ray diffraction", uniprot_chains="A=1-100")]}, con)
+        save_alphafolds({"A1YPR0": {"A1YPR0"}}, con)
+    return session_dir
+
+
+async def fake_pdbe_iter_fetch_async(
+    ids: Iterable[str], save_dir: Path, max_parallel_downloads=5, session=None, mirror_dir=None
+) -> AsyncGenerator[tuple[str, Path]]:
+    for pdb_id in ids:
+        await asyncio.sleep(0)
+        save_dir.mkdir(parents=True, exist_ok=True)
+        mmcif_file = save_dir / f"{pdb_id.lower()}.pdb"
+        # Like a real download, existing files are kept
+        if not mmcif_file.exists():
+            # The AlphaFold sample has a single chain A, so can stand in for a PDBe structure
+            shutil.copy(sample_pdb_file, mmcif_file)
+        yield pdb_id, mmcif_file
+
+
+@pytest.fixture
+def fake_downloads(monkeypatch: pytest.MonkeyPatch, af_summary: EntrySummary):
+    async def fake_af_iter_fetch_async(
+        ids: Iterable[str], save_dir: Path, what=None, max_parallel_downloads=5, session=None, mirror_dir=None
+    ) -> AsyncGenerator[AlphaFoldEntry]:
+        for uniprot_acc in ids:
+            await asyncio.sleep(0)
+            save_dir.mkdir(parents=True, exist_ok=True)
+            pdb_file = save_dir / sample_pdb_file.name
+            if not pdb_file.exists():
+                shutil.copy(sample_pdb_file, pdb_file)
+            yield AlphaFoldEntry(uniprot_acc, af_summary, pdb_file=pdb_file)
+
+    monkeypatch.setattr("protein_detective.pipeline.af_iter_fetch_async", fake_af_iter_fetch_async)
+    monkeypatch.setattr("protein_detective.pipeline.pdbe_iter_fetch_async", fake_pdbe_iter_fetch_async)
+
+
+@pytest.mark.usefixtures("fake_downloads")
+def test_run_pipeline(found_session_dir: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+
+    result = run_pipeline(found_session_dir, query, max_workers=2, eager=True)
+
+    assert result == RunResult(nr_mmcif_files=1, nr_single_chain_files=1, nr_afs=1, nr_kept=1, nr_discarded=0)
+    assert (found_session_dir / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb").exists()
+    assert (found_session_dir / "single_chain" / "A1YPR0_1abc_A2A.pdb").exists()
+    with connect(found_session_dir) as con:
+        [af] = load_alphafolds(con)
+        assert af.pdb_file == Path("downloads/AF-A1YPR0-F1-model_v4.pdb")
+        assert con.execute(
+            "SELECT mmcif_file, single_chain_pdb_file FROM pdbs JOIN proteins_pdbs USING (pdb_id)"
+        ).fetchall() == [("downloads/1abc.pdb", "single_chain/A1YPR0_1abc_A2A.pdb")]
+        assert con.execute("SELECT uniprot_acc, keep, pdb_file FROM density_filtered_alphafolds").fetchall() == [
+            ("A1YPR0", True, "density_filtered/confidence_50/AF-A1YPR0-F1-model_v4.pdb")
+        ]
+
+
+@pytest.mark.usefixtures("fake_downloads")
+def test_run_pipeline_again_reuses_results(found_session_dir: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+    run_pipeline(found_session_dir, query, max_workers=1, eager=True)
+    output_files = [
+        Path("density_filtered/confidence_50/AF-A1YPR0-F1-model_v4.pdb"),
+        Path("single_chain/A1YPR0_1abc_A2A.pdb"),
+    ]
+    mtimes = [(found_session_dir / path).stat().st_mtime_ns for path in output_files]
+
+    result = run_pipeline(found_session_dir, query, max_workers=1, eager=True)
+
+    assert result == RunResult(nr_mmcif_files=1, nr_single_chain_files=1, nr_afs=1, nr_kept=1, nr_unchanged=1)
+    assert [(found_session_dir / path).stat().st_mtime_ns for path in output_files] == mtimes
+    with connect(found_session_dir) as con:
+        assert set(load_output_fingerprints(con)) == set(output_files)
+
+
+@pytest.mark.usefixtures("fake_downloads")
+def test_run_pipeline_again_after_input_changed(found_session_dir: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+    run_pipeline(found_session_dir, query, max_workers=1, eager=True)
+    filtered_file = found_session_dir / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb"
+    expected = filtered_file.read_text()
+    filtered_file.write_text("stale\n")
+    pdb_file = found_session_dir / "downloads" / "AF-A1YPR0-F1-model_v4.pdb"
+    stat = pdb_file.stat()
+    os.utime(pdb_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    result = run_pipeline(found_session_dir, query, what={"alphafold"}, max_workers=1, eager=True)
+
+    assert result == RunResult(nr_afs=1, nr_kept=1)
+    assert filtered_file.read_text() == expected
+
+
+@pytest.mark.usefixtures("fake_downloads")
+def test_run_pipeline_only_alphafold(found_session_dir: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=0, max_threshold=10)
+
+    result = run_pipeline(found_session_dir, query, what={"alphafold"}, max_workers=1, queue_size=1)
+
+    assert result == RunResult(nr_afs=1, nr_discarded=1)
+    assert not (found_session_dir / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb").exists()
+
+
+def test_run_pipeline_invalid_what(found_session_dir: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=0, max_threshold=10)
+
+    with pytest.raises(ValueError, match="Invalid 'what' argument"):
+        run_pipeline(found_session_dir, query, what={"rcsb"})  # type: ignore[arg-type]
+
+
+@pytest.mark.usefixtures("fake_downloads")
+def test_run_pipeline_again_after_pack_does_not_download(found_session_dir: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+    run_pipeline(found_session_dir, query, max_workers=1, eager=True)
+    pack_session(found_session_dir)
+
+    result = run_pipeline(found_session_dir, query, max_workers=1, eager=True)
+
+    assert result.nr_mmcif_files == 0
+    assert result.nr_afs == 0
+    assert result.nr_kept == 1
+    assert list((found_session_dir / "downloads").iterdir()) == []
+
+
+def test_run_keeps_only_pending_saves(tmp_path: Path):
+    with SessionWriter(tmp_path) as writer:
+        run = _Run(tmp_path, writer, ThreadPoolExecutor(), 1, 1, PackedStore(tmp_path), {})
+        for _ in range(10):
+            run._save(save_uniprot_accessions, ["A1YPR0"])
+            writer.flush()
+
+        assert len(run.saved) == 1
+
+
+def test_run_fails_on_failed_save(tmp_path: Path):
+    def failing_save(con):
+        msg = "disk full"
+        raise OSError(msg)
+
+    with SessionWriter(tmp_path) as writer:
+        run = _Run(tmp_path, writer, ThreadPoolExecutor(), 1, 1, PackedStore(tmp_path), {})
+        run._save(failing_save)
+        writer.flush()
+
+        with pytest.raises(OSError, match="disk full"):
+            run._save(save_uniprot_accessions, ["A1YPR0"])
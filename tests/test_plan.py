@@ -0,0 +1,70 @@
+import asyncio
+from collections.abc import Iterable
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from protein_detective.plan import plan_search_async
+from protein_detective.uniprot import PdbResult, Query, SearchCounts
+
+query = Query(
+    taxon_id="9606",
+    reviewed=True,
+    subcellular_location_uniprot=None,
+    subcellular_location_go=None,
+    molecular_function_go=None,
+)
+
+
+@pytest.fixture
+def fake_uniprot(monkeypatch: pytest.MonkeyPatch):
+    counts = SearchCounts(nr_uniprot=20_000, nr_pdb_rows=9_000, nr_pdbs=8_000, nr_alphafolds=19_000)
+    monkeypatch.setattr("protein_detective.plan.count4search", lambda *_args, **_kwargs: counts)
+    monkeypatch.setattr("protein_detective.plan.search4uniprot", lambda *_args, **_kwargs: {"P11111", "P22222"})
+
+    def search4pdb(uniprot_accs: Iterable[str]) -> dict[str, set[PdbResult]]:
+        return {
+            acc: {PdbResult(id=f"{acc[-1]}ABC", method="X-ray diffraction", uniprot_chains="A=1-100")}
+            for acc in uniprot_accs
+        }
+
+    monkeypatch.setattr("protein_detective.plan.search4pdb", search4pdb)
+    monkeypatch.setattr("protein_detective.plan.search4af", lambda accs: {acc: {acc} for acc in accs})
+
+
+@pytest.mark.usefixtures("fake_uniprot")
+def test_plan_search(monkeypatch: pytest.MonkeyPatch):
+    sizes = {"1abc.cif": 3000, "2abc.cif": 1000, "AF-P11111-F1-model_v4.pdb": 200}
+
+    async def handler(request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        if name not in sizes:
+            return web.Response(status=404)
+        return web.Response(body=b"x" * sizes[name])
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{name}", handler)
+        async with TestServer(app) as server:
+
+            def map_id_mmcif(pdb_id: str) -> tuple[str, str]:
+                fn = f"{pdb_id.lower()}.cif"
+                return str(server.make_url(f"/{fn}")), fn
+
+            async def fetch_summmary(qualifier: str, *_args) -> list[SimpleNamespace]:
+                return [SimpleNamespace(pdbUrl=str(server.make_url(f"/AF-{qualifier}-F1-model_v4.pdb")))]
+
+            monkeypatch.setattr("protein_detective.plan._map_id_mmcif", map_id_mmcif)
+            monkeypatch.setattr("protein_detective.plan.fetch_summmary", fetch_summmary)
+            return await plan_search_async(query, limit=10_000)
+
+    plan = asyncio.run(run())
+
+    assert plan.counts.nr_uniprot == 20_000
+    assert plan.truncated == ["uniprot", "alphafold"]
+    assert plan.pdb_file_size == 2000
+    assert plan.pdb_bytes == 8_000 * 2000
+    # The file of P22222 was not found, so only the size of P11111 is used
+    assert plan.alphafold_bytes == 10_000 * 200
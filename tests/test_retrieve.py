@@ -0,0 +1,53 @@
+from pathlib import Path
+
+import pytest
+
+from protein_detective.db import connect, load_pdbs, save_alphafolds, save_pdbs
+from protein_detective.shards import Shard, merge_shards
+from protein_detective.uniprot import PdbResult
+from protein_detective.workflow import retrieve_structures
+
+
+@pytest.fixture
+def found_session_dir(tmp_path: Path) -> Path:
+    """Session with one PDBe and one AlphaFold structure found, but not retrieved."""
+    session_dir = tmp_path / "session"
+    session_dir.mkdir()
+    with connect(session_dir) as con:
+        save_pdbs({"A1YPR0": [PdbResult(id="1ABC", method="X-ray diffraction", uniprot_chains="A=1-100")]}, con)
+        save_alphafolds({"A1YPR0": {"A1YPR0"}}, con)
+    return session_dir
+
+
+@pytest.fixture
+def failing_alphafold(monkeypatch: pytest.MonkeyPatch):
+    async def fake_pdbe_fetch(ids, save_dir, *args, **kwargs):
+        return {pdb_id: save_dir / f"{pdb_id.lower()}.cif" for pdb_id in ids}
+
+    async def failing_af_fetch(*args, **kwargs):
+        msg = "AlphaFold is down"
+        raise ConnectionError(msg)
+
+    monkeypatch.setattr("protein_detective.pdbe.fetch.fetch_async", fake_pdbe_fetch)
+    monkeypatch.setattr("protein_detective.alphafold.fetch.fetch_many_list_async", failing_af_fetch)
+
+
+@pytest.mark.usefixtures("failing_alphafold")
+def test_retrieve_saves_pdbe_files_when_alphafold_fails(found_session_dir: Path):
+    with pytest.raises(ConnectionError, match="AlphaFold is down"):
+        retrieve_structures(found_session_dir)
+
+    with connect(found_session_dir) as con:
+        assert [row.mmcif_file for row in load_pdbs(con)] == [Path("downloads/1abc.cif")]
+
+
+@pytest.mark.usefixtures("failing_alphafold")
+def test_retrieve_shard_writes_pdbe_files_when_alphafold_fails(found_session_dir: Path):
+    with pytest.raises(ConnectionError, match="AlphaFold is down"):
+        retrieve_structures(found_session_dir, shard=Shard(0, 1))
+
+    merged = merge_shards(found_session_dir)
+
+    assert merged["retrieve-pdbe"] == 1
+    with connect(found_session_dir) as con:
+        assert [row.mmcif_file for row in load_pdbs(con)] == [Path("downloads/1abc.cif")]
@@ -0,0 +1,78 @@
+from collections.abc import Iterable
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+from protein_detective.db import connect, load_alphafold_ids, load_fresh_uniprot_accessions, save_uniprot_accessions
+from protein_detective.gene_ontology import GoOntology
+from protein_detective.uniprot import PdbResult, Query
+from protein_detective.workflow import search_structures_in_uniprot
+
+
+class FakeUniProt:
+    """Stands in for the SPARQL searches and records which accessions cross-references are searched for."""
+
+    def __init__(self, monkeypatch: pytest.MonkeyPatch, accessions: set[str]):
+        self.accessions = accessions
+        self.searched: list[set[str]] = []
+        monkeypatch.setattr("protein_detective.workflow.search4uniprot", self.search4uniprot)
+        monkeypatch.setattr("protein_detective.workflow.search4pdb", self.search4pdb)
+        monkeypatch.setattr("protein_detective.workflow.search4af", self.search4af)
+
+    def search4uniprot(self, query: Query, limit: int, go_ontology: GoOntology | None = None) -> set[str]:
+        return set(self.accessions)
+
+    def search4pdb(self, uniprot_accs: Iterable[str], limit: int) -> dict[str, set[PdbResult]]:
+        self.searched.append(set(uniprot_accs))
+        return {}
+
+    def search4af(self, uniprot_accs: Iterable[str], limit: int) -> dict[str, set[str]]:
+        return {acc: {acc} for acc in uniprot_accs}
+
+
+query = Query(
+    taxon_id="9606",
+    reviewed=True,
+    subcellular_location_uniprot=None,
+    subcellular_location_go=None,
+    molecular_function_go=None,
+)
+
+
+def test_search_records_refresh(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    FakeUniProt(monkeypatch, {"P11111", "P22222"})
+
+    result = search_structures_in_uniprot(query, tmp_path)
+
+    assert result == (2, 0, 2)
+    with connect(tmp_path) as con:
+        assert load_fresh_uniprot_accessions(con) == {"P11111", "P22222"}
+        assert load_fresh_uniprot_accessions(con, timedelta(0)) == set()
+
+
+def test_incremental_search_only_searches_new_accessions(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    FakeUniProt(monkeypatch, {"P11111", "P22222"})
+    search_structures_in_uniprot(query, tmp_path)
+    with connect(tmp_path) as con:
+        # Found by a search before refresh times were recorded
+        save_uniprot_accessions(["P33333"], con)
+    fake = FakeUniProt(monkeypatch, {"P11111", "P22222", "P33333", "P44444"})
+
+    result = search_structures_in_uniprot(query, tmp_path, incremental=True)
+
+    assert fake.searched == [{"P33333", "P44444"}]
+    assert result == (4, 0, 2)
+    with connect(tmp_path) as con:
+        assert load_alphafold_ids(con) == {"P11111", "P22222", "P33333", "P44444"}
+
+
+def test_incremental_search_refreshes_old_accessions(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    FakeUniProt(monkeypatch, {"P11111"})
+    search_structures_in_uniprot(query, tmp_path)
+    fake = FakeUniProt(monkeypatch, {"P11111"})
+
+    search_structures_in_uniprot(query, tmp_path, incremental=True, refresh_after=timedelta(days=30))
+    search_structures_in_uniprot(query, tmp_path, incremental=True, refresh_after=timedelta(0))
+
+    assert fake.searched == [{"P11111"}]
@@ -0,0 +1,107 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from protein_detective.db import connect
+from protein_detective.server import WarmState, make_app, warm_state_key
+
+
+async def run_jobs(*jobs: dict) -> tuple[list[tuple[int, dict]], list[dict], WarmState]:
+    """Submit jobs, wait for them to finish and return the submit responses, the finished jobs and the server state."""
+    with ThreadPoolExecutor() as processes:
+        app = make_app(processes=processes)
+        async with TestClient(TestServer(app)) as client:
+
+            async def post(job: dict) -> tuple[int, dict]:
+                response = await client.post("/jobs", json=job)
+                return response.status, await response.json()
+
+            async def wait(job_id: str) -> dict:
+                while True:
+                    response = await client.get(f"/jobs/{job_id}")
+                    body = await response.json()
+                    if body["status"] != "running":
+                        return body
+                    await asyncio.sleep(0.01)
+
+            submitted = await asyncio.gather(*(post(job) for job in jobs))
+            finished = await asyncio.gather(*(wait(body["id"]) for status, body in submitted if status == 202))
+            return submitted, finished, app[warm_state_key]
+
+
+def test_density_filter_job(af_session_dir: Path):
+    job = {
+        "command": "density-filter",
+        "session_dir": str(af_session_dir),
+        "options": {"confidence_threshold": 50, "min_residues": 100, "max_residues": 1000, "eager": True},
+    }
+
+    [(status, submitted)], [finished], _ = asyncio.run(run_jobs(job))
+
+    assert status == 202
+    assert submitted["status"] == "running"
+    assert finished["id"] == submitted["id"]
+    assert finished["status"] == "done"
+    assert finished["result"] == {
+        "density_filtered_dir": str(af_session_dir / "density_filtered" / "confidence_50"),
+        "nr_kept": 1,
+        "nr_discarded": 0,
+        "nr_unchanged": 0,
+    }
+    assert (af_session_dir / "density_filtered" / "confidence_50" / "AF-A1YPR0-F1-model_v4.pdb").exists()
+
+
+def test_jobs_on_same_session_share_writer(af_session_dir: Path):
+    job = {"command": "density-filter", "session_dir": str(af_session_dir)}
+    prune_job = {"command": "prune-pdbs", "session_dir": str(af_session_dir)}
+
+    submitted, finished, state = asyncio.run(run_jobs(job, prune_job, job))
+
+    assert [status for status, _ in submitted] == [202, 202, 202]
+    assert [body["status"] for body in finished] == ["done", "done", "done"]
+    # Writers of idle sessions are closed, so other processes can open the session
+    assert state.writers == {}
+    with connect(af_session_dir) as con:
+        assert con.execute("SELECT count(*) FROM density_filtered_alphafolds").fetchone() == (1,)
+
+
+def test_failed_job(tmp_path: Path):
+    job = {"command": "prune-pdbs", "session_dir": str(tmp_path / "session")}
+    # The session directory is a file
+    (tmp_path / "session").write_text("")
+
+    _, [finished], _ = asyncio.run(run_jobs(job))
+
+    assert finished["status"] == "failed"
+    assert "result" not in finished
+    assert finished["error"]
+
+
+def test_unknown_job():
+    async def get_unknown() -> int:
+        with ThreadPoolExecutor() as processes:
+            async with TestClient(TestServer(make_app(processes=processes))) as client:
+                response = await client.get("/jobs/unknown")
+                return response.status
+
+    assert asyncio.run(get_unknown()) == 404
+
+
+@pytest.mark.parametrize(
+    "job",
+    [
+        [],
+        {"command": "dance", "session_dir": "."},
+        {"command": "prune-pdbs"},
+        {"command": "density-filter", "session_dir": ".", "options": {"confidence": 50}},
+        {"command": "retrieve", "session_dir": ".", "options": {"what": ["rcsb"]}},
+    ],
+)
+def test_invalid_job(job):
+    [(status, body)], _, _ = asyncio.run(run_jobs(job))
+
+    assert status == 400
+    assert "error" in body
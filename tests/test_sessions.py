@@ -0,0 +1,91 @@
+from pathlib import Path
+
+import pytest
+from duckdb import connect as duckdb_connect
+
+from protein_detective.alphafold.density import DensityFilterQuery, DensityFilterResult
+from protein_detective.db import connect, save_alphafolds, save_density_filtered, save_pdbs
+from protein_detective.sessions import attach_sessions, presets, query_sessions
+from protein_detective.uniprot import PdbResult
+
+
+@pytest.fixture
+def session_dirs(tmp_path: Path) -> list[Path]:
+    session1 = tmp_path / "session1"
+    session1.mkdir()
+    with connect(session1) as con:
+        save_pdbs(
+            {
+                "P12345": [PdbResult(id="1ABC", method="X-Ray", uniprot_chains="A=1-100", resolution="2.0")],
+                "P67890": [PdbResult(id="2DEF", method="EM", uniprot_chains="B=1-50")],
+            },
+            con,
+        )
+    session2 = tmp_path / "session2"
+    session2.mkdir()
+    with connect(session2) as con:
+        save_pdbs({"Q11111": [PdbResult(id="1ABC", method="X-Ray", uniprot_chains="C=1-100", resolution="2.0")]}, con)
+        save_alphafolds({"Q11111": {"Q11111"}}, con)
+        save_density_filtered(
+            DensityFilterQuery(confidence=70.0, min_threshold=0, max_threshold=1000),
+            [DensityFilterResult(pdb_file="AF-Q11111-F1-model_v4.pdb", count=42, density_filtered_file=None)],
+            ["Q11111"],
+            con,
+        )
+    return [session1, session2]
+
+
+def test_attach_sessions_combines_tables(session_dirs: list[Path]):
+    con = attach_sessions(session_dirs)
+
+    rows = con.execute("SELECT session_dir, uniprot_acc, pdb_id FROM proteins_pdbs ORDER BY ALL").fetchall()
+
+    assert rows == [
+        (str(session_dirs[0]), "P12345", "1ABC"),
+        (str(session_dirs[0]), "P67890", "2DEF"),
+        (str(session_dirs[1]), "Q11111", "1ABC"),
+    ]
+
+
+def test_attach_sessions_from_before_schema_versioning(session_dirs: list[Path], tmp_path: Path):
+    old_session = tmp_path / "old_session"
+    old_session.mkdir()
+    con = duckdb_connect(old_session / "session.db")
+    con.execute("CREATE TABLE proteins (uniprot_acc TEXT PRIMARY KEY)")
+    con.execute("INSERT INTO proteins VALUES ('P99999')")
+    con.close()
+
+    con = attach_sessions([*session_dirs, old_session])
+
+    result = con.execute("SELECT count(*) FROM proteins").fetchone()
+    assert result == (4,)
+
+
+def test_attach_sessions_without_database(tmp_path: Path):
+    with pytest.raises(ValueError, match="has no database"):
+        attach_sessions([tmp_path])
+
+
+def test_shared_pdbs_preset(session_dirs: list[Path]):
+    con = attach_sessions(session_dirs)
+
+    rows = con.execute(presets["shared-pdbs"]).fetchall()
+
+    assert rows == [("1ABC", 2, [str(session_dirs[0]), str(session_dirs[1])])]
+
+
+def test_density_filtered_preset(session_dirs: list[Path]):
+    con = attach_sessions(session_dirs)
+
+    rows = con.execute(presets["density-filtered"]).fetchall()
+
+    assert rows == [(str(session_dirs[1]), 70.0, 0, 1000, "Q11111", 42, False, None)]
+
+
+def test_query_sessions_to_parquet(session_dirs: list[Path], tmp_path: Path):
+    output = tmp_path / "shared.parquet"
+
+    query_sessions(session_dirs, "shared-pdbs", output)
+
+    result = duckdb_connect().execute("SELECT pdb_id, nr_sessions FROM read_parquet(?)", (str(output),)).fetchall()
+    assert result == [("1ABC", 2)]
@@ -0,0 +1,97 @@
+import re
+from pathlib import Path
+
+import pytest
+
+from protein_detective.alphafold.density import DensityFilterQuery
+from protein_detective.db import connect, load_alphafolds
+from protein_detective.shards import Shard, merge_shards, shards_dir, write_retrieved
+from protein_detective.workflow import density_filter
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("0/1", Shard(0, 1)),
+        ("3/8", Shard(3, 8)),
+    ],
+)
+def test_shard_parse(value: str, expected: Shard):
+    assert Shard.parse(value) == expected
+
+
+@pytest.mark.parametrize("value", ["3", "8/8", "-1/8", "0/0", "a/b"])
+def test_shard_parse_invalid(value: str):
+    with pytest.raises(ValueError, match=r"[Ii]nvalid"):
+        Shard.parse(value)
+
+
+def test_shards_split_keys_into_disjoint_parts():
+    keys = [f"P{i:05d}" for i in range(1000)]
+    shards = [Shard(index, 4) for index in range(4)]
+
+    parts = [{key for key in keys if key in shard} for shard in shards]
+
+    assert sum(len(part) for part in parts) == len(keys)
+    assert set().union(*parts) == set(keys)
+    assert all(len(part) > 0 for part in parts)
+
+
+def test_density_filter_shards_then_merge(af_session_dir: Path):
+    query = DensityFilterQuery(confidence=50, min_threshold=100, max_threshold=1000)
+
+    results = [density_filter(af_session_dir, query, shard=Shard(index, 2)) for index in range(2)]
+
+    assert sum(result.nr_kept for result in results) == 1
+    names = sorted(path.name for path in shards_dir(af_session_dir).iterdir())
+    assert [re.sub(r"-\d{8}T\d{12}-[0-9a-f]{8}-", "-<run>-", name) for name in names] == [
+        "density-filter-<run>-000-of-002.parquet",
+        "density-filter-<run>-001-of-002.parquet",
+    ]
+    with connect(af_session_dir) as con:
+        result = con.execute("SELECT count(*) FROM density_filtered_alphafolds").fetchone()
+        assert result == (0,)
+
+    merged = merge_shards(af_session_dir)
+    # Merged files are removed, so merging again merges nothing
+    merged_again = merge_shards(af_session_dir)
+
+    assert merged["density-filter"] == 2
+    assert merged_again["density-filter"] == 0
+    assert list(shards_dir(af_session_dir).iterdir()) == []
+    with connect(af_session_dir) as con:
+        rows = con.execute(
+            """SELECT confidence, min_threshold, max_threshold, uniprot_acc, keep, pdb_file
+            FROM density_filtered_alphafolds JOIN density_filters USING (density_filter_id)"""
+        ).fetchall()
+    assert rows == [(50.0, 100, 1000, "A1YPR0", True, "density_filtered/confidence_50/AF-A1YPR0-F1-model_v4.pdb")]
+
+
+def test_merge_retrieved_alphafolds(af_session_dir: Path):
+    with connect(af_session_dir) as con:
+        [af] = load_alphafolds(con)
+        con.execute("UPDATE alphafolds SET summary = NULL, pdb_file = NULL")
+    af.cif_file = Path("downloads/AF-A1YPR0-F1-model_v4.cif")
+
+    write_retrieved(af_session_dir, Shard(0, 1), {}, [af])
+    merged = merge_shards(af_session_dir)
+
+    assert merged["retrieve-alphafold"] == 1
+    with connect(af_session_dir) as con:
+        assert load_alphafolds(con) == [af]
+
+
+def test_merge_shards_later_run_wins(af_session_dir: Path):
+    with connect(af_session_dir) as con:
+        [af] = load_alphafolds(con)
+    af.cif_file = Path("downloads/AF-A1YPR0-F1-model_v4.cif")
+    write_retrieved(af_session_dir, Shard(0, 1), {}, [af])
+    # Shard is rerun before the first run is merged
+    af.cif_file = Path("downloads/AF-A1YPR0-F1-model_v5.cif")
+    write_retrieved(af_session_dir, Shard(0, 1), {}, [af])
+
+    merged = merge_shards(af_session_dir)
+
+    assert merged["retrieve-alphafold"] == 2
+    with connect(af_session_dir) as con:
+        assert load_alphafolds(con) == [af]
@@ -1,6 +1,19 @@
+import re
+import urllib.error
+from email.message import Message
 from textwrap import dedent
 
-from protein_detective.uniprot import Query, _build_sparql_query_pdb, _build_sparql_query_uniprot
+import pytest
+
+from protein_detective.gene_ontology import GoOntology
+from protein_detective.uniprot import (
+    Query,
+    SearchCounts,
+    _build_sparql_query_pdb,
+    _build_sparql_query_uniprot,
+    count4search,
+    search4af,
+)
 
 
 def assertQueryEqual(actual, expected):
@@ -101,3 +114,134 @@ def test_build_sparql_query_pdb():
         LIMIT 42
     """)
     assertQueryEqual(result, expected)
+
+
+class FakeEndpoint:
+    """Stands in for the UniProt SPARQL endpoint, failing queries with more than `max_accessions` accessions."""
+
+    def __init__(self, max_accessions: int, error: Exception):
+        self.max_accessions = max_accessions
+        self.error = error
+        self.queried: list[list[str]] = []
+
+    def __call__(self, sparql_query: str, timeout: int) -> list:
+        accs = re.findall(r'\("(\w+)"\)', sparql_query)
+        self.queried.append(accs)
+        if len(accs) > self.max_accessions:
+            raise self.error
+        return [
+            {
+                "protein": {"value": f"http://purl.uniprot.org/uniprot/{acc}"},
+                "af_db": {"value": f"http://purl.uniprot.org/alphafolddb/{acc}"},
+            }
+            for acc in accs
+        ]
+
+
+@pytest.fixture
+def no_sleep(monkeypatch: pytest.MonkeyPatch) -> list[float]:
+    sleeps: list[float] = []
+    monkeypatch.setattr("protein_detective.uniprot.time.sleep", sleeps.append)
+    return sleeps
+
+
+def test_search4af_splits_query_on_timeout(monkeypatch: pytest.MonkeyPatch, no_sleep: list[float]):
+    endpoint = FakeEndpoint(max_accessions=1, error=TimeoutError("timed out"))
+    monkeypatch.setattr("protein_detective.uniprot._execute_sparql_search", endpoint)
+
+    result = search4af(["P1", "P2", "P3"])
+
+    assert result == {"P1": {"P1"}, "P2": {"P2"}, "P3": {"P3"}}
+    assert endpoint.queried == [["P1", "P2", "P3"], ["P1"], ["P2", "P3"], ["P2"], ["P3"]]
+    assert no_sleep == []
+
+
+def test_search4af_retries_server_error_before_splitting(monkeypatch: pytest.MonkeyPatch, no_sleep: list[float]):
+    error = urllib.error.HTTPError("https://sparql.uniprot.org/sparql", 503, "Service Unavailable", Message(), None)
+    endpoint = FakeEndpoint(max_accessions=1, error=error)
+    monkeypatch.setattr("protein_detective.uniprot._execute_sparql_search", endpoint)
+
+    result = search4af(["P1", "P2"])
+
+    assert result == {"P1": {"P1"}, "P2": {"P2"}}
+    assert endpoint.queried == [["P1", "P2"]] * 4 + [["P1"], ["P2"]]
+    assert no_sleep == [5, 10, 20]
+
+
+def test_search4af_fails_when_single_accession_times_out(monkeypatch: pytest.MonkeyPatch, no_sleep: list[float]):
+    endpoint = FakeEndpoint(max_accessions=0, error=TimeoutError("timed out"))
+    monkeypatch.setattr("protein_detective.uniprot._execute_sparql_search", endpoint)
+
+    with pytest.raises(TimeoutError):
+        search4af(["P1"])
+
+    assert len(no_sleep) == 3
+
+
+def test_build_sparql_query_uniprot_with_go_ontology():
+    query = Query(
+        taxon_id=None,
+        reviewed=None,
+        subcellular_location_uniprot=None,
+        subcellular_location_go="GO:0005634",
+        molecular_function_go="GO:0003677",
+    )
+    ontology = GoOntology({"GO:0005634": set(), "GO:0005654": {"GO:0005634"}})
+
+    result = _build_sparql_query_uniprot(query, limit=10, go_ontology=ontology)
+
+    expected = """
+        PREFIX up: <http://purl.uniprot.org/core/>
+        PREFIX taxon: <http://purl.uniprot.org/taxonomy/>
+        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+        PREFIX GO:<http://purl.obolibrary.org/obo/GO_>
+
+        SELECT ?protein
+        WHERE {
+
+        # --- Protein Selection ---
+        ?protein a up:Protein .
+
+        VALUES ?location_go { GO:0005634 GO:0005654 }
+        ?protein up:classifiedWith ?location_go .
+
+
+        ?protein up:classifiedWith|(up:classifiedWith/rdfs:subClassOf) GO:0003677 .
+
+
+        }
+
+        LIMIT 10
+    """
+    assertQueryEqual(result, expected)
+
+
+def test_count4search(monkeypatch: pytest.MonkeyPatch):
+    queries: list[str] = []
+
+    def execute(sparql_query: str, timeout: int) -> list:
+        queries.append(sparql_query)
+        if "?rows" in sparql_query:
+            return [{"rows": {"value": "12"}, "count": {"value": "10"}}]
+        return [{"count": {"value": str(len(queries))}}]
+
+    monkeypatch.setattr("protein_detective.uniprot._execute_sparql_search", execute)
+    query = Query(
+        taxon_id="9606",
+        reviewed=True,
+        subcellular_location_uniprot=None,
+        subcellular_location_go=None,
+        molecular_function_go=None,
+    )
+
+    result = count4search(query)
+
+    assert result == SearchCounts(nr_uniprot=1, nr_pdb_rows=12, nr_pdbs=10, nr_alphafolds=3)
+    assert all("SELECT DISTINCT ?protein" in sparql_query for sparql_query in queries)
+    assert all("?protein up:organism taxon:9606 ." in sparql_query for sparql_query in queries)
+    [pdb_query] = [sparql_query for sparql_query in queries if "?rows" in sparql_query]
+    # Same required patterns as the search, so only PDB entries the search finds are counted
+    assert 'FILTER(STRSTARTS(?isoformPart, CONCAT(?ac, "-")))' in pdb_query
+    assert "?pdb_db up:method ?pdb_method ." in pdb_query
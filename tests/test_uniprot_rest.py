@@ -0,0 +1,160 @@
+import io
+import json
+import threading
+from collections.abc import Iterator
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import ClassVar
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from protein_detective.db import connect, load_alphafold_ids, load_pdbs
+from protein_detective.uniprot import PdbResult, Query
+from protein_detective.uniprot_rest import (
+    _iter_json_results,
+    _query2rest_query,
+    iter_search4structures,
+)
+from protein_detective.workflow import search_structures_in_uniprot
+
+results = [
+    {
+        "primaryAccession": "P05067",
+        "uniProtKBCrossReferences": [
+            {
+                "database": "PDB",
+                "id": "1AAP",
+                "properties": [
+                    {"key": "Method", "value": "X-ray"},
+                    {"key": "Resolution", "value": "1.50 A"},
+                    {"key": "Chains", "value": "A/B=287-344, C=400-410"},
+                ],
+            },
+            {
+                "database": "PDB",
+                "id": "1AMB",
+                "properties": [
+                    {"key": "Method", "value": "NMR"},
+                    {"key": "Resolution", "value": "-"},
+                    {"key": "Chains", "value": "A=672-699"},
+                ],
+            },
+            {"database": "AlphaFoldDB", "id": "P05067", "properties": [{"key": "Description", "value": "-"}]},
+        ],
+    },
+    {"primaryAccession": "P0DTC2", "uniProtKBCrossReferences": []},
+    {"primaryAccession": "Q9NZC2"},
+]
+
+
+class StandInUniProt(BaseHTTPRequestHandler):
+    """Stands in for the stream endpoint of the UniProt REST API."""
+
+    queries: ClassVar[list[dict[str, list[str]]]] = []
+
+    def do_GET(self):
+        self.queries.append(parse_qs(urlparse(self.path).query))
+        body = json.dumps({"results": results}, indent=2).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+
+@pytest.fixture
+def stream_url() -> Iterator[str]:
+    StandInUniProt.queries = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInUniProt)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/uniprotkb/stream"
+    server.shutdown()
+    server.server_close()
+
+
+query = Query(
+    taxon_id="9606",
+    reviewed=True,
+    subcellular_location_uniprot="Nucleus",
+    subcellular_location_go="GO:0005634",
+    molecular_function_go="GO:0003677",
+)
+
+
+def test_query2rest_query():
+    result = _query2rest_query(query)
+
+    assert result == 'organism_id:9606 AND reviewed:true AND (cc_scl_term:"Nucleus" OR go:0005634) AND go:0003677'
+
+
+def test_iter_json_results_with_small_chunks():
+    document = json.dumps({"results": [*results, {"primaryAccession": "Ünïcode"}]}).encode()
+
+    items = list(_iter_json_results(io.BytesIO(document), chunk_size=7))
+
+    assert [item["primaryAccession"] for item in items] == ["P05067", "P0DTC2", "Q9NZC2", "Ünïcode"]
+
+
+def test_iter_json_results_of_truncated_stream():
+    document = json.dumps({"results": results}).encode()
+    truncated = document[: document.index(b'{"primaryAccession": "Q9NZC2"') + 20]
+
+    items = _iter_json_results(io.BytesIO(truncated), chunk_size=7)
+
+    with pytest.raises(ValueError, match="ended before the results were complete"):
+        list(items)
+
+
+def test_iter_json_results_without_results():
+    document = json.dumps({"messages": ["bad query"]}).encode()
+
+    with pytest.raises(ValueError, match="no results"):
+        list(_iter_json_results(io.BytesIO(document)))
+
+
+def test_iter_search4structures(stream_url: str):
+    entries = list(iter_search4structures(query, url=stream_url))
+
+    assert [entry.uniprot_acc for entry in entries] == ["P05067", "P0DTC2", "Q9NZC2"]
+    assert entries[0].pdbs == {
+        PdbResult(id="1AAP", method="X-Ray_Crystallography", uniprot_chains="A/B=287-344,C=400-410", resolution="1.5"),
+        PdbResult(id="1AMB", method="NMR_Spectroscopy", uniprot_chains="A=672-699"),
+    }
+    assert entries[0].alphafolds == {"P05067"}
+    assert StandInUniProt.queries[0]["fields"] == ["accession,xref_pdb,xref_alphafolddb"]
+
+
+def test_iter_search4structures_limit(stream_url: str):
+    entries = list(iter_search4structures(query, limit=2, url=stream_url))
+
+    assert len(entries) == 2
+
+
+def test_search_structures_in_uniprot_with_rest_backend(
+    stream_url: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(
+        "protein_detective.workflow.iter_search4structures", partial(iter_search4structures, url=stream_url)
+    )
+
+    result = search_structures_in_uniprot(query, tmp_path, backend="rest")
+
+    assert result == (3, 2, 1)
+    with connect(tmp_path) as con:
+        assert {(row.id, row.uniprot_chains) for row in load_pdbs(con)} == {
+            ("1AAP", "A/B=287-344,C=400-410"),
+            ("1AMB", "A=672-699"),
+        }
+        assert load_alphafold_ids(con) == {"P05067"}
+        assert con.execute("SELECT count(*) FROM proteins WHERE refreshed_at IS NOT NULL").fetchone() == (3,)
+
+
+def test_search_structures_in_uniprot_with_rest_backend_is_not_incremental(tmp_path: Path):
+    with pytest.raises(ValueError, match="rest backend does not support"):
+        search_structures_in_uniprot(query, tmp_path, incremental=True, backend="rest")
@@ -0,0 +1,211 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from aiohttp import ClientResponseError, RequestInfo, web
+from aiohttp.test_utils import TestServer
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from protein_detective.instrumentation import instrumentation
+from protein_detective.utils import (
+    AdaptiveLimiter,
+    _parse_retry_after,
+    _worker_pool,
+    retries_stage,
+    retrieve_files,
+    run_async,
+)
+
+url = "https://alphafold.ebi.ac.uk/files/AF-A1YPR0-F1-model_v4.pdb"
+host = "alphafold.ebi.ac.uk"
+
+
+def throttled_error(retry_after: int) -> ClientResponseError:
+    request_info = RequestInfo(URL(url), "GET", CIMultiDictProxy(CIMultiDict()), URL(url))
+    return ClientResponseError(
+        request_info, (), status=429, headers=CIMultiDictProxy(CIMultiDict({"Retry-After": str(retry_after)}))
+    )
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("120", 120.0),
+        ("-1", 0.0),
+        ("Wed, 21 Oct 2015 07:28:00 GMT", 0.0),  # in the past
+        ("soon", None),
+        (None, None),
+    ],
+)
+def test_parse_retry_after(value, expected):
+    assert _parse_retry_after(value) == expected
+
+
+def test_adaptive_limiter_increases_on_success():
+    # Latencies of sleep(0) are too noisy to compare
+    limiter = AdaptiveLimiter(max_concurrency=4, initial_concurrency=1, latency_spike=float("inf"))
+
+    async def download():
+        async with limiter.limit(url):
+            await asyncio.sleep(0)
+
+    async def run():
+        for _ in range(20):
+            await download()
+
+    asyncio.run(run())
+
+    assert limiter.concurrency(host) == 4
+
+
+def test_adaptive_limiter_decreases_on_throttle():
+    limiter = AdaptiveLimiter(max_concurrency=8, initial_concurrency=8)
+
+    async def run():
+        with pytest.raises(ClientResponseError):
+            async with limiter.limit(url):
+                raise throttled_error(0)
+
+    asyncio.run(run())
+
+    assert limiter.concurrency(host) == 4
+    assert limiter.concurrency("www.ebi.ac.uk") == 8
+
+
+def test_adaptive_limiter_never_below_min():
+    limiter = AdaptiveLimiter(max_concurrency=8, min_concurrency=2, initial_concurrency=2)
+
+    limiter.throttle(host)
+
+    assert limiter.concurrency(host) == 2
+
+
+def test_retrieve_files_retries_throttled(tmp_path: Path):
+    calls = 0
+
+    async def handler(request: web.Request) -> web.Response:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            return web.Response(status=429, headers={"Retry-After": "0"})
+        return web.Response(text=f"HEADER    {request.match_info['name']}\n")
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{name}", handler)
+        async with TestServer(app) as server:
+            urls = [(str(server.make_url(f"/{name}")), name) for name in ("a.pdb", "b.pdb")]
+            return await retrieve_files(urls, tmp_path, max_parallel_downloads=1)
+
+    files = asyncio.run(run())
+
+    assert sorted(f.read_text() for f in files) == ["HEADER    a.pdb\n", "HEADER    b.pdb\n"]
+    assert calls == 3
+
+
+def test_worker_pool_bounds_work_in_progress():
+    in_progress = 0
+    max_in_progress = 0
+
+    async def items():
+        for i in range(100):
+            yield (i,)
+
+    async def work(i: int) -> int:
+        nonlocal in_progress, max_in_progress
+        in_progress += 1
+        max_in_progress = max(max_in_progress, in_progress)
+        await asyncio.sleep(0)
+        in_progress -= 1
+        return i * 2
+
+    async def run():
+        return [r async for r in _worker_pool(items(), work, nr_workers=3)]
+
+    results = asyncio.run(run())
+
+    assert sorted(results) == list(range(0, 200, 2))
+    assert max_in_progress == 3
+
+
+def test_worker_pool_raises_first_error():
+    async def work(i: int) -> int:
+        if i == 5:
+            msg = "boom"
+            raise ValueError(msg)
+        return i
+
+    async def run():
+        return [r async for r in _worker_pool(((i,) for i in range(10)), work, nr_workers=2)]
+
+    with pytest.raises(ValueError, match="boom"):
+        asyncio.run(run())
+
+
+async def answer() -> int:
+    await asyncio.sleep(0)
+    return 42
+
+
+def test_run_async():
+    assert run_async(answer()) == 42
+
+
+def test_run_async_inside_running_loop():
+    async def run():
+        return run_async(answer())
+
+    assert asyncio.run(run()) == 42
+
+
+def test_retrieve_files_counts_retries_once(tmp_path: Path):
+    calls = 0
+
+    async def handler(request: web.Request) -> web.Response:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            return web.Response(status=429, headers={"Retry-After": "0"})
+        if calls == 2:
+            return web.Response(text="<html><body>Service unavailable</body></html>", content_type="text/html")
+        return web.Response(text="data_8WAS\n#\n")
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{name}", handler)
+        async with TestServer(app) as server:
+            return await retrieve_files([(str(server.make_url("/8was.cif")), "8was.cif")], tmp_path)
+
+    instrumentation.enable()
+    try:
+        asyncio.run(run())
+    finally:
+        instrumentation.disable()
+
+    assert {name: stats.retries for name, stats in instrumentation.stages.items() if stats.retries} == {
+        retries_stage: 2
+    }
+
+
+def test_retrieve_files_retries_invalid_download(tmp_path: Path):
+    calls = 0
+
+    async def handler(request: web.Request) -> web.Response:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            return web.Response(text="<html><body>Service unavailable</body></html>", content_type="text/html")
+        return web.Response(text="data_8WAS\n#\n")
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{name}", handler)
+        async with TestServer(app) as server:
+            return await retrieve_files([(str(server.make_url("/8was.cif")), "8was.cif")], tmp_path)
+
+    files = asyncio.run(run())
+
+    assert files == [tmp_path / "8was.cif"]
+    assert files[0].read_text() == "data_8WAS\n#\n"
+    assert not (tmp_path / "8was.cif.part").exists()
@@ -0,0 +1,56 @@
+import gzip
+import hashlib
+from pathlib import Path
+
+import pytest
+
+from protein_detective.validation import DownloadValidator, InvalidDownloadError, looks_like
+
+
+@pytest.mark.parametrize(
+    "filename,head,expected",
+    [
+        ("AF-A1YPR0-F1-model_v4.pdb", b"HEADER    01-JUN-22\n", True),
+        ("AF-A1YPR0-F1-model_v4.pdb", b"<!DOCTYPE html>\n<html>", False),
+        ("8was.cif", b"data_8WAS\n#\n", True),
+        ("8was.cif", b"# comment\ndata_8WAS\n", True),
+        ("8was.cif", b"<html><body>Not found</body></html>", False),
+        ("AF-A1YPR0-F1-model_v4.bcif", b"\x83\xa7encoder", True),
+        ("AF-A1YPR0-F1-model_v4.bcif", b"{}", False),
+        ("AF-A1YPR0-F1-predicted_aligned_error_v4.json", b' [{"pae": []}]', True),
+        ("AF-A1YPR0-F1-predicted_aligned_error_v4.png", b"\x89PNG\r\n\x1a\n", True),
+        ("8was.cif.gz", b"\x1f\x8b\x08", True),
+        ("AF-A1YPR0-F1-aa-substitutions.csv", b"protein_variant,am_pathogenicity", True),
+        ("AF-A1YPR0-F1-aa-substitutions.csv", b"<html>", False),
+    ],
+)
+def test_looks_like(filename, head, expected):
+    assert looks_like(filename, head) == expected
+
+
+def test_truncated_download():
+    validation = DownloadValidator().stream(Path("8was.cif"), {"Content-Length": "100"})
+    validation.update(b"data_8WAS\n")
+
+    with pytest.raises(InvalidDownloadError, match="truncated"):
+        validation.finish()
+
+
+def test_truncated_gzip():
+    body = gzip.compress(b"data_8WAS\n" * 1000)
+    validation = DownloadValidator().stream(Path("8was.cif.gz"))
+    validation.update(body[: len(body) // 2])
+
+    with pytest.raises(InvalidDownloadError, match="truncated gzip"):
+        validation.finish()
+
+
+def test_digest():
+    validator = DownloadValidator(hash_algorithm="sha256")
+    path = Path("8was.cif")
+    validation = validator.stream(path)
+    validation.update(b"data_8WAS\n")
+    validation.update(b"#\n")
+    validation.finish()
+
+    assert validator.digests == {path: hashlib.sha256(b"data_8WAS\n#\n").hexdigest()}
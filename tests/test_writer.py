@@ -0,0 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+from duckdb import ConstraintException, DuckDBPyConnection
+
+from protein_detective.db import load_alphafold_ids, save_alphafolds, save_uniprot_accessions
+from protein_detective.writer import SessionWriter
+
+
+def test_session_writer_commits_writes(tmp_path: Path):
+    with SessionWriter(tmp_path) as writer:
+        writer.submit(save_uniprot_accessions, ["P12345"])
+        writer.submit(save_alphafolds, {"P12345": {"P12345"}}).result()
+
+        with writer.reader() as con:
+            assert load_alphafold_ids(con) == {"P12345"}
+
+
+def test_session_writer_failed_write_does_not_fail_others(tmp_path: Path):
+    with SessionWriter(tmp_path) as writer:
+        # alphafolds need a protein, so this write fails
+        failing = writer.submit(save_alphafolds, {"Q99999": {"Q99999"}})
+        succeeding = writer.submit(save_uniprot_accessions, ["P12345"])
+
+        with pytest.raises(ConstraintException):
+            failing.result()
+        succeeding.result()
+        with writer.reader() as con:
+            assert con.execute("SELECT uniprot_acc FROM proteins").fetchall() == [("P12345",)]
+
+
+def test_session_writer_close_commits_pending_writes(tmp_path: Path):
+    with SessionWriter(tmp_path) as writer:
+        futures = [writer.submit(save_uniprot_accessions, [f"P{i:05d}"]) for i in range(250)]
+
+    assert all(future.done() and future.exception() is None for future in futures)
+    with SessionWriter(tmp_path) as writer, writer.reader() as con:
+        assert con.execute("SELECT count(*) FROM proteins").fetchone() == (250,)
+
+
+def test_session_writer_with_concurrent_readers(tmp_path: Path):
+    def count_proteins(con: DuckDBPyConnection) -> int:
+        result = con.execute("SELECT count(*) FROM proteins").fetchone()
+        return result[0] if result else 0
+
+    with SessionWriter(tmp_path, batch_size=10) as writer:
+
+        def read(_):
+            with writer.reader() as con:
+                return count_proteins(con)
+
+        with ThreadPoolExecutor(4) as readers:
+            counts = readers.map(read, range(100))
+            for i in range(100):
+                writer.submit(save_uniprot_accessions, [f"P{i:05d}"])
+            assert all(0 <= count <= 100 for count in counts)
+        writer.flush()
+
+        with writer.reader() as con:
+            assert count_proteins(con) == 100
+
+
+def test_session_writer_submit_after_close(tmp_path: Path):
+    writer = SessionWriter(tmp_path)
+    writer.close()
+
+    with pytest.raises(RuntimeError, match="closed"):
+        writer.submit(save_uniprot_accessions, ["P12345"])